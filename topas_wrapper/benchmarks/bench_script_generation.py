@@ -0,0 +1,58 @@
+import argparse
+import tempfile
+import time
+from itertools import product
+from pathlib import Path
+from topas_wrapper.get_data import load_experiment_parameters, ExperimentParameters
+from topas_wrapper.create_file_structure import create_filename
+from topas_wrapper.script_generator import generate_script, write_script_to_file, generate_compiled_scripts
+
+
+def create_sweep_parameters(number_of_energies: int, number_of_histories_entries: int) -> ExperimentParameters:
+    experiment_parameters = load_experiment_parameters()
+    particle_source = experiment_parameters.particle_source
+    particle_source.beam_energy = [70 + 100 * i / number_of_energies for i in range(number_of_energies)]
+    particle_source.beam_energy_spreads = [particle_source.beam_energy_spreads[0]] * number_of_energies
+    experiment_parameters.numbers_of_histories = [1000 * (j + 1) for j in range(number_of_histories_entries)]
+    return experiment_parameters
+
+
+def time_inline_generation(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path) -> float:
+    particle_source = experiment_parameters.particle_source
+    start_time = time.perf_counter()
+    for i, j in product(range(len(particle_source.beam_energy)), range(len(experiment_parameters.numbers_of_histories))):
+        script = generate_script(experiment_parameters, i, j, data_folder)
+        filename = create_filename(particle_source.beam_energy[i], particle_source.beam_energy_unit, experiment_parameters.numbers_of_histories[j])
+        write_script_to_file(script, scripts_folder, filename)
+    return time.perf_counter() - start_time
+
+
+def time_compiled_generation(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path) -> float:
+    particle_source = experiment_parameters.particle_source
+    combination_of_indices = product(range(len(particle_source.beam_energy)), range(len(experiment_parameters.numbers_of_histories)))
+    start_time = time.perf_counter()
+    generate_compiled_scripts(experiment_parameters, scripts_folder, data_folder, combination_of_indices)
+    return time.perf_counter() - start_time
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare inline and compiled script generation for large sweeps.")
+    parser.add_argument("--energies", type=int, default=100)
+    parser.add_argument("--histories", type=int, default=100)
+    arguments = parser.parse_args()
+
+    experiment_parameters = create_sweep_parameters(arguments.energies, arguments.histories)
+    number_of_points = arguments.energies * arguments.histories
+    timings = {}
+    for mode, time_generation in [("inline", time_inline_generation), ("compiled", time_compiled_generation)]:
+        with tempfile.TemporaryDirectory() as temporary_folder:
+            scripts_folder = Path(temporary_folder) / "scripts"
+            data_folder = Path(temporary_folder) / "data"
+            scripts_folder.mkdir()
+            data_folder.mkdir()
+            timings[mode] = time_generation(experiment_parameters, scripts_folder, data_folder)
+        print(f"{mode:>8}: {number_of_points} scripts in {timings[mode]:.2f} s ({number_of_points / timings[mode]:.0f} scripts/s)")
+    print(f" speedup: {timings['inline'] / timings['compiled']:.1f}x")
+
+if __name__=="__main__":
+    main()
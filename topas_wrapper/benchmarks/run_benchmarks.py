@@ -0,0 +1,371 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Callable, Dict, List, Optional, Tuple
+import numpy as np
+from topas_wrapper.get_data import load_experiment_parameters, ExperimentParameters
+from topas_wrapper.input_constants import ScriptGenerationMode
+from topas_wrapper.script_generator import generate_scripts
+from topas_wrapper.scorer_output import load_scorer_output, create_sidecar_filepath
+from topas_wrapper.sliced_analysis import slice_scorer_output, projection, lateral_profile, roi_sum, rebin
+from topas_wrapper.analysis import compute_bragg_peak_metrics
+from topas_wrapper.main import run_pipeline
+from topas_wrapper.telemetry import TelemetryLedger
+from topas_wrapper.run_simulations import resolve_core_budget
+from topas_wrapper.create_file_structure import locate_experiment_folder
+from topas_wrapper.file_structure import FileStructure
+from synthetic_outputs import GRID_SHAPES, write_synthetic_scorer_output, create_depth_dose_profiles
+
+BENCHMARK_NAMES = ["script_generation", "parsing", "slicing", "peak_extraction", "end_to_end"]
+RESULTS_FOLDER = Path(__file__).parent / "results"
+STUB_TOPAS_FILEPATH = Path(__file__).parent / "stub_topas.py"
+BENCHMARK_EXPERIMENT_NAME = "benchmark_experiment"
+DEFAULT_NUMBER_OF_REPEATS = 3
+DEFAULT_STUB_STARTUP_SECONDS = 0.2
+DEFAULT_STUB_SECONDS_PER_HISTORY = 1e-4
+DEFAULT_COMPARISON_TOLERANCE = 0.1
+# Numbers of beam energies and of numbers of histories in each sweep
+SCRIPT_GENERATION_SIZES = {"100_runs": (10, 10), "1000_runs": (40, 25), "10000_runs": (100, 100)}
+END_TO_END_SIZES = {"4_runs": (4, 1), "16_runs": (4, 4), "64_runs": (8, 8)}
+END_TO_END_NUMBER_OF_HISTORIES = 1000
+PEAK_EXTRACTION_SIZES = {"1_profile": 1, "100_profiles": 100, "10000_profiles": 10000}
+BEAM_ENERGY_RANGE = (70.0, 170.0)
+
+
+@dataclass
+class BenchmarkResult:
+    benchmark: str
+    case: str
+    size: str
+    best_seconds: float
+    mean_seconds: float
+    repeats: int
+    throughput: float
+    throughput_unit: str
+    parameters: Dict = field(default_factory=dict)
+
+    @property
+    def key(self) -> Tuple[str, str, str]:
+        return self.benchmark, self.case, self.size
+
+
+def time_repeats(function: Callable, number_of_repeats: int, setup: Optional[Callable]=None) -> List[float]:
+    # setup runs untimed before every repeat, for work like clearing what the previous repeat left behind
+    timings = []
+    for _ in range(number_of_repeats):
+        if setup is not None:
+            setup()
+        start_time = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start_time)
+    return timings
+
+
+def create_result(benchmark: str, case: str, size: str, timings: List[float], amount: float, throughput_unit: str,
+                  parameters: Optional[Dict]=None) -> BenchmarkResult:
+    result = BenchmarkResult(benchmark, case, size, min(timings), float(np.mean(timings)), len(timings),
+                             amount / max(min(timings), np.finfo(np.float64).tiny), throughput_unit, parameters or {})
+    print(f"{benchmark:>17} {case:<13} {size:<15} {result.best_seconds:10.4f} s  {result.throughput:14,.1f} {throughput_unit}")
+    return result
+
+
+def call_quietly(function: Callable, *args):
+    # The wrapper reports every script and run it handles, which would bury the timings
+    with contextlib.redirect_stdout(io.StringIO()):
+        return function(*args)
+
+
+def create_benchmark_parameters(number_of_energies: int, numbers_of_histories: List[int], shape: Tuple[int, int, int],
+                                script_generation_mode: ScriptGenerationMode=ScriptGenerationMode.compiled) -> ExperimentParameters:
+    # Starts from EXPERIMENT_PARAMETERS.toml for the physics and source, but fixes everything that changes what is timed
+    experiment_parameters = load_experiment_parameters()
+    particle_source = experiment_parameters.particle_source
+    beam_energies = list(np.linspace(*BEAM_ENERGY_RANGE, number_of_energies)) if number_of_energies > 1 else [BEAM_ENERGY_RANGE[0]]
+    scorer_bins = [None if bins == 1 else bins for bins in shape]
+    return experiment_parameters.model_copy(update={
+        "experiment_name": BENCHMARK_EXPERIMENT_NAME,
+        "overwrite_existing_experiment": True,
+        "regenerate_incrementally": False,
+        "script_generation_mode": script_generation_mode,
+        "number_of_threads": 1,
+        "core_budget": None,
+        "seed_number": 1,
+        "use_result_cache": False,
+        "number_of_shards": 1,
+        "numbers_of_histories": numbers_of_histories,
+        "particle_source": particle_source.model_copy(update={"beam_energy": [float(beam_energy) for beam_energy in beam_energies],
+                                                              "beam_energy_spreads": [particle_source.beam_energy_spreads[0]] * len(beam_energies)}),
+        "scorer": experiment_parameters.scorer.model_copy(update={"x_bins": scorer_bins[0], "y_bins": scorer_bins[1], "z_bins": scorer_bins[2],
+                                                                 "output_type": None}),
+        "adaptive_histories": None,
+        "supervisor": None,
+        "sweep": None})
+
+
+def remove_benchmark_experiment():
+    try:
+        shutil.rmtree(locate_experiment_folder(BENCHMARK_EXPERIMENT_NAME, FileStructure.EXPERIMENTS.value))
+    except FileNotFoundError:
+        pass
+
+
+def benchmark_script_generation(number_of_repeats: int) -> List[BenchmarkResult]:
+    results = []
+    for size, (number_of_energies, number_of_histories_entries) in SCRIPT_GENERATION_SIZES.items():
+        numbers_of_histories = [END_TO_END_NUMBER_OF_HISTORIES * (index + 1) for index in range(number_of_histories_entries)]
+        for script_generation_mode in ScriptGenerationMode:
+            experiment_parameters = create_benchmark_parameters(number_of_energies, numbers_of_histories, GRID_SHAPES["depth_1d"], script_generation_mode)
+            try:
+                timings = time_repeats(lambda: call_quietly(generate_scripts, experiment_parameters), number_of_repeats, remove_benchmark_experiment)
+            finally:
+                remove_benchmark_experiment()
+            results.append(create_result("script_generation", script_generation_mode.value, size, timings,
+                                         number_of_energies * number_of_histories_entries, "scripts/s"))
+    return results
+
+
+def locate_synthetic_output(synthetic_folder: Path, grid_name: str, binary: bool) -> Path:
+    # Written once per suite run and shared by every benchmark that reads it; the 3D CSV alone is about 400 MB
+    output_filepath = synthetic_folder / f"{grid_name}_{'binary' if binary else 'csv'}"
+    if not any(synthetic_folder.glob(f"{output_filepath.name}.*")):
+        print(f"Writing synthetic {'binary' if binary else 'CSV'} scorer output -> {grid_name} {'x'.join(str(bins) for bins in GRID_SHAPES[grid_name])}")
+        write_synthetic_scorer_output(output_filepath, GRID_SHAPES[grid_name], 150.0, END_TO_END_NUMBER_OF_HISTORIES, seed=1, binary=binary)
+    return output_filepath
+
+
+def benchmark_parsing(grid_names: List[str], synthetic_folder: Path, number_of_repeats: int) -> List[BenchmarkResult]:
+    results = []
+    for grid_name in grid_names:
+        number_of_voxels = int(np.prod(GRID_SHAPES[grid_name]))
+        csv_filepath = locate_synthetic_output(synthetic_folder, grid_name, binary=False)
+        sidecar_filepath = create_sidecar_filepath(csv_filepath.parent / f"{csv_filepath.name}.csv")
+        timings = time_repeats(lambda: load_scorer_output(csv_filepath, use_sidecar=False), number_of_repeats)
+        results.append(create_result("parsing", "csv", grid_name, timings, number_of_voxels, "voxels/s"))
+        # The first load writes the sidecar, which every later load of the unchanged CSV reads instead
+        sidecar_filepath.unlink(missing_ok=True)
+        load_scorer_output(csv_filepath)
+        timings = time_repeats(lambda: load_scorer_output(csv_filepath), number_of_repeats)
+        results.append(create_result("parsing", "csv_sidecar", grid_name, timings, number_of_voxels, "voxels/s"))
+        # Binary output is memory-mapped, so this is only the header parse and mapping; slicing reads the data
+        binary_filepath = locate_synthetic_output(synthetic_folder, grid_name, binary=True)
+        timings = time_repeats(lambda: load_scorer_output(binary_filepath), number_of_repeats)
+        results.append(create_result("parsing", "binary", grid_name, timings, number_of_voxels, "voxels/s"))
+    return results
+
+
+def create_slice_requests(shape: Tuple[int, int, int]) -> List:
+    # What a typical analysis asks of one run: the depth profile, both lateral profiles, a central ROI and a coarser grid
+    central_bounds = [(size // 4, size - size // 4) if size >= 4 else None for size in shape]
+    return [projection((2,)),
+            lateral_profile(0),
+            lateral_profile(1),
+            roi_sum(*central_bounds),
+            rebin(2, 2, 5)]
+
+
+def benchmark_slicing(grid_names: List[str], synthetic_folder: Path, number_of_repeats: int) -> List[BenchmarkResult]:
+    results = []
+    for grid_name in grid_names:
+        shape = GRID_SHAPES[grid_name]
+        scorer_output = load_scorer_output(locate_synthetic_output(synthetic_folder, grid_name, binary=True))
+        timings = time_repeats(lambda: slice_scorer_output(scorer_output, create_slice_requests(shape)), number_of_repeats)
+        results.append(create_result("slicing", "binary", grid_name, timings, int(np.prod(shape)), "voxels/s",
+                                     {"number_of_requests": len(create_slice_requests(shape))}))
+    return results
+
+
+def benchmark_peak_extraction(number_of_repeats: int) -> List[BenchmarkResult]:
+    results = []
+    for size, number_of_profiles in PEAK_EXTRACTION_SIZES.items():
+        profiles, depths = create_depth_dose_profiles(number_of_profiles, seed=1)
+        timings = time_repeats(lambda: compute_bragg_peak_metrics(profiles, depths), number_of_repeats)
+        results.append(create_result("peak_extraction", "bragg_metrics", size, timings, number_of_profiles, "profiles/s",
+                                     {"number_of_bins": profiles.shape[1]}))
+    return results
+
+
+def create_stub_launcher(launcher_folder: Path) -> Path:
+    # Runs the stub with this interpreter, which has topas_wrapper installed, whatever python3 is first on PATH
+    launcher_filepath = launcher_folder / "topas"
+    launcher_filepath.write_text(f'#!/bin/sh\nexec "{sys.executable}" "{STUB_TOPAS_FILEPATH}" "$@"\n')
+    launcher_filepath.chmod(0o755)
+    return launcher_filepath
+
+
+def measure_stub_launch_seconds(topas_executable: Path, number_of_repeats: int) -> float:
+    # Interpreter start-up and output writing cost every stub run this much on top of its sleeps
+    with tempfile.TemporaryDirectory() as probe_folder:
+        probe_script_path = Path(probe_folder) / "probe.txt"
+        probe_script_path.write_text(f'i:So/Beam/NumberOfHistoriesInRun = 0\ni:Sc/Scorer/ZBins = {GRID_SHAPES["depth_1d"][2]}\n'
+                                     f's:Sc/Scorer/OutputFile = "{Path(probe_folder) / "probe"}"\n')
+        environment = dict(os.environ, STUB_TOPAS_STARTUP_SECONDS="0", STUB_TOPAS_SECONDS_PER_HISTORY="0")
+        return min(time_repeats(lambda: subprocess.run([str(topas_executable), str(probe_script_path)], env=environment,
+                                                       stdout=subprocess.DEVNULL, check=True), number_of_repeats))
+
+
+def run_end_to_end_sweep(experiment_parameters: ExperimentParameters, topas_executable: Path):
+    # A ledger of its own, so stub runs never reach the shared cost model and every repeat is scheduled alike
+    number_of_runs = len(experiment_parameters.particle_source.beam_energy) * len(experiment_parameters.numbers_of_histories)
+    with tempfile.TemporaryDirectory() as ledger_folder:
+        table = call_quietly(run_pipeline, experiment_parameters, str(topas_executable), 1,
+                             TelemetryLedger(Path(ledger_folder) / "telemetry.sqlite"))
+    if len(table) != number_of_runs:
+        raise RuntimeError(f"The end-to-end sweep analysed {len(table)} of {number_of_runs} runs, so its timing is not comparable.")
+
+
+def benchmark_end_to_end(number_of_repeats: int, stub_startup_seconds: float, stub_seconds_per_history: float) -> List[BenchmarkResult]:
+    os.environ["STUB_TOPAS_STARTUP_SECONDS"] = str(stub_startup_seconds)
+    os.environ["STUB_TOPAS_SECONDS_PER_HISTORY"] = str(stub_seconds_per_history)
+    cores = resolve_core_budget(None)
+    results = []
+    with tempfile.TemporaryDirectory() as launcher_folder:
+        topas_executable = create_stub_launcher(Path(launcher_folder))
+        stub_launch_seconds = measure_stub_launch_seconds(topas_executable, number_of_repeats)
+        for size, (number_of_energies, number_of_histories_entries) in END_TO_END_SIZES.items():
+            numbers_of_histories = [END_TO_END_NUMBER_OF_HISTORIES * (index + 1) for index in range(number_of_histories_entries)]
+            experiment_parameters = create_benchmark_parameters(number_of_energies, numbers_of_histories, GRID_SHAPES["depth_1d"])
+            try:
+                timings = time_repeats(lambda: run_end_to_end_sweep(experiment_parameters, topas_executable), number_of_repeats, remove_benchmark_experiment)
+            finally:
+                remove_benchmark_experiment()
+            # The time the stubs themselves take with every core busy, so what is left over is the wrapper's own overhead
+            stub_seconds = number_of_energies * sum(stub_launch_seconds + stub_startup_seconds + stub_seconds_per_history * number_of_histories
+                                                    for number_of_histories in numbers_of_histories)
+            ideal_seconds = stub_seconds / cores
+            results.append(create_result("end_to_end", "stub_pipeline", size, timings, number_of_energies * number_of_histories_entries, "runs/s",
+                                         {"cores": cores,
+                                          "stub_launch_seconds": stub_launch_seconds,
+                                          "stub_seconds": stub_seconds,
+                                          "ideal_seconds": ideal_seconds,
+                                          "overhead_seconds": min(timings) - ideal_seconds}))
+    return results
+
+
+def describe_version() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], cwd=Path(__file__).parent,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def describe_machine() -> Dict:
+    return {"platform": platform.platform(),
+            "processor": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(),
+            "python": platform.python_version(),
+            "numpy": np.__version__}
+
+
+def write_results(results: List[BenchmarkResult], settings: Dict, label: str, results_folder: Path) -> Path:
+    results_folder.mkdir(parents=True, exist_ok=True)
+    results_filepath = results_folder / f"{label}.json"
+    results_filepath.write_text(json.dumps({"label": label,
+                                            "version": describe_version(),
+                                            "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                                            "machine": describe_machine(),
+                                            "settings": settings,
+                                            "results": [asdict(result) for result in results]}, indent=4))
+    return results_filepath
+
+
+def load_results(results_filepath: Path) -> Tuple[Dict, Dict[Tuple[str, str, str], BenchmarkResult]]:
+    if not Path(results_filepath).is_file():
+        raise FileNotFoundError(f"No benchmark results exist at location -> {results_filepath}")
+    document = json.loads(Path(results_filepath).read_text())
+    results = [BenchmarkResult(**result) for result in document["results"]]
+    return document, {result.key: result for result in results}
+
+
+def compare_results(baseline_filepath: Path, candidate_filepath: Path, tolerance: float=DEFAULT_COMPARISON_TOLERANCE) -> int:
+    # Compares best times, which are the least disturbed by other load on the machine. Returns the number of regressions.
+    baseline_document, baseline_results = load_results(baseline_filepath)
+    candidate_document, candidate_results = load_results(candidate_filepath)
+    print(f"Baseline  -> {baseline_document['label']} ({baseline_document['version']}, {baseline_document['created_at']})")
+    print(f"Candidate -> {candidate_document['label']} ({candidate_document['version']}, {candidate_document['created_at']})")
+    if baseline_document["machine"] != candidate_document["machine"]:
+        print("The results were measured on different machines or environments, so differences are not only the code's.")
+    number_of_regressions = 0
+    for key in list(baseline_results) + [key for key in candidate_results if key not in baseline_results]:
+        benchmark, case, size = key
+        if key not in baseline_results or key not in candidate_results:
+            print(f"{benchmark:>17} {case:<13} {size:<15} only in the {'candidate' if key in candidate_results else 'baseline'}")
+            continue
+        ratio = candidate_results[key].best_seconds / max(baseline_results[key].best_seconds, np.finfo(np.float64).tiny)
+        verdict = ""
+        if ratio > 1 + tolerance:
+            verdict = "slower"
+            number_of_regressions += 1
+        elif ratio < 1 / (1 + tolerance):
+            verdict = "faster"
+        print(f"{benchmark:>17} {case:<13} {size:<15} {baseline_results[key].best_seconds:10.4f} s -> "
+              f"{candidate_results[key].best_seconds:10.4f} s  {ratio:6.2f}x {verdict}")
+    print(f"{number_of_regressions} benchmarks slower by more than {tolerance:.0%}.")
+    return number_of_regressions
+
+
+def run_benchmarks(benchmark_names: List[str], grid_names: List[str], number_of_repeats: int,
+                   stub_startup_seconds: float, stub_seconds_per_history: float) -> List[BenchmarkResult]:
+    results = []
+    with tempfile.TemporaryDirectory() as synthetic_folder:
+        for benchmark_name in benchmark_names:
+            if benchmark_name == "script_generation":
+                results += benchmark_script_generation(number_of_repeats)
+            elif benchmark_name == "parsing":
+                results += benchmark_parsing(grid_names, Path(synthetic_folder), number_of_repeats)
+            elif benchmark_name == "slicing":
+                results += benchmark_slicing(grid_names, Path(synthetic_folder), number_of_repeats)
+            elif benchmark_name == "peak_extraction":
+                results += benchmark_peak_extraction(number_of_repeats)
+            else:
+                results += benchmark_end_to_end(number_of_repeats, stub_startup_seconds, stub_seconds_per_history)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time script generation, output parsing, slicing, peak extraction and stub sweeps, "
+                                                 "and compare the stored results of two versions.")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="Run the benchmarks and store their results (default).")
+    run_parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARK_NAMES, default=BENCHMARK_NAMES)
+    run_parser.add_argument("--grids", nargs="+", choices=list(GRID_SHAPES), default=list(GRID_SHAPES),
+                            help="Scorer grids used by the parsing and slicing benchmarks.")
+    run_parser.add_argument("--repeats", type=int, default=DEFAULT_NUMBER_OF_REPEATS, help="Timed repeats of each case, the best is kept.")
+    run_parser.add_argument("--label", default=None, help="Name of the results file, defaults to the git version.")
+    run_parser.add_argument("--results-folder", type=Path, default=RESULTS_FOLDER)
+    run_parser.add_argument("--stub-startup-seconds", type=float, default=DEFAULT_STUB_STARTUP_SECONDS)
+    run_parser.add_argument("--stub-seconds-per-history", type=float, default=DEFAULT_STUB_SECONDS_PER_HISTORY)
+    compare_parser = subparsers.add_parser("compare", help="Compare two stored results files.")
+    compare_parser.add_argument("baseline", type=Path)
+    compare_parser.add_argument("candidate", type=Path)
+    compare_parser.add_argument("--tolerance", type=float, default=DEFAULT_COMPARISON_TOLERANCE,
+                                help="Relative slowdown tolerated before a benchmark counts as a regression.")
+    arguments = parser.parse_args()
+    if arguments.command == "compare":
+        sys.exit(1 if compare_results(arguments.baseline, arguments.candidate, arguments.tolerance) else 0)
+    benchmark_names = getattr(arguments, "benchmarks", BENCHMARK_NAMES)
+    grid_names = getattr(arguments, "grids", list(GRID_SHAPES))
+    number_of_repeats = getattr(arguments, "repeats", DEFAULT_NUMBER_OF_REPEATS)
+    stub_startup_seconds = getattr(arguments, "stub_startup_seconds", DEFAULT_STUB_STARTUP_SECONDS)
+    stub_seconds_per_history = getattr(arguments, "stub_seconds_per_history", DEFAULT_STUB_SECONDS_PER_HISTORY)
+    results = run_benchmarks(benchmark_names, grid_names, number_of_repeats, stub_startup_seconds, stub_seconds_per_history)
+    label = getattr(arguments, "label", None) or describe_version() or "unversioned"
+    results_filepath = write_results(results, {"repeats": number_of_repeats,
+                                               "stub_startup_seconds": stub_startup_seconds,
+                                               "stub_seconds_per_history": stub_seconds_per_history},
+                                     label, getattr(arguments, "results_folder", RESULTS_FOLDER))
+    print(f"Benchmark results written -> {results_filepath}")
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+# Stands in for the topas executable, so the wrapper can be run and timed on any machine without Geant4.
+# It reads a parameter file as TOPAS would, including its includeFiles, sleeps for a start-up time plus
+# a time per history shared over Ts/NumberOfThreads, printing TOPAS style progress as it goes, then writes
+# a synthetic scorer output with the file's binning, beam energy, histories and seed to its OutputFile.
+#
+#   STUB_TOPAS_STARTUP_SECONDS        Geometry and physics initialisation time (default 1.0)
+#   STUB_TOPAS_SECONDS_PER_HISTORY    Time per history on one thread (default 0.0001)
+#   STUB_TOPAS_HANG_SECONDS           Time to hang for after start-up, as a stuck run would (default 0)
+#   STUB_TOPAS_EXIT_CODE              Exit code to crash with before writing any output (default 0)
+#   STUB_TOPAS_FAULT_PATTERN          Regular expression a parameter filename must match for the hang and
+#                                     exit code to apply, such as "run_3\.txt$" (default every file)
+#
+# Put it on PATH as topas, or pass its path as the TOPAS executable.
+import os
+import re
+import sys
+import time
+from pathlib import Path
+from topas_wrapper.script_reader import read_script_lines, read_parameter_value, read_output_filepath, PARAMETER_PATTERN
+from synthetic_outputs import write_synthetic_scorer_output
+
+DEFAULT_STARTUP_SECONDS = 1.0
+DEFAULT_SECONDS_PER_HISTORY = 1e-4
+NUMBER_OF_PROGRESS_LINES = 10
+DEFAULT_BEAM_ENERGY = 100.0
+
+
+def read_source_parameter(script_lines, parameter_suffix: str):
+    # The particle source component is named by the user, so its parameters are found by their suffix
+    value = None
+    for line in script_lines:
+        match = PARAMETER_PATTERN.match(line.strip())
+        if match is not None and match.group("name").startswith("So/") and match.group("name").endswith(parameter_suffix):
+            value = match.group("value")
+    return value
+
+
+def read_number_of_bins(script_lines, axis_name: str) -> int:
+    value = read_parameter_value(script_lines, f"Sc/Scorer/{axis_name}Bins")
+    return 1 if value is None else int(value)
+
+
+def main():
+    if len(sys.argv) != 2:
+        print("Usage: stub_topas.py <parameter file>")
+        sys.exit(1)
+    script_path = Path(sys.argv[1]).resolve()
+    script_lines = read_script_lines(script_path)
+    output_filepath = read_output_filepath(script_lines)
+    number_of_histories = int(read_source_parameter(script_lines, "/NumberOfHistoriesInRun") or 0)
+    beam_energy = float((read_source_parameter(script_lines, "/BeamEnergy") or str(DEFAULT_BEAM_ENERGY)).split()[0])
+    seed = read_parameter_value(script_lines, "Ts/Seed")
+    number_of_threads = int(read_parameter_value(script_lines, "Ts/NumberOfThreads") or 1)
+    output_type = (read_parameter_value(script_lines, "Sc/Scorer/OutputType") or '"csv"').strip('"').lower()
+    shape = tuple(read_number_of_bins(script_lines, axis_name) for axis_name in "XYZ")
+
+    startup_seconds = float(os.environ.get("STUB_TOPAS_STARTUP_SECONDS", DEFAULT_STARTUP_SECONDS))
+    seconds_per_history = float(os.environ.get("STUB_TOPAS_SECONDS_PER_HISTORY", DEFAULT_SECONDS_PER_HISTORY))
+    run_seconds = seconds_per_history * number_of_histories / max(number_of_threads, 1)
+    print(f"Stub TOPAS reading parameter file -> {script_path}", flush=True)
+    time.sleep(startup_seconds)
+    if re.search(os.environ.get("STUB_TOPAS_FAULT_PATTERN", ""), script_path.name) is not None:
+        time.sleep(float(os.environ.get("STUB_TOPAS_HANG_SECONDS", 0)))
+        exit_code = int(os.environ.get("STUB_TOPAS_EXIT_CODE", 0))
+        if exit_code != 0:
+            print(f"Stub TOPAS crashed with exit code {exit_code} -> {script_path}", flush=True)
+            sys.exit(exit_code)
+    for progress_index in range(NUMBER_OF_PROGRESS_LINES):
+        print(f"G4WT0 > --> Event {progress_index * number_of_histories // NUMBER_OF_PROGRESS_LINES} starts.", flush=True)
+        time.sleep(run_seconds / NUMBER_OF_PROGRESS_LINES)
+    write_synthetic_scorer_output(output_filepath, shape, beam_energy, number_of_histories,
+                                  seed=None if seed is None else int(seed),
+                                  binary=output_type == "binary")
+    print(f"Stub TOPAS wrote {'x'.join(str(bins) for bins in shape)} bins -> {output_filepath}", flush=True)
+
+if __name__=="__main__":
+    main()
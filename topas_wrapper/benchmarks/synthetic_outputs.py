@@ -0,0 +1,93 @@
+import math
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from topas_wrapper.scorer_output import ScorerOutput, parse_scorer_header, write_scorer_output
+
+# Scorer grids the benchmarks are run at, from a single depth profile up to the full scintillator voxelisation
+GRID_SHAPES = {"depth_1d": (1, 1, 500),
+               "lateral_2d": (78, 1, 500),
+               "volume_3d": (78, 198, 500)}
+# Full widths of the scintillator in EXPERIMENT_GEOMETRY.txt, split evenly over the bins of each axis
+SCORER_EXTENTS_CM = (3.9, 9.9, 25.0)
+STATISTIC_NAMES = ["Sum", "Mean", "Standard_Deviation"]
+# Bragg-Kleeman range of protons in water, R = alpha * E^p, with range straggling of about 1.2% of R
+RANGE_ALPHA_CM = 0.0022
+RANGE_EXPONENT = 1.77
+RANGE_STRAGGLING_FRACTION = 0.012
+LATERAL_SPREAD_CM = 0.5
+
+
+def create_header_lines(shape: Tuple[int, int, int], quantity: str="EnergyDeposit", unit: str="MeV") -> List[str]:
+    # The same header TOPAS writes above a CSV or into a .binheader
+    header_lines = ["# TOPAS Version: synthetic",
+                    "# Results for scorer: Scorer",
+                    "# Scored in component: Scintillator"]
+    for axis_name, number_of_bins, extent in zip("XYZ", shape, SCORER_EXTENTS_CM):
+        bin_label = "bin " if number_of_bins == 1 else "bins"
+        header_lines.append(f"# {axis_name} in {number_of_bins} {bin_label} of {extent / number_of_bins:.6g} cm")
+    header_lines.append(f"# {quantity} ( {unit} ) : {'   '.join(STATISTIC_NAMES)}")
+    return header_lines
+
+
+def compute_bin_centres(number_of_bins: int, extent: float) -> np.ndarray:
+    return (np.arange(number_of_bins) + 0.5) * extent / number_of_bins
+
+
+def create_depth_dose_curve(depths: np.ndarray, beam_energy: float) -> np.ndarray:
+    # Stopping power rises as (R - z)^(1/p - 1) towards the end of range, smeared by straggling into a finite peak
+    projected_range = RANGE_ALPHA_CM * beam_energy**RANGE_EXPONENT
+    straggling = RANGE_STRAGGLING_FRACTION * projected_range
+    residual_ranges = np.clip(projected_range - depths, straggling, None)
+    falloff = np.array([0.5 * math.erfc((depth - projected_range) / (math.sqrt(2) * straggling)) for depth in depths])
+    return residual_ranges**(1 / RANGE_EXPONENT - 1) * falloff
+
+
+def create_lateral_profile(number_of_bins: int, extent: float) -> np.ndarray:
+    if number_of_bins == 1:
+        return np.ones(1)
+    positions = compute_bin_centres(number_of_bins, extent) - extent / 2
+    return np.exp(-0.5 * (positions / LATERAL_SPREAD_CM)**2)
+
+
+def create_synthetic_statistics(shape: Tuple[int, int, int], beam_energy: float, number_of_histories: int,
+                                rng: np.random.Generator) -> Dict[str, np.ndarray]:
+    # Each history deposits about its beam energy, spread as a Gaussian beam times a Bragg curve. The spread
+    # of a voxel over histories is taken as its mean, so the noise of the mean falls as one over root N.
+    x_profile = create_lateral_profile(shape[0], SCORER_EXTENTS_CM[0])
+    y_profile = create_lateral_profile(shape[1], SCORER_EXTENTS_CM[1])
+    depth_dose_curve = create_depth_dose_curve(compute_bin_centres(shape[2], SCORER_EXTENTS_CM[2]), beam_energy)
+    expected_means = np.einsum("i,j,k->ijk", x_profile, y_profile, depth_dose_curve)
+    # A beam that stops before the first bin centre leaves every voxel empty
+    if expected_means.sum() > 0:
+        expected_means *= beam_energy / expected_means.sum()
+    relative_error = 1 / math.sqrt(max(number_of_histories, 1))
+    means = expected_means * np.clip(1 + relative_error * rng.standard_normal(shape), 0, None)
+    return {"Sum": means * number_of_histories,
+            "Mean": means,
+            "Standard_Deviation": expected_means}
+
+
+def create_synthetic_scorer_output(shape: Tuple[int, int, int], beam_energy: float, number_of_histories: int,
+                                   seed: Optional[int]=None) -> ScorerOutput:
+    header = parse_scorer_header(create_header_lines(shape))
+    statistics = create_synthetic_statistics(shape, beam_energy, number_of_histories, np.random.default_rng(seed))
+    return ScorerOutput(header, statistics, Path("synthetic"))
+
+
+def write_synthetic_scorer_output(output_filepath: Path, shape: Tuple[int, int, int], beam_energy: float, number_of_histories: int,
+                                  seed: Optional[int]=None, binary: bool=False) -> Path:
+    # output_filepath has no extension, like the OutputFile of a TOPAS scorer
+    scorer_output = create_synthetic_scorer_output(shape, beam_energy, number_of_histories, seed)
+    return write_scorer_output(scorer_output, output_filepath, binary=binary)
+
+
+def create_depth_dose_profiles(number_of_profiles: int, number_of_bins: int=GRID_SHAPES["depth_1d"][2],
+                               seed: Optional[int]=None) -> Tuple[np.ndarray, np.ndarray]:
+    # Stacked noisy depth profiles over the clinical energy range, for timing peak extraction on its own
+    rng = np.random.default_rng(seed)
+    depths = compute_bin_centres(number_of_bins, SCORER_EXTENTS_CM[2])
+    beam_energies = np.linspace(70, 170, number_of_profiles)
+    profiles = np.stack([create_depth_dose_curve(depths, beam_energy) for beam_energy in beam_energies])
+    profiles *= np.clip(1 + 0.01 * rng.standard_normal(profiles.shape), 0, None)
+    return profiles, depths
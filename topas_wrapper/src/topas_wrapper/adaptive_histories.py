@@ -0,0 +1,200 @@
+import math
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import List, Optional
+import numpy as np
+from topas_wrapper.get_data import load_experiment_parameters, ExperimentParameters, AdaptiveHistories
+from topas_wrapper.input_constants import ConvergenceMetric
+from topas_wrapper.script_generator import generate_scripts
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+from topas_wrapper.scorer_output import load_scorer_output, merge_scorer_outputs, write_scorer_output
+from topas_wrapper.create_file_structure import create_run_name
+from topas_wrapper.sharding import derive_seed, generate_shard_script
+from topas_wrapper.analysis import compute_depth_profile, compute_depth_bin_centres, find_bragg_peak_depths, compute_integrated_deposits
+from topas_wrapper.result_cache import ResultCache
+from topas_wrapper.telemetry import TelemetryLedger
+from topas_wrapper.run_simulations import (SimulationJob,
+                                           iterate_simulations,
+                                           report_simulation_result,
+                                           TOPAS_EXECUTABLE)
+
+SUMMARY_FILENAME = "adaptive_histories_summary.csv"
+
+
+@dataclass
+class AdaptiveRun:
+    beam_energy: float
+    script_path: Path
+    output_filepath: Path
+    batch_output_filepaths: List[Path] = field(default_factory=list)
+    batch_metrics: List[float] = field(default_factory=list)
+    converged: bool = False
+    failed: bool = False
+    merged_output_filepath: Optional[Path] = None
+
+    @property
+    def number_of_batches(self) -> int:
+        return len(self.batch_metrics)
+
+    @property
+    def estimate(self) -> float:
+        return float(np.mean(self.batch_metrics)) if self.batch_metrics else math.nan
+
+    @property
+    def standard_error(self) -> float:
+        if self.number_of_batches < 2:
+            return math.inf
+        return float(np.std(self.batch_metrics, ddof=1) / math.sqrt(self.number_of_batches))
+
+    @property
+    def relative_uncertainty(self) -> float:
+        standard_error = self.standard_error
+        if standard_error == 0:
+            return 0.0
+        estimate = abs(self.estimate)
+        return standard_error / estimate if estimate > 0 else math.inf
+
+
+def compute_batch_metric(output_filepath: Path, target_metric: ConvergenceMetric, batch_number_of_histories: int) -> float:
+    scorer_output = load_scorer_output(output_filepath, use_sidecar=False)
+    profile = compute_depth_profile(scorer_output)
+    if target_metric == ConvergenceMetric.bragg_peak_depth:
+        return float(find_bragg_peak_depths(profile, compute_depth_bin_centres(scorer_output))[0])
+    return float(compute_integrated_deposits(profile)[0]) / batch_number_of_histories
+
+
+def plan_number_of_new_batches(adaptive_run: AdaptiveRun, settings: AdaptiveHistories) -> int:
+    # Batches needed to reach the tolerance scale with the square of the current relative uncertainty;
+    # growth is capped at doubling per round so one noisy estimate cannot commit the whole budget
+    if adaptive_run.converged or adaptive_run.failed:
+        return 0
+    maximum_number_of_batches = settings.maximum_number_of_histories // settings.batch_number_of_histories
+    remaining_batches = maximum_number_of_batches - adaptive_run.number_of_batches
+    if remaining_batches <= 0:
+        return 0
+    if adaptive_run.number_of_batches < settings.minimum_number_of_batches:
+        return min(settings.minimum_number_of_batches - adaptive_run.number_of_batches, remaining_batches)
+    relative_uncertainty = adaptive_run.relative_uncertainty
+    if math.isinf(relative_uncertainty):
+        required_batches = 2 * adaptive_run.number_of_batches
+    else:
+        required_batches = math.ceil(adaptive_run.number_of_batches * (relative_uncertainty / settings.relative_tolerance) ** 2)
+    number_of_new_batches = min(max(required_batches - adaptive_run.number_of_batches, 1), adaptive_run.number_of_batches)
+    return min(number_of_new_batches, remaining_batches)
+
+
+def write_batch_script(adaptive_run: AdaptiveRun, batch_index: int, experiment_parameters: ExperimentParameters) -> Path:
+    settings = experiment_parameters.adaptive_histories
+    batch_name = f"{adaptive_run.script_path.stem}_batch_{batch_index}"
+    batch_output_filepath = adaptive_run.output_filepath.parent / f"{adaptive_run.output_filepath.name}_batch_{batch_index}"
+    batch_seed = derive_seed(experiment_parameters.seed_number, adaptive_run.script_path.stem, "batch", batch_index)
+    batch_script = generate_shard_script(adaptive_run.script_path.name,
+                                         experiment_parameters.particle_source.component,
+                                         batch_seed,
+                                         settings.batch_number_of_histories,
+                                         batch_output_filepath)
+    batch_script_path = adaptive_run.script_path.parent / f"{batch_name}{adaptive_run.script_path.suffix}"
+    batch_script_path.write_text("".join(f"{line}\n" for line in batch_script))
+    return batch_script_path
+
+
+def merge_adaptive_run(adaptive_run: AdaptiveRun, experiment_parameters: ExperimentParameters) -> Path:
+    settings = experiment_parameters.adaptive_histories
+    particle_source = experiment_parameters.particle_source
+    batch_outputs = [load_scorer_output(output_filepath, use_sidecar=False) for output_filepath in adaptive_run.batch_output_filepaths]
+    merged_output = merge_scorer_outputs(batch_outputs, [settings.batch_number_of_histories] * len(batch_outputs))
+    total_number_of_histories = settings.batch_number_of_histories * len(batch_outputs)
+    merged_output_filepath = adaptive_run.output_filepath.parent / create_run_name(adaptive_run.beam_energy,
+                                                                                 particle_source.beam_energy_unit,
+                                                                                 total_number_of_histories)
+    binary = batch_outputs[0].source_path.suffix == ".bin"
+    return write_scorer_output(merged_output, merged_output_filepath, binary=binary)
+
+
+def write_adaptive_summary(adaptive_runs: List[AdaptiveRun], experiment_parameters: ExperimentParameters, analysis_folder: Path) -> Path:
+    settings = experiment_parameters.adaptive_histories
+    summary_filepath = Path(analysis_folder) / SUMMARY_FILENAME
+    with summary_filepath.open("w") as f:
+        f.write("beam_energy,number_of_histories,number_of_batches,target_metric,estimate,standard_error,relative_uncertainty,converged,output_filepath\n")
+        for adaptive_run in adaptive_runs:
+            f.write(",".join(str(value) for value in (adaptive_run.beam_energy,
+                                                      adaptive_run.number_of_batches * settings.batch_number_of_histories,
+                                                      adaptive_run.number_of_batches,
+                                                      settings.target_metric.value,
+                                                      adaptive_run.estimate,
+                                                      adaptive_run.standard_error,
+                                                      adaptive_run.relative_uncertainty,
+                                                      adaptive_run.converged,
+                                                      adaptive_run.merged_output_filepath)) + "\n")
+    return summary_filepath
+
+
+def run_adaptive_experiment(experiment_parameters: ExperimentParameters,
+                            topas_executable: str=TOPAS_EXECUTABLE,
+                            result_cache: Optional[ResultCache]=None,
+                            telemetry_ledger: Optional[TelemetryLedger]=None) -> List[AdaptiveRun]:
+    # Each energy runs in rounds of seeded batches, all energies sharing the core budget within a round,
+    # until the batch-means standard error of the target metric meets the tolerance or the budget is spent
+    settings = experiment_parameters.adaptive_histories
+    if settings is None:
+        raise ValueError("The experiment parameters have no [adaptive_histories] section.")
+    batch_parameters = experiment_parameters.model_copy(update={"numbers_of_histories": [settings.batch_number_of_histories]})
+    script_paths = generate_scripts(batch_parameters)
+    adaptive_runs = [AdaptiveRun(beam_energy, script_path, read_output_filepath(read_script_lines(script_path)))
+                     for beam_energy, script_path in zip(experiment_parameters.particle_source.beam_energy, script_paths)]
+    telemetry_ledger = TelemetryLedger() if telemetry_ledger is None else telemetry_ledger
+    try:
+        while True:
+            adaptive_run_by_script = {}
+            round_runs = []
+            jobs = []
+            for adaptive_run in adaptive_runs:
+                number_of_new_batches = plan_number_of_new_batches(adaptive_run, settings)
+                if number_of_new_batches > 0:
+                    round_runs.append(adaptive_run)
+                for new_batch_index in range(number_of_new_batches):
+                    batch_index = adaptive_run.number_of_batches + new_batch_index
+                    batch_script_path = write_batch_script(adaptive_run, batch_index, experiment_parameters)
+                    adaptive_run_by_script[batch_script_path] = adaptive_run
+                    jobs.append(SimulationJob(batch_script_path, experiment_parameters.number_of_threads))
+            if not jobs:
+                break
+
+            for result in iterate_simulations(jobs, experiment_parameters.core_budget, topas_executable, result_cache=result_cache):
+                report_simulation_result(result)
+                telemetry_ledger.record(result, experiment_parameters)
+                adaptive_run = adaptive_run_by_script[result.job.script_path]
+                if not result.succeeded:
+                    adaptive_run.failed = True
+                    continue
+                batch_output_filepath = read_output_filepath(read_script_lines(result.job.script_path))
+                adaptive_run.batch_output_filepaths.append(batch_output_filepath)
+                adaptive_run.batch_metrics.append(compute_batch_metric(batch_output_filepath, settings.target_metric, settings.batch_number_of_histories))
+
+            for adaptive_run in round_runs:
+                if adaptive_run.number_of_batches >= settings.minimum_number_of_batches:
+                    adaptive_run.converged = adaptive_run.relative_uncertainty <= settings.relative_tolerance
+                print(f"{adaptive_run.beam_energy} {experiment_parameters.particle_source.beam_energy_unit.value}: "
+                      f"{adaptive_run.number_of_batches} batches, {settings.target_metric.value} = {adaptive_run.estimate:.6g} "
+                      f"+/- {adaptive_run.standard_error:.3g}{' (converged)' if adaptive_run.converged else ''}")
+    finally:
+        telemetry_ledger.close()
+
+    for adaptive_run in adaptive_runs:
+        if adaptive_run.failed:
+            print(f"Adaptive run at {adaptive_run.beam_energy} {experiment_parameters.particle_source.beam_energy_unit.value} stopped after a failed batch.")
+        if adaptive_run.batch_output_filepaths and not adaptive_run.failed:
+            adaptive_run.merged_output_filepath = merge_adaptive_run(adaptive_run, experiment_parameters)
+    analysis_folder = script_paths[0].parent.parent / "analysis"
+    summary_filepath = write_adaptive_summary(adaptive_runs, experiment_parameters, analysis_folder)
+    print(f"Adaptive histories summary written -> {summary_filepath}")
+    return adaptive_runs
+
+
+def main():
+    experiment_parameters = load_experiment_parameters()
+    result_cache = ResultCache() if experiment_parameters.use_result_cache else None
+    run_adaptive_experiment(experiment_parameters, result_cache=result_cache)
+
+if __name__=="__main__":
+    main()
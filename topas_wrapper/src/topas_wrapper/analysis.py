@@ -0,0 +1,192 @@
+from dataclasses import dataclass
+from itertools import product
+from pathlib import Path
+from typing import Dict, List, Tuple
+import numpy as np
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.create_file_structure import create_output_filepath
+from topas_wrapper.scorer_output import ScorerOutput, load_scorer_output
+
+DEPTH_AXIS = 2
+METRICS_TABLE_FILENAME = "bragg_peak_metrics.csv"
+SWEEP_POINT_METRICS_TABLE_FILENAME = "sweep_point_metrics.csv"
+METRICS_TABLE_DTYPE = np.dtype([("beam_energy", np.float64),
+                                ("number_of_histories", np.int64),
+                                ("bragg_peak_depth", np.float64),
+                                ("bragg_peak_value", np.float64),
+                                ("r90", np.float64),
+                                ("r80", np.float64),
+                                ("peak_width", np.float64)])
+
+
+@dataclass
+class SweepDepthProfiles:
+    beam_energies: np.ndarray
+    numbers_of_histories: np.ndarray
+    depths: np.ndarray
+    depth_unit: str
+    profiles: np.ndarray
+
+
+def compute_depth_profile(scorer_output: ScorerOutput, statistic_name: str="Sum") -> np.ndarray:
+    # Collapses the lateral bins so only the z (beam) axis remains
+    return np.asarray(scorer_output[statistic_name]).sum(axis=(0, 1))
+
+
+def compute_depth_bin_centres(scorer_output: ScorerOutput) -> np.ndarray:
+    return scorer_output.header.axes[DEPTH_AXIS].bin_centres
+
+
+def fit_parabolic_peaks(profiles: np.ndarray, depths: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    # Profiles are stacked along the first axis. The peak is refined to sub-bin precision with a
+    # parabola through the maximum bin and its neighbours, which falls back to the bin centre at the edges.
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    depths = np.asarray(depths, dtype=np.float64)
+    number_of_bins = profiles.shape[1]
+    rows = np.arange(profiles.shape[0])
+    peak_indices = np.argmax(profiles, axis=1)
+    if number_of_bins < 3:
+        return depths[peak_indices], profiles[rows, peak_indices]
+    inner_indices = np.clip(peak_indices, 1, number_of_bins - 2)
+    left = profiles[rows, inner_indices - 1]
+    centre = profiles[rows, inner_indices]
+    right = profiles[rows, inner_indices + 1]
+    curvature = left - 2 * centre + right
+    at_edge = peak_indices != inner_indices
+    fit_valid = (curvature < 0) & ~at_edge
+    with np.errstate(divide="ignore", invalid="ignore"):
+        offsets = np.where(fit_valid, np.clip(0.5 * (left - right) / curvature, -0.5, 0.5), 0.0)
+    peak_values = np.where(fit_valid, centre - 0.25 * (left - right) * offsets, profiles[rows, peak_indices])
+    bin_width = depths[1] - depths[0]
+    return depths[peak_indices] + offsets * bin_width, peak_values
+
+
+def find_bragg_peak_depths(profiles: np.ndarray, depths: np.ndarray) -> np.ndarray:
+    return fit_parabolic_peaks(profiles, depths)[0]
+
+
+def find_level_crossings(profiles: np.ndarray, depths: np.ndarray, levels: np.ndarray, distal: bool=True) -> np.ndarray:
+    # Depth at which each profile falls through its level on the distal (or proximal) side of the
+    # maximum, linearly interpolated between the two bins either side. NaN where it never crosses.
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    depths = np.asarray(depths, dtype=np.float64)
+    if not distal:
+        return find_level_crossings(profiles[:, ::-1], depths[::-1], levels, distal=True)
+    rows = np.arange(profiles.shape[0])
+    bin_indices = np.arange(profiles.shape[1])
+    peak_indices = np.argmax(profiles, axis=1)
+    below_level = (profiles < levels[:, None]) & (bin_indices[None, :] > peak_indices[:, None])
+    crosses = below_level.any(axis=1)
+    after_indices = np.argmax(below_level, axis=1)
+    before_indices = np.maximum(after_indices - 1, 0)
+    before_values = profiles[rows, before_indices]
+    after_values = profiles[rows, after_indices]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        fractions = np.clip((before_values - levels) / (before_values - after_values), 0.0, 1.0)
+    crossings = depths[before_indices] + fractions * (depths[after_indices] - depths[before_indices])
+    return np.where(crosses, crossings, np.nan)
+
+
+def compute_bragg_peak_metrics(profiles: np.ndarray, depths: np.ndarray) -> Dict[str, np.ndarray]:
+    # R90 and R80 are the distal depths where the dose falls to 90% and 80% of the fitted peak;
+    # the peak width is the full width at half of the fitted peak
+    profiles = np.atleast_2d(np.asarray(profiles, dtype=np.float64))
+    peak_depths, peak_values = fit_parabolic_peaks(profiles, depths)
+    r90 = find_level_crossings(profiles, depths, 0.9 * peak_values)
+    r80 = find_level_crossings(profiles, depths, 0.8 * peak_values)
+    distal_half_maximum = find_level_crossings(profiles, depths, 0.5 * peak_values)
+    proximal_half_maximum = find_level_crossings(profiles, depths, 0.5 * peak_values, distal=False)
+    return {"bragg_peak_depth": peak_depths,
+            "bragg_peak_value": peak_values,
+            "r90": r90,
+            "r80": r80,
+            "peak_width": distal_half_maximum - proximal_half_maximum}
+
+
+def compute_integrated_deposits(profiles: np.ndarray) -> np.ndarray:
+    return np.atleast_2d(np.asarray(profiles, dtype=np.float64)).sum(axis=1)
+
+
+def load_sweep_depth_profiles(experiment_parameters: ExperimentParameters, data_folder: Path, statistic_name: str="Sum") -> SweepDepthProfiles:
+    # Stacks the z-profile of every (beam_energy, number_of_histories) run in the sweep that has output
+    particle_source = experiment_parameters.particle_source
+    beam_energies = []
+    numbers_of_histories = []
+    profiles = []
+    depths = None
+    depth_unit = None
+    for beam_energy, number_of_histories in product(particle_source.beam_energy, experiment_parameters.numbers_of_histories):
+        output_filepath = create_output_filepath(Path(data_folder), beam_energy, particle_source.beam_energy_unit, number_of_histories)
+        try:
+            scorer_output = load_scorer_output(output_filepath)
+        except FileNotFoundError:
+            print(f"No output for {beam_energy} {particle_source.beam_energy_unit.value} with {number_of_histories} histories, skipping it.")
+            continue
+        run_depths = compute_depth_bin_centres(scorer_output)
+        if depths is None:
+            depths = run_depths
+            depth_unit = scorer_output.header.axes[DEPTH_AXIS].unit
+        elif not np.array_equal(depths, run_depths):
+            raise ValueError(f"The depth binning of {scorer_output.source_path} differs from the rest of the sweep.")
+        beam_energies.append(beam_energy)
+        numbers_of_histories.append(number_of_histories)
+        profiles.append(compute_depth_profile(scorer_output, statistic_name))
+    if depths is None:
+        raise FileNotFoundError(f"No scorer output for this sweep exists at location -> {data_folder}.")
+    return SweepDepthProfiles(np.asarray(beam_energies, dtype=np.float64),
+                              np.asarray(numbers_of_histories, dtype=np.int64),
+                              depths,
+                              depth_unit,
+                              np.vstack(profiles))
+
+
+def tabulate_bragg_peak_metrics(sweep_depth_profiles: SweepDepthProfiles) -> np.ndarray:
+    # One row per run, sorted by (beam_energy, number_of_histories)
+    metrics = compute_bragg_peak_metrics(sweep_depth_profiles.profiles, sweep_depth_profiles.depths)
+    table = np.empty(len(sweep_depth_profiles.beam_energies), dtype=METRICS_TABLE_DTYPE)
+    table["beam_energy"] = sweep_depth_profiles.beam_energies
+    table["number_of_histories"] = sweep_depth_profiles.numbers_of_histories
+    for metric_name, values in metrics.items():
+        table[metric_name] = values
+    return np.sort(table, order=["beam_energy", "number_of_histories"])
+
+
+def write_metrics_table(table: np.ndarray, analysis_folder: Path, filename: str=METRICS_TABLE_FILENAME) -> Path:
+    metrics_table_filepath = Path(analysis_folder) / filename
+    row_format = ",".join("%d" if table.dtype[name].kind == "i" else "%.10g" for name in table.dtype.names)
+    np.savetxt(metrics_table_filepath, table, fmt=row_format, delimiter=",", header=",".join(table.dtype.names), comments="")
+    return metrics_table_filepath
+
+
+def write_sweep_point_metrics_table(run_names: List[str], rows: List[np.ndarray], analysis_folder: Path,
+                                    filename: str=SWEEP_POINT_METRICS_TABLE_FILENAME) -> Path:
+    # Sweep points can share a beam energy and number of histories, so their rows are keyed by run name
+    # to join against sweep_points.csv
+    metrics_table_filepath = Path(analysis_folder) / filename
+    order = sorted(range(len(run_names)), key=lambda i: run_names[i])
+    with metrics_table_filepath.open("w") as f:
+        f.write(",".join(("run_name",) + METRICS_TABLE_DTYPE.names) + "\n")
+        for i in order:
+            f.write(",".join([run_names[i]] + [str(rows[i][name]) if METRICS_TABLE_DTYPE[name].kind == "i" else f"{rows[i][name]:.10g}"
+                                               for name in METRICS_TABLE_DTYPE.names]) + "\n")
+    return metrics_table_filepath
+
+
+def analyse_sweep(experiment_parameters: ExperimentParameters, data_folder: Path, analysis_folder: Path) -> np.ndarray:
+    sweep_depth_profiles = load_sweep_depth_profiles(experiment_parameters, data_folder)
+    table = tabulate_bragg_peak_metrics(sweep_depth_profiles)
+    metrics_table_filepath = write_metrics_table(table, analysis_folder)
+    print(f"Bragg peak metrics written -> {metrics_table_filepath} (depths in {sweep_depth_profiles.depth_unit})")
+    return table
+
+
+def analyse_run_output(output_filepath: Path, beam_energy: float, number_of_histories: int, statistic_name: str="Sum") -> Tuple[np.ndarray, str]:
+    # The metrics row of a single run, so runs can be analysed one by one as they finish
+    scorer_output = load_scorer_output(output_filepath)
+    metrics = compute_bragg_peak_metrics(compute_depth_profile(scorer_output, statistic_name), compute_depth_bin_centres(scorer_output))
+    row = np.zeros((), dtype=METRICS_TABLE_DTYPE)
+    row["beam_energy"] = beam_energy
+    row["number_of_histories"] = number_of_histories
+    for metric_name, values in metrics.items():
+        row[metric_name] = values[0]
+    return row, scorer_output.header.axes[DEPTH_AXIS].unit
@@ -4,14 +4,17 @@ from topas_wrapper.input_constants import EnergyUnit
 
 EXPERIMENTS_FOLDER_LOCATION = "../../experiments"
 
-def create_file_structure(experiment_name: str, relative_filepath: str, overwrite: bool=False):
+def create_file_structure(experiment_name: str, relative_filepath: str, overwrite: bool=False, incremental: bool=False):
+    # An incremental regeneration keeps the existing folders, and with them every run's scripts and data
     mod_path = Path(__file__).parent
     experiment_folder = (mod_path / relative_filepath / experiment_name).resolve()
-    if experiment_folder.exists() and not overwrite:
+    if experiment_folder.exists() and not overwrite and not incremental:
         raise FileExistsError("An experiment with this name already exists. Rename experiment or set overwrite parameter to true.") #TODO allow UI here for overwriting
     if experiment_folder.exists() and not experiment_folder.is_dir():
         raise FileExistsError(f"You have an unexpected file with the experiment name -> {experiment_name} at location -> {experiment_folder}. \nPlease remove it.")
-    if experiment_folder.exists():
+    if experiment_folder.exists() and incremental:
+        print(f"Updating -> {experiment_folder}")
+    elif experiment_folder.exists():
         print(f"Overwriting -> {experiment_folder}")
         shutil.rmtree(experiment_folder)
 
@@ -19,22 +22,38 @@ def create_file_structure(experiment_name: str, relative_filepath: str, overwrit
     data_folder = (experiment_folder / "data").resolve()
     analysis_folder = (experiment_folder / "analysis").resolve()
 
-    scripts_folder.mkdir(parents=True, exist_ok=False)
-    data_folder.mkdir(exist_ok=False)
-    analysis_folder.mkdir(exist_ok=False)
+    scripts_folder.mkdir(parents=True, exist_ok=incremental)
+    data_folder.mkdir(exist_ok=incremental)
+    analysis_folder.mkdir(exist_ok=incremental)
     return scripts_folder, data_folder, analysis_folder
 
 
-def create_filename(beam_energy: float, beam_energy_units: EnergyUnit, number_of_histories: int):
+def locate_experiment_folder(experiment_name: str, relative_filepath: str) -> Path:
+    mod_path = Path(__file__).parent
+    experiment_folder = (mod_path / relative_filepath / experiment_name).resolve()
+    if not experiment_folder.is_dir():
+        raise FileNotFoundError(f"No experiment named -> {experiment_name} exists at location -> {experiment_folder}.")
+    return experiment_folder
+
+
+def create_run_name(beam_energy: float, beam_energy_units: EnergyUnit, number_of_histories: int):
     beam_energy_string = f"{beam_energy:.2f}"
     beam_energy_string = beam_energy_string.replace('.', 'p')
-    filename = f"beam_energy_{beam_energy_string}_{beam_energy_units.value}_number_of_histories_{number_of_histories}.txt"
+    run_name = f"beam_energy_{beam_energy_string}_{beam_energy_units.value}_number_of_histories_{number_of_histories}"
+    return run_name
+
+
+def create_filename(beam_energy: float, beam_energy_units: EnergyUnit, number_of_histories: int):
+    filename = f"{create_run_name(beam_energy, beam_energy_units, number_of_histories)}.txt"
     return filename
 
 
+def create_sweep_run_name(sweep_point_index: int) -> str:
+    # A sweep point can vary more than the energy and histories, so it is named by its row in sweep_points.csv
+    return f"sweep_point_{sweep_point_index:06d}"
+
+
 def create_output_filepath(data_folder: str, beam_energy: float, beam_energy_units: EnergyUnit, number_of_histories: int):
-    beam_energy_string = f"{beam_energy:.2f}"
-    beam_energy_string = beam_energy_string.replace('.', 'p')
-    filename = f"beam_energy_{beam_energy_string}_{beam_energy_units.value}_number_of_histories_{number_of_histories}"
+    filename = create_run_name(beam_energy, beam_energy_units, number_of_histories)
     output_filepath = (data_folder / filename).resolve()
     return output_filepath
\ No newline at end of file
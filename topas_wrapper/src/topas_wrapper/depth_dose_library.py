@@ -0,0 +1,265 @@
+import argparse
+from collections import defaultdict
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+import numpy as np
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.analysis import compute_depth_profile, compute_depth_bin_centres, compute_bragg_peak_metrics, DEPTH_AXIS
+from topas_wrapper.scorer_output import load_scorer_output
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+from topas_wrapper.script_generator import EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME
+from topas_wrapper.results_store import list_run_scripts, read_run_metadata
+from topas_wrapper.create_file_structure import locate_experiment_folder
+from topas_wrapper.file_structure import FileStructure
+from topas_wrapper.input_constants import SweepParameter
+
+DEPTH_DOSE_LIBRARY_FILENAME = "depth_dose_library.npz"
+DEFAULT_QUERY_CHUNK_SIZE = 4096
+MINIMUM_NUMBER_OF_ENERGIES = 2
+# Ranges are the distal 80% depths, which are less sensitive to the energy spread than the peak
+RANGE_LEVEL_METRIC = "r80"
+
+
+@dataclass
+class DepthDoseQuery:
+    beam_energies: np.ndarray
+    depths: np.ndarray
+    curves: np.ndarray
+    peak_doses: np.ndarray
+    ranges: np.ndarray
+    error_estimates: np.ndarray
+
+    @property
+    def doses(self) -> np.ndarray:
+        # Dose per history, where curves are normalised to a peak of one
+        return self.curves * self.peak_doses[:, None]
+
+
+def sample_curves(curves: np.ndarray, curve_indices: np.ndarray, positions: np.ndarray, depths: np.ndarray) -> np.ndarray:
+    # Linear interpolation of curves[curve_indices[m]] at positions[m], held flat before the first
+    # bin centre and falling to zero one bin spacing past the last one, which is the zero column padded on
+    number_of_bins = curves.shape[1]
+    padded_curves = np.concatenate([curves, np.zeros((len(curves), 1))], axis=1)
+    fractional_indices = (positions - depths[0]) / (depths[1] - depths[0])
+    lower_indices = np.floor(fractional_indices)
+    fractions = fractional_indices - lower_indices
+    lower_indices = np.clip(lower_indices, 0, number_of_bins).astype(np.int64)
+    upper_indices = np.clip(lower_indices + 1, 0, number_of_bins)
+    upper_indices = np.where(fractional_indices < 0, 0, upper_indices)
+    rows = curve_indices[:, None]
+    return (1 - fractions) * padded_curves[rows, lower_indices] + fractions * padded_curves[rows, upper_indices]
+
+
+def interpolate_depth_dose(node_energies: np.ndarray, node_curves: np.ndarray, node_ranges: np.ndarray, node_peak_doses: np.ndarray,
+                           depths: np.ndarray, beam_energies: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    # The range follows a power law in energy between neighbouring nodes. Each neighbour's curve is stretched
+    # in depth so its range lands on the interpolated one, and the two are blended linearly in energy.
+    lower_nodes = np.clip(np.searchsorted(node_energies, beam_energies, side="right") - 1, 0, len(node_energies) - 2)
+    upper_nodes = lower_nodes + 1
+    weights = (beam_energies - node_energies[lower_nodes]) / (node_energies[upper_nodes] - node_energies[lower_nodes])
+    log_weights = np.log(beam_energies / node_energies[lower_nodes]) / np.log(node_energies[upper_nodes] / node_energies[lower_nodes])
+    ranges = node_ranges[lower_nodes] * (node_ranges[upper_nodes] / node_ranges[lower_nodes]) ** log_weights
+    lower_curves = sample_curves(node_curves, lower_nodes, depths[None, :] * (node_ranges[lower_nodes] / ranges)[:, None], depths)
+    upper_curves = sample_curves(node_curves, upper_nodes, depths[None, :] * (node_ranges[upper_nodes] / ranges)[:, None], depths)
+    curves = (1 - weights)[:, None] * lower_curves + weights[:, None] * upper_curves
+    peak_doses = (1 - weights) * node_peak_doses[lower_nodes] + weights * node_peak_doses[upper_nodes]
+    return curves, ranges, peak_doses, lower_nodes, weights
+
+
+@dataclass
+class DepthDoseLibrary:
+    # Depth-dose curves normalised to a peak of one on the sweep's depth grid, one per simulated energy,
+    # with the peak dose per history and range needed to scale them back
+    beam_energies: np.ndarray
+    beam_energy_unit: str
+    depths: np.ndarray
+    depth_unit: str
+    curves: np.ndarray
+    peak_doses: np.ndarray
+    ranges: np.ndarray
+    numbers_of_histories: np.ndarray
+    error_coefficients: np.ndarray
+
+    def query(self, beam_energies, chunk_size: int=DEFAULT_QUERY_CHUNK_SIZE) -> DepthDoseQuery:
+        # Energies must lie within the library; they are answered chunk by chunk to bound the working memory
+        beam_energies = np.atleast_1d(np.asarray(beam_energies, dtype=np.float64))
+        outside = (beam_energies < self.beam_energies[0]) | (beam_energies > self.beam_energies[-1])
+        if outside.any():
+            raise ValueError(f"The library covers {self.beam_energies[0]:g} to {self.beam_energies[-1]:g} {self.beam_energy_unit}, "
+                             f"which excludes -> {beam_energies[outside][:5]}")
+        curves = np.empty((len(beam_energies), len(self.depths)))
+        ranges = np.empty(len(beam_energies))
+        peak_doses = np.empty(len(beam_energies))
+        error_estimates = np.empty(len(beam_energies))
+        for start in range(0, len(beam_energies), chunk_size):
+            chunk = slice(start, start + chunk_size)
+            curves[chunk], ranges[chunk], peak_doses[chunk], lower_nodes, weights = interpolate_depth_dose(
+                self.beam_energies, self.curves, self.ranges, self.peak_doses, self.depths, beam_energies[chunk])
+            error_estimates[chunk] = self.estimate_errors(lower_nodes, weights)
+        return DepthDoseQuery(beam_energies, self.depths, curves, peak_doses, ranges, error_estimates)
+
+    def estimate_errors(self, lower_nodes: np.ndarray, weights: np.ndarray) -> np.ndarray:
+        # Interpolation error grows with the product of the distances to the two nodes, as for any smooth
+        # curve, zero at a node and largest midway between, scaled by the curvature the nodes measured
+        interval_widths = self.beam_energies[lower_nodes + 1] - self.beam_energies[lower_nodes]
+        error_coefficients = (1 - weights) * self.error_coefficients[lower_nodes] + weights * self.error_coefficients[lower_nodes + 1]
+        return 4 * error_coefficients * weights * (1 - weights) * interval_widths**2
+
+    def save(self, library_filepath: Path) -> Path:
+        np.savez(library_filepath,
+                 beam_energies=self.beam_energies,
+                 beam_energy_unit=np.array(self.beam_energy_unit),
+                 depths=self.depths,
+                 depth_unit=np.array(self.depth_unit),
+                 curves=self.curves,
+                 peak_doses=self.peak_doses,
+                 ranges=self.ranges,
+                 numbers_of_histories=self.numbers_of_histories,
+                 error_coefficients=self.error_coefficients)
+        return Path(library_filepath)
+
+    @classmethod
+    def load(cls, library_filepath: Path):
+        library_filepath = Path(library_filepath)
+        if not library_filepath.exists():
+            raise FileNotFoundError(f"No depth-dose library exists at location -> {library_filepath}")
+        with np.load(library_filepath, allow_pickle=False) as arrays:
+            return cls(arrays["beam_energies"],
+                       str(arrays["beam_energy_unit"]),
+                       arrays["depths"],
+                       str(arrays["depth_unit"]),
+                       arrays["curves"],
+                       arrays["peak_doses"],
+                       arrays["ranges"],
+                       arrays["numbers_of_histories"],
+                       arrays["error_coefficients"])
+
+
+def compute_leave_one_out_errors(beam_energies: np.ndarray, curves: np.ndarray, ranges: np.ndarray, peak_doses: np.ndarray,
+                                 depths: np.ndarray) -> np.ndarray:
+    # Each inner curve is predicted from its two neighbours alone; the largest difference, as a fraction
+    # of the peak, is the error of interpolating across that wider gap. NaN for the end curves.
+    errors = np.full(len(beam_energies), np.nan)
+    for i in range(1, len(beam_energies) - 1):
+        neighbours = np.array([i - 1, i + 1])
+        predicted_curve = interpolate_depth_dose(beam_energies[neighbours], curves[neighbours], ranges[neighbours], peak_doses[neighbours],
+                                                 depths, beam_energies[i:i + 1])[0][0]
+        errors[i] = np.max(np.abs(predicted_curve - curves[i]))
+    return errors
+
+
+def compute_error_coefficients(beam_energies: np.ndarray, leave_one_out_errors: np.ndarray) -> np.ndarray:
+    # A left-out curve sits near the middle of a gap twice as wide, where the error is a quarter of the
+    # gap's width squared times the coefficient; the end curves borrow the coefficient of their neighbour
+    error_coefficients = np.full(len(beam_energies), np.nan)
+    if len(beam_energies) < 3:
+        return error_coefficients
+    gap_widths = beam_energies[2:] - beam_energies[:-2]
+    error_coefficients[1:-1] = leave_one_out_errors[1:-1] / gap_widths**2
+    error_coefficients[0] = error_coefficients[1]
+    error_coefficients[-1] = error_coefficients[-2]
+    return error_coefficients
+
+
+def check_runs_differ_only_in_energy(experiment_parameters: ExperimentParameters):
+    if experiment_parameters.sweep is None:
+        return
+    other_parameters = [axis.parameter.value for axis in experiment_parameters.sweep.axes
+                        if axis.parameter not in (SweepParameter.beam_energy, SweepParameter.number_of_histories)]
+    if other_parameters:
+        raise ValueError(f"A depth-dose library needs runs that differ only in beam energy and histories, but this sweep also varies -> {', '.join(other_parameters)}")
+
+
+def build_depth_dose_library(experiment_folder: Path, statistic_name: str="Sum") -> DepthDoseLibrary:
+    # Runs at the same energy are pooled into one curve per history, weighted by their histories
+    experiment_folder = Path(experiment_folder)
+    experiment_parameters = ExperimentParameters.from_json(experiment_folder / EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME)
+    check_runs_differ_only_in_energy(experiment_parameters)
+    summed_profiles: Dict[float, np.ndarray] = defaultdict(lambda: 0.0)
+    summed_numbers_of_histories: Dict[float, int] = defaultdict(int)
+    depths: Optional[np.ndarray] = None
+    depth_unit = None
+    beam_energy_unit = None
+    for script_path in list_run_scripts(experiment_folder / "scripts"):
+        run_metadata = read_run_metadata(script_path, experiment_parameters.particle_source.component)
+        if run_metadata["number_of_histories"] <= 0:
+            continue
+        try:
+            scorer_output = load_scorer_output(read_output_filepath(read_script_lines(script_path)))
+        except FileNotFoundError:
+            print(f"No output for {script_path.name}, leaving it out of the library.")
+            continue
+        run_depths = compute_depth_bin_centres(scorer_output)
+        if depths is None:
+            depths = run_depths
+            depth_unit = scorer_output.header.axes[DEPTH_AXIS].unit
+            beam_energy_unit = str(run_metadata["beam_energy_unit"])
+        elif not np.array_equal(depths, run_depths):
+            raise ValueError(f"The depth binning of {scorer_output.source_path} differs from the rest of the sweep.")
+        beam_energy = float(run_metadata["beam_energy"])
+        summed_profiles[beam_energy] = summed_profiles[beam_energy] + compute_depth_profile(scorer_output, statistic_name)
+        summed_numbers_of_histories[beam_energy] += int(run_metadata["number_of_histories"])
+    if len(summed_profiles) < MINIMUM_NUMBER_OF_ENERGIES:
+        raise ValueError(f"A depth-dose library needs completed runs at {MINIMUM_NUMBER_OF_ENERGIES} or more beam energies, "
+                         f"found {len(summed_profiles)} -> {experiment_folder}")
+    if len(depths) < 2:
+        raise ValueError(f"A depth-dose library needs more than one depth bin -> {experiment_folder}")
+
+    beam_energies = np.array(sorted(summed_profiles))
+    numbers_of_histories = np.array([summed_numbers_of_histories[beam_energy] for beam_energy in beam_energies], dtype=np.int64)
+    profiles = np.vstack([summed_profiles[beam_energy] for beam_energy in beam_energies]) / numbers_of_histories[:, None]
+    metrics = compute_bragg_peak_metrics(profiles, depths)
+    peak_doses = metrics["bragg_peak_value"]
+    ranges = metrics[RANGE_LEVEL_METRIC]
+    if np.isnan(ranges).any() or (peak_doses <= 0).any():
+        raise ValueError(f"Every curve must peak and fall below 80% of its peak within the scored depth, which fails at -> "
+                         f"{beam_energies[np.isnan(ranges) | (peak_doses <= 0)]} {beam_energy_unit}")
+    curves = profiles / peak_doses[:, None]
+    leave_one_out_errors = compute_leave_one_out_errors(beam_energies, curves, ranges, peak_doses, depths)
+    return DepthDoseLibrary(beam_energies,
+                            beam_energy_unit,
+                            depths,
+                            depth_unit,
+                            curves,
+                            peak_doses,
+                            ranges,
+                            numbers_of_histories,
+                            compute_error_coefficients(beam_energies, leave_one_out_errors))
+
+
+def locate_depth_dose_library(experiment_name: str) -> Path:
+    experiment_folder = locate_experiment_folder(experiment_name, FileStructure.EXPERIMENTS.value)
+    return experiment_folder / "analysis" / DEPTH_DOSE_LIBRARY_FILENAME
+
+
+def open_depth_dose_library(experiment_name: str) -> DepthDoseLibrary:
+    return DepthDoseLibrary.load(locate_depth_dose_library(experiment_name))
+
+
+def report_depth_dose_library(library: DepthDoseLibrary):
+    print(f"Depth-dose library of {len(library.beam_energies)} energies from {library.beam_energies[0]:g} to "
+          f"{library.beam_energies[-1]:g} {library.beam_energy_unit} on {len(library.depths)} depth bins.")
+    for beam_energy, beam_range, number_of_histories in zip(library.beam_energies, library.ranges, library.numbers_of_histories):
+        print(f"    {beam_energy:g} {library.beam_energy_unit}: R80 {beam_range:.4g} {library.depth_unit} from {number_of_histories} histories")
+    if np.isnan(library.error_coefficients).all():
+        print("Interpolation errors cannot be estimated from fewer than 3 energies.")
+        return
+    midpoints = 0.5 * (library.beam_energies[:-1] + library.beam_energies[1:])
+    largest_error = library.query(midpoints).error_estimates.max()
+    print(f"Largest estimated interpolation error -> {largest_error:.2%} of the peak dose, midway between simulated energies.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build a depth-dose library from an experiment's scorer outputs for interpolating unsimulated energies.")
+    parser.add_argument("experiment_name")
+    parser.add_argument("--statistic", default="Sum", help="Statistic of the scorer output to build the curves from.")
+    arguments = parser.parse_args()
+    experiment_folder = locate_experiment_folder(arguments.experiment_name, FileStructure.EXPERIMENTS.value)
+    library = build_depth_dose_library(experiment_folder, arguments.statistic)
+    library_filepath = library.save(experiment_folder / "analysis" / DEPTH_DOSE_LIBRARY_FILENAME)
+    report_depth_dose_library(library)
+    print(f"Depth-dose library written -> {library_filepath}")
+
+if __name__=="__main__":
+    main()
@@ -2,5 +2,7 @@ from enum import Enum
 
 class FileStructure(Enum):
     EXPERIMENTS = "../../experiments"
+    RESULT_CACHE = "../../experiments/.result_cache"
+    TELEMETRY_LEDGER = "../../experiments/telemetry.sqlite"
     GEOMETRY = "../../EXPERIMENT_GEOMETRY.txt"
     PARAMETERS = "../../EXPERIMENT_PARAMETERS.toml"
@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List, Type, Optional
+from typing import List, Type, Optional, Union
 from dataclasses import dataclass
 from pydantic import BaseModel, model_validator, ValidationError, Field, field_validator
 import tomli
@@ -16,7 +16,12 @@ from topas_wrapper.input_constants import (EnergyUnit,
                                            PhysicsList,
                                            PhysicsListType,
                                            ScorerQuantity,
-                                           ParticleType)
+                                           ParticleType,
+                                           ScorerOutputType,
+                                           ConvergenceMetric,
+                                           ScriptGenerationMode,
+                                           SweepParameter,
+                                           SweepSampling)
 
 @dataclass
 class ParticleSource(BaseModel): #TODO Add limits on values of energy etc
@@ -87,19 +92,100 @@ class Scorer(BaseModel):
     x_bins: Optional[int] = Field(None, gt=0)
     y_bins: Optional[int] = Field(None, gt=0)
     z_bins: Optional[int] = Field(None, gt=0)
+    output_type: Optional[ScorerOutputType] = None
+
+@dataclass
+class AdaptiveHistories(BaseModel):
+    target_metric: ConvergenceMetric
+    relative_tolerance: float = Field(..., gt=0)
+    batch_number_of_histories: int = Field(..., gt=0)
+    minimum_number_of_batches: int = Field(4, ge=2)
+    maximum_number_of_histories: int = Field(..., gt=0)
+
+    @model_validator(mode="after")
+    def check_budget_fits_minimum_batches(self):
+        minimum_number_of_histories = self.batch_number_of_histories * self.minimum_number_of_batches
+        if self.maximum_number_of_histories < minimum_number_of_histories:
+            raise ValueError(f"maximum_number_of_histories must allow the minimum number of batches, which needs {minimum_number_of_histories} histories.")
+        return self
+
+@dataclass
+class Supervisor(BaseModel):
+    # A run is killed after minimum_timeout_seconds plus timeout_seconds_per_history for each of its histories
+    timeout_seconds_per_history: float = Field(..., gt=0)
+    minimum_timeout_seconds: float = Field(60, gt=0)
+    maximum_retries: int = Field(2, ge=0)
+    retry_backoff_seconds: float = Field(5, ge=0)
+
+@dataclass
+class SweepAxis(BaseModel):
+    # Either lists the values to sweep or spans minimum to maximum, which a grid splits into number_of_points
+    parameter: SweepParameter
+    values: Optional[List[Union[float, List[PhysicsList]]]] = None
+    minimum: Optional[float] = Field(None, ge=0)
+    maximum: Optional[float] = Field(None, ge=0)
+    number_of_points: Optional[int] = Field(None, ge=2)
+
+    @model_validator(mode="after")
+    def check_values_or_range(self):
+        sweeps_modules = self.parameter == SweepParameter.physics_modules
+        if (self.values is None) == (self.minimum is None and self.maximum is None):
+            raise ValueError(f"The {self.parameter.value} sweep axis needs either values or a minimum and maximum, not both.")
+        if self.values is None:
+            if sweeps_modules:
+                raise ValueError("physics_modules can only be swept over listed values, each a list of modules.")
+            if self.minimum is None or self.maximum is None or self.maximum < self.minimum:
+                raise ValueError(f"The {self.parameter.value} sweep axis needs a minimum and a maximum that is no smaller than it.")
+            return self
+        if len(self.values) == 0:
+            raise ValueError(f"The {self.parameter.value} sweep axis has no values.")
+        if any(isinstance(value, list) != sweeps_modules for value in self.values):
+            raise ValueError(f"The values of the {self.parameter.value} sweep axis must all be {'lists of modules' if sweeps_modules else 'numbers'}.")
+        if not sweeps_modules and any(value < 0 for value in self.values):
+            raise ValueError(f"All values of the {self.parameter.value} sweep axis must be zero or greater.")
+        return self
+
+@dataclass
+class Sweep(BaseModel):
+    # Beam energy and numbers of histories fall back to the lists given outside the sweep when they have no axis
+    sampling: SweepSampling = SweepSampling.grid
+    number_of_samples: Optional[int] = Field(None, gt=0)
+    axes: List[SweepAxis]
+
+    @model_validator(mode="after")
+    def check_axes_fit_sampling(self):
+        parameters = [axis.parameter for axis in self.axes]
+        if len(set(parameters)) != len(parameters):
+            raise ValueError("Each parameter can only have one sweep axis.")
+        if self.sampling == SweepSampling.grid:
+            if self.number_of_samples is not None:
+                raise ValueError("number_of_samples only applies to latin_hypercube and sobol sampling, a grid runs every point.")
+            if any(axis.values is None and axis.number_of_points is None for axis in self.axes):
+                raise ValueError("A grid sweep needs number_of_points on every axis given by a minimum and maximum.")
+        elif self.number_of_samples is None:
+            raise ValueError(f"{self.sampling.value} sampling needs number_of_samples.")
+        return self
 
 @dataclass
 class ExperimentParameters(BaseModel):
     experiment_name: str
     overwrite_existing_experiment: bool
+    regenerate_incrementally: bool = False
+    script_generation_mode: ScriptGenerationMode = ScriptGenerationMode.inline
 
     number_of_threads: int = Field(..., ge=0)
+    core_budget: Optional[int] = Field(None, gt=0)
     seed_number: int = Field(..., ge=0)
+    use_result_cache: bool = True
+    number_of_shards: int = Field(1, ge=1)
     numbers_of_histories: List[int]
 
     particle_source: ParticleSource
     physics_list: ExperimentPhysicsList
     scorer: Scorer
+    adaptive_histories: Optional[AdaptiveHistories] = None
+    supervisor: Optional[Supervisor] = None
+    sweep: Optional[Sweep] = None
 
     @classmethod
     def from_json(cls, filepath: Path):
@@ -118,6 +204,20 @@ class ExperimentParameters(BaseModel):
             raise ValueError("All numbers of histories must be zero or greater")
         return values
 
+    @model_validator(mode="after")
+    def check_derived_seeds_have_fixed_seed(self):
+        if self.number_of_shards > 1 and self.seed_number == 0:
+            raise ValueError("Sharded runs derive a distinct seed for every shard, so seed_number must be non-zero when number_of_shards is greater than one.")
+        if self.adaptive_histories is not None and self.seed_number == 0:
+            raise ValueError("Adaptive histories derive a distinct seed for every batch, so seed_number must be non-zero.")
+        return self
+
+    @model_validator(mode="after")
+    def check_sweep_is_not_adaptive(self):
+        if self.adaptive_histories is not None and self.sweep is not None:
+            raise ValueError("Adaptive histories only sweep the beam energies, so they cannot be combined with a [sweep] section.")
+        return self
+
 
 def locate_experiment_config_file(relative_filepath: str) -> Path:
     mod_path = Path(__file__).parent
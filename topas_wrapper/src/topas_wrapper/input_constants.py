@@ -93,6 +93,11 @@ class PhysicsList(str, Enum):
     g4radioactivedecay = "g4radioactivedecay"
     g4stopping = "g4stopping"
 
+class ScriptGenerationMode(str, Enum):
+    inline = "inline"
+    compiled = "compiled"
+    include_file = "include_file"
+
 class PhysicsListType(str, Enum):
     Geant4_Modular = "Geant4_Modular"
 
@@ -113,6 +118,35 @@ class ScorerQuantity(str, Enum):
     EffectiveCharge = "EffectiveCharge"
     ProtonLET = "ProtonLET"
 
+class ScorerOutputType(str, Enum):
+    csv = "csv"
+    binary = "binary"
+
+class ConvergenceMetric(str, Enum):
+    bragg_peak_depth = "bragg_peak_depth"
+    integrated_deposit = "integrated_deposit"
+
+class SweepParameter(str, Enum):
+    beam_energy = "beam_energy"
+    beam_energy_spread = "beam_energy_spread"
+    beam_position_spread_x = "beam_position_spread_x"
+    beam_position_spread_y = "beam_position_spread_y"
+    beam_angular_spread_x = "beam_angular_spread_x"
+    beam_angular_spread_y = "beam_angular_spread_y"
+    physics_modules = "physics_modules"
+    number_of_histories = "number_of_histories"
+
+class SweepSampling(str, Enum):
+    grid = "grid"
+    latin_hypercube = "latin_hypercube"
+    sobol = "sobol"
+
+class RunStatus(str, Enum):
+    pending = "pending"
+    running = "running"
+    completed = "completed"
+    failed = "failed"
+
 class ParticleType(str, Enum): #PDG codes not currently supported
     proton = "proton"
     neutron = "neutron"
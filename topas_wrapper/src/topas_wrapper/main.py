@@ -0,0 +1,260 @@
+import argparse
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+import numpy as np
+from topas_wrapper.get_data import load_experiment_parameters, ExperimentParameters
+from topas_wrapper.script_generator import iterate_scripts, EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+from topas_wrapper.sharding import ShardedRun, shard_script, mark_shard_complete
+from topas_wrapper.result_cache import ResultCache
+from topas_wrapper.manifest import RunManifest
+from topas_wrapper.regeneration import has_valid_output
+from topas_wrapper.results_store import read_run_metadata, list_run_scripts
+from topas_wrapper.analysis import METRICS_TABLE_DTYPE, analyse_run_output, analyse_sweep, write_metrics_table, write_sweep_point_metrics_table
+from topas_wrapper.adaptive_histories import run_adaptive_experiment
+from topas_wrapper.supervisor import iterate_supervised_simulations
+from topas_wrapper.work_queue import enqueue_experiment, run_worker, report_queue_status, DEFAULT_LEASE_TIMEOUT_SECONDS
+from topas_wrapper.telemetry import TelemetryLedger, order_longest_first, report_sweep_estimate
+from topas_wrapper.create_file_structure import locate_experiment_folder
+from topas_wrapper.file_structure import FileStructure
+from topas_wrapper.run_simulations import (SimulationJob,
+                                           SimulationResult,
+                                           iterate_simulations,
+                                           report_simulation_result,
+                                           report_simulation_summary,
+                                           resume_experiment,
+                                           TOPAS_EXECUTABLE)
+
+DEFAULT_NUMBER_OF_ANALYSIS_WORKERS = 1
+
+
+def iterate_pipeline_jobs(script_paths: Iterable[Path],
+                          experiment_parameters: ExperimentParameters,
+                          manifest: RunManifest,
+                          sharded_run_by_script: Dict[Path, ShardedRun],
+                          up_to_date_script_paths: List[Path]) -> Iterator[SimulationJob]:
+    # Scripts are registered, and sharded if asked for, only as the scheduler pulls them in. An incremental
+    # regeneration keeps the valid output of every unchanged run, so those are set aside for analysis instead.
+    for script_path in script_paths:
+        if experiment_parameters.regenerate_incrementally and has_valid_output(script_path):
+            manifest.register(script_path)
+            up_to_date_script_paths.append(script_path)
+            continue
+        if experiment_parameters.number_of_shards <= 1:
+            manifest.register(script_path)
+            yield SimulationJob(script_path, experiment_parameters.number_of_threads)
+            continue
+        sharded_run = shard_script(script_path,
+                                   experiment_parameters.number_of_shards,
+                                   experiment_parameters.seed_number,
+                                   experiment_parameters.particle_source.component)
+        manifest.register_all(sharded_run.shard_script_paths, sharded_run.script_path)
+        for shard_script_path in sharded_run.shard_script_paths:
+            sharded_run_by_script[shard_script_path] = sharded_run
+            yield SimulationJob(shard_script_path, experiment_parameters.number_of_threads)
+
+
+def iterate_experiment_simulations(jobs: Iterable[SimulationJob],
+                                   experiment_parameters: ExperimentParameters,
+                                   topas_executable: str,
+                                   result_cache: Optional[ResultCache],
+                                   manifest: RunManifest) -> Iterator[SimulationResult]:
+    if experiment_parameters.supervisor is None:
+        return iterate_simulations(jobs, experiment_parameters.core_budget, topas_executable, result_cache=result_cache, manifest=manifest)
+    return iterate_supervised_simulations(jobs,
+                                          experiment_parameters.supervisor,
+                                          experiment_parameters.particle_source.component,
+                                          experiment_parameters.core_budget,
+                                          topas_executable,
+                                          result_cache=result_cache,
+                                          manifest=manifest)
+
+
+def find_completed_run_script(result: SimulationResult, sharded_run_by_script: Dict[Path, ShardedRun]) -> Optional[Path]:
+    # The run script whose output this result completes, which for a shard is only once its run has merged
+    if not result.succeeded:
+        return None
+    sharded_run = sharded_run_by_script.get(result.job.script_path)
+    if sharded_run is None:
+        return result.job.script_path
+    merged_output_filepath = mark_shard_complete(sharded_run, result.job.script_path)
+    if merged_output_filepath is None:
+        return None
+    print(f"Shards merged -> {merged_output_filepath.name}")
+    return sharded_run.script_path
+
+
+def submit_up_to_date_analyses(executor: ProcessPoolExecutor, up_to_date_script_paths: List[Path], futures: Dict[str, Future],
+                               particle_source_component: str):
+    while up_to_date_script_paths:
+        script_path = up_to_date_script_paths.pop(0)
+        print(f"Up to date -> {script_path.name}")
+        futures[script_path.stem] = submit_run_analysis(executor, script_path, particle_source_component)
+
+
+def report_run_analysis(script_path: Path, future: Future):
+    if future.cancelled():
+        return
+    if future.exception() is not None:
+        print(f"Analysis failed -> {script_path.name}. \n{future.exception()}")
+        return
+    row, depth_unit = future.result()
+    print(f"Analysed -> {script_path.name}: Bragg peak at {row['bragg_peak_depth']:.4g} {depth_unit}, "
+          f"R90 {row['r90']:.4g} {depth_unit}, R80 {row['r80']:.4g} {depth_unit}")
+
+
+def submit_run_analysis(executor: ProcessPoolExecutor, script_path: Path, particle_source_component: str) -> Future:
+    run_metadata = read_run_metadata(script_path, particle_source_component)
+    output_filepath = read_output_filepath(read_script_lines(script_path))
+    future = executor.submit(analyse_run_output,
+                             output_filepath,
+                             float(run_metadata["beam_energy"]),
+                             int(run_metadata["number_of_histories"]))
+    future.add_done_callback(partial(report_run_analysis, script_path))
+    return future
+
+
+def collect_analysed_rows(futures: Dict[str, Future]) -> Dict[str, np.ndarray]:
+    return {run_name: future.result()[0] for run_name, future in futures.items() if not future.cancelled() and future.exception() is None}
+
+
+def collect_metrics_table(rows: List[np.ndarray]) -> np.ndarray:
+    return np.sort(np.array(rows, dtype=METRICS_TABLE_DTYPE), order=["beam_energy", "number_of_histories"])
+
+
+def write_pipeline_metrics(rows_by_run_name: Dict[str, np.ndarray], experiment_parameters: ExperimentParameters, analysis_folder: Path) -> np.ndarray:
+    table = collect_metrics_table(list(rows_by_run_name.values()))
+    metrics_table_filepath = write_metrics_table(table, analysis_folder)
+    print(f"Bragg peak metrics for {len(table)} runs written -> {metrics_table_filepath}")
+    if experiment_parameters.sweep is not None:
+        sweep_point_metrics_filepath = write_sweep_point_metrics_table(list(rows_by_run_name), list(rows_by_run_name.values()), analysis_folder)
+        print(f"Bragg peak metrics by sweep point written -> {sweep_point_metrics_filepath}")
+    return table
+
+
+def analyse_run_scripts(experiment_folder: Path, experiment_parameters: ExperimentParameters) -> np.ndarray:
+    # Sweep points are not an energy by histories grid, so each run is analysed from what its own script sets
+    rows_by_run_name = {}
+    for script_path in list_run_scripts(experiment_folder / "scripts"):
+        run_metadata = read_run_metadata(script_path, experiment_parameters.particle_source.component)
+        try:
+            rows_by_run_name[script_path.stem], _ = analyse_run_output(read_output_filepath(read_script_lines(script_path)),
+                                                                       float(run_metadata["beam_energy"]),
+                                                                       int(run_metadata["number_of_histories"]))
+        except (FileNotFoundError, ValueError) as e:
+            print(f"Analysis failed -> {script_path.name}. \n{e}")
+    return write_pipeline_metrics(rows_by_run_name, experiment_parameters, experiment_folder / "analysis")
+
+
+def run_pipeline(experiment_parameters: ExperimentParameters,
+                 topas_executable: str=TOPAS_EXECUTABLE,
+                 number_of_analysis_workers: int=DEFAULT_NUMBER_OF_ANALYSIS_WORKERS,
+                 telemetry_ledger: Optional[TelemetryLedger]=None) -> np.ndarray:
+    # Scripts are generated as the scheduler asks for them, and each run's output is analysed in a separate
+    # worker process as soon as it is complete, so the first results arrive while the sweep is still running.
+    # Once the telemetry ledger can fit a cost model the sweep is instead generated up front, so it can be
+    # ordered longest first and given an ETA before it starts.
+    result_cache = ResultCache() if experiment_parameters.use_result_cache else None
+    telemetry_ledger = TelemetryLedger() if telemetry_ledger is None else telemetry_ledger
+    script_paths = iterate_scripts(experiment_parameters)
+    up_to_date_script_paths: List[Path] = []
+    if telemetry_ledger.has_cost_model():
+        script_paths_to_run = []
+        for script_path in script_paths:
+            # Unchanged runs are only analysed, so they are kept out of the order and the estimate
+            if experiment_parameters.regenerate_incrementally and has_valid_output(script_path):
+                up_to_date_script_paths.append(script_path)
+            else:
+                script_paths_to_run.append(script_path)
+        cost_models = telemetry_ledger.fit_script_cost_models(script_paths_to_run)
+        ordered_script_paths, ordered_cost_models = order_longest_first(script_paths_to_run, cost_models, experiment_parameters)
+        report_sweep_estimate(ordered_script_paths, ordered_cost_models, experiment_parameters)
+        script_paths = iter(ordered_script_paths)
+    first_script_path = next(script_paths, None)
+    if first_script_path is not None:
+        script_paths = chain([first_script_path], script_paths)
+    elif up_to_date_script_paths:
+        first_script_path = up_to_date_script_paths[0]
+    else:
+        raise ValueError("The experiment parameters describe no runs.")
+    experiment_folder = first_script_path.parent.parent
+    manifest = RunManifest(experiment_folder)
+    for script_path in up_to_date_script_paths:
+        manifest.register(script_path)
+    sharded_run_by_script: Dict[Path, ShardedRun] = {}
+    results = []
+    futures: Dict[str, Future] = {}
+    try:
+        with ProcessPoolExecutor(max_workers=number_of_analysis_workers) as executor:
+            jobs = iterate_pipeline_jobs(script_paths, experiment_parameters, manifest, sharded_run_by_script, up_to_date_script_paths)
+            for result in iterate_experiment_simulations(jobs, experiment_parameters, topas_executable, result_cache, manifest):
+                report_simulation_result(result)
+                results.append(result)
+                telemetry_ledger.record(result, experiment_parameters)
+                completed_run_script_path = find_completed_run_script(result, sharded_run_by_script)
+                if completed_run_script_path is not None:
+                    futures[completed_run_script_path.stem] = submit_run_analysis(executor, completed_run_script_path,
+                                                                                  experiment_parameters.particle_source.component)
+                submit_up_to_date_analyses(executor, up_to_date_script_paths, futures, experiment_parameters.particle_source.component)
+            submit_up_to_date_analyses(executor, up_to_date_script_paths, futures, experiment_parameters.particle_source.component)
+            report_simulation_summary(results)
+            if futures:
+                print(f"Waiting for the analysis of {sum(not future.done() for future in futures.values())} runs to finish.")
+    finally:
+        manifest.close()
+        telemetry_ledger.close()
+    return write_pipeline_metrics(collect_analysed_rows(futures), experiment_parameters, experiment_folder / "analysis")
+
+
+def resume_pipeline(experiment_name: str, topas_executable: str=TOPAS_EXECUTABLE) -> np.ndarray:
+    resume_experiment(experiment_name, topas_executable)
+    experiment_folder = locate_experiment_folder(experiment_name, FileStructure.EXPERIMENTS.value)
+    experiment_parameters = ExperimentParameters.from_json(experiment_folder / EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME)
+    if experiment_parameters.sweep is not None:
+        return analyse_run_scripts(experiment_folder, experiment_parameters)
+    return analyse_sweep(experiment_parameters, experiment_folder / "data", experiment_folder / "analysis")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate, run and analyse the TOPAS simulations described by EXPERIMENT_PARAMETERS.toml.")
+    parser.add_argument("--topas-executable", default=TOPAS_EXECUTABLE, help="TOPAS executable name or path.")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="Generate, run and analyse the experiment as one pipeline (default).")
+    run_parser.add_argument("--analysis-workers", type=int, default=DEFAULT_NUMBER_OF_ANALYSIS_WORKERS,
+                            help="Number of worker processes analysing finished runs.")
+    resume_parser = subparsers.add_parser("resume", help="Re-run the missing or failed runs of an existing experiment, then analyse it.")
+    resume_parser.add_argument("experiment_name")
+    subparsers.add_parser("enqueue", help="Generate the experiment's scripts into a work queue for workers on any host sharing the filesystem.")
+    work_parser = subparsers.add_parser("work", help="Run jobs from an experiment's work queue until it is drained.")
+    work_parser.add_argument("experiment_name")
+    work_parser.add_argument("--core-budget", type=int, default=None, help="Cores this worker may use, defaults to the experiment's core_budget.")
+    work_parser.add_argument("--lease-timeout", type=float, default=DEFAULT_LEASE_TIMEOUT_SECONDS,
+                             help="Seconds without a heartbeat before another worker takes over a job.")
+    status_parser = subparsers.add_parser("queue-status", help="Show the jobs and leases of an experiment's work queue.")
+    status_parser.add_argument("experiment_name")
+    arguments = parser.parse_args()
+    if arguments.command == "resume":
+        resume_pipeline(arguments.experiment_name, arguments.topas_executable)
+        return
+    if arguments.command == "work":
+        run_worker(arguments.experiment_name, arguments.core_budget, arguments.topas_executable, arguments.lease_timeout)
+        return
+    if arguments.command == "queue-status":
+        report_queue_status(arguments.experiment_name)
+        return
+    experiment_parameters = load_experiment_parameters()
+    if arguments.command == "enqueue":
+        enqueue_experiment(experiment_parameters)
+        return
+    if experiment_parameters.adaptive_histories is not None:
+        # Adaptive runs decide their own numbers of histories and write their own summary
+        result_cache = ResultCache() if experiment_parameters.use_result_cache else None
+        run_adaptive_experiment(experiment_parameters, arguments.topas_executable, result_cache)
+        return
+    run_pipeline(experiment_parameters, arguments.topas_executable, getattr(arguments, "analysis_workers", DEFAULT_NUMBER_OF_ANALYSIS_WORKERS))
+
+if __name__=="__main__":
+    main()
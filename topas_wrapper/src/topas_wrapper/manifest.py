@@ -0,0 +1,83 @@
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Iterable, List, Optional
+from topas_wrapper.input_constants import RunStatus
+from topas_wrapper.result_cache import hash_script_lines
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+
+MANIFEST_FILENAME = "manifest.sqlite"
+
+
+@dataclass
+class ManifestEntry:
+    script_path: Path
+    parameters_hash: str
+    status: RunStatus
+    exit_code: Optional[int]
+    output_path: Path
+    parent_script_path: Optional[Path]
+    started_at: Optional[float]
+    finished_at: Optional[float]
+    wall_time: Optional[float]
+
+
+class RunManifest:
+    # One row per job in the experiment folder, committed on every change so a crash loses at most the running jobs
+    def __init__(self, experiment_folder: Path):
+        self.manifest_path = Path(experiment_folder) / MANIFEST_FILENAME
+        self.connection = sqlite3.connect(self.manifest_path)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    script_path TEXT PRIMARY KEY,
+                    parameters_hash TEXT NOT NULL,
+                    status TEXT NOT NULL,
+                    exit_code INTEGER,
+                    output_path TEXT NOT NULL,
+                    parent_script_path TEXT,
+                    started_at REAL,
+                    finished_at REAL,
+                    wall_time REAL
+                )""")
+
+    def close(self):
+        self.connection.close()
+
+    def register(self, script_path: Path, parent_script_path: Optional[Path]=None):
+        # Re-registering a script whose parameters changed resets it, an unchanged script keeps its status
+        script_lines = read_script_lines(script_path)
+        parameters_hash = hash_script_lines(script_lines)
+        output_path = read_output_filepath(script_lines)
+        parent = None if parent_script_path is None else str(parent_script_path)
+        with self.connection:
+            row = self.connection.execute("SELECT parameters_hash FROM runs WHERE script_path = ?", (str(script_path),)).fetchone()
+            if row is not None and row[0] == parameters_hash:
+                self.connection.execute("UPDATE runs SET parent_script_path = ? WHERE script_path = ?", (parent, str(script_path)))
+                return
+            self.connection.execute("""
+                INSERT OR REPLACE INTO runs (script_path, parameters_hash, status, exit_code, output_path, parent_script_path)
+                VALUES (?, ?, ?, NULL, ?, ?)""",
+                (str(script_path), parameters_hash, RunStatus.pending.value, str(output_path), parent))
+
+    def register_all(self, script_paths: Iterable[Path], parent_script_path: Optional[Path]=None):
+        for script_path in script_paths:
+            self.register(script_path, parent_script_path)
+
+    def mark_running(self, script_path: Path):
+        with self.connection:
+            self.connection.execute("UPDATE runs SET status = ?, exit_code = NULL, started_at = ?, finished_at = NULL, wall_time = NULL WHERE script_path = ?",
+                                    (RunStatus.running.value, time.time(), str(script_path)))
+
+    def mark_finished(self, script_path: Path, exit_code: int, status: RunStatus, wall_time: float):
+        with self.connection:
+            self.connection.execute("UPDATE runs SET status = ?, exit_code = ?, finished_at = ?, wall_time = ? WHERE script_path = ?",
+                                    (status.value, exit_code, time.time(), wall_time, str(script_path)))
+
+    def entries(self) -> List[ManifestEntry]:
+        rows = self.connection.execute("""
+            SELECT script_path, parameters_hash, status, exit_code, output_path, parent_script_path, started_at, finished_at, wall_time
+            FROM runs ORDER BY rowid""").fetchall()
+        return [ManifestEntry(Path(row[0]), row[1], RunStatus(row[2]), row[3], Path(row[4]),
+                              None if row[5] is None else Path(row[5]), row[6], row[7], row[8]) for row in rows]
@@ -0,0 +1,282 @@
+import re
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Set, Tuple
+from topas_wrapper.script_reader import PARAMETER_PATTERN, INCLUDE_FILE_PATTERN
+from topas_wrapper.file_structure import FileStructure
+
+GEOMETRY_SOURCE_NAME = FileStructure.GEOMETRY.value.split("/")[-1]
+GENERATED_SOURCE_NAME = "generated run script"
+BASE_PARAMETERS_SOURCE_NAME = "generated base parameters"
+SECTION_MARKER_PATTERN = re.compile(r'^!!![\w-]+!!!$')
+QUOTED_STRING_PATTERN = re.compile(r'"[^"]*"')
+REFERENCE_PATTERN = re.compile(r'(?<![\w/])(?:Ge|Ma|So|Sc|Ph|Ts|Gr|Tf|El|Is|Vr)/[\w./-]+')
+PARAMETER_TYPES = {"s", "b", "i", "u", "d", "sv", "bv", "iv", "uv", "dv"}
+BOOLEAN_VALUES = {'"true"', '"false"', '"t"', '"f"', '"1"', '"0"'}
+# TOPAS defines the world volume itself, so a geometry may use it without defining all of it
+WORLD_COMPONENT = "World"
+# Materials TOPAS defines by default, besides the Geant4 NIST materials named G4_*
+TOPAS_DEFAULT_MATERIALS = {"Air", "Aluminum", "Brass", "Kapton", "Lead", "Lexan", "Lucite", "Mylar", "Parylene", "Titanium", "Vacuum"}
+NIST_MATERIAL_PREFIX = "G4_"
+MATERIAL_FRACTION_TOLERANCE = 1e-4
+
+UNIT_DIMENSIONS = {"nm": "length", "um": "length", "mm": "length", "cm": "length", "m": "length", "km": "length",
+                   "eV": "energy", "keV": "energy", "MeV": "energy", "GeV": "energy", "TeV": "energy",
+                   "rad": "angle", "mrad": "angle", "deg": "angle",
+                   "g/cm3": "density", "mg/cm3": "density", "kg/m3": "density",
+                   "ns": "time", "us": "time", "ms": "time", "s": "time"}
+# The dimension a parameter must have, by the last part of its name
+EXPECTED_DIMENSIONS = {"HLX": "length", "HLY": "length", "HLZ": "length", "RMin": "length", "RMax": "length",
+                       "TransX": "length", "TransY": "length", "TransZ": "length",
+                       "BeamPositionCutoffX": "length", "BeamPositionCutoffY": "length",
+                       "BeamPositionSpreadX": "length", "BeamPositionSpreadY": "length",
+                       "RotX": "angle", "RotY": "angle", "RotZ": "angle", "SPhi": "angle", "DPhi": "angle",
+                       "BeamAngularCutoffX": "angle", "BeamAngularCutoffY": "angle",
+                       "BeamAngularSpreadX": "angle", "BeamAngularSpreadY": "angle",
+                       "BeamEnergy": "energy", "MeanExcitationEnergy": "energy", "EMRangeMin": "energy", "EMRangeMax": "energy",
+                       "Density": "density"}
+
+
+@dataclass
+class ParameterDefinition:
+    type: str
+    name: str
+    value: str
+    source: str
+    line_number: int
+
+    @property
+    def location(self) -> str:
+        return f"{self.source}:{self.line_number}"
+
+
+@dataclass
+class PreflightReport:
+    errors: List[str] = field(default_factory=list)
+    warnings: List[str] = field(default_factory=list)
+    number_of_parameters: int = 0
+    number_of_components: int = 0
+
+
+def parse_parameter_lines(lines: List[Tuple[int, str]], source: str, report: PreflightReport) -> List[ParameterDefinition]:
+    # Blank lines, comments, section markers and includeFile lines carry no parameters
+    definitions = []
+    for line_number, line in lines:
+        stripped_line = line.strip()
+        if not stripped_line or stripped_line.startswith("#") or SECTION_MARKER_PATTERN.match(stripped_line) or INCLUDE_FILE_PATTERN.match(stripped_line):
+            continue
+        match = PARAMETER_PATTERN.match(stripped_line)
+        if match is None or match.group("type").lower() not in PARAMETER_TYPES:
+            report.errors.append(f"{source}:{line_number} is not a TOPAS parameter -> {stripped_line}")
+            continue
+        definitions.append(ParameterDefinition(match.group("type").lower(), match.group("name"), match.group("value"), source, line_number))
+    return definitions
+
+
+def split_generated_lines(script_lines: List[str], geometry_lines: List[str]) -> List[Tuple[int, str]]:
+    # The geometry is pasted into the run script as one block, which is checked against its own file instead
+    number_of_geometry_lines = len(geometry_lines)
+    numbered_lines = list(enumerate(script_lines, start=1))
+    for start in range(len(script_lines) - number_of_geometry_lines + 1):
+        if number_of_geometry_lines and script_lines[start:start + number_of_geometry_lines] == geometry_lines:
+            return numbered_lines[:start] + numbered_lines[start + number_of_geometry_lines:]
+    return numbered_lines
+
+
+def build_symbol_table(definitions: List[ParameterDefinition], report: PreflightReport) -> Dict[str, ParameterDefinition]:
+    # TOPAS refuses a parameter set twice in one file, which is what the geometry becomes inside every run script
+    symbol_table: Dict[str, ParameterDefinition] = {}
+    for definition in definitions:
+        previous_definition = symbol_table.get(definition.name)
+        if previous_definition is not None:
+            report.errors.append(f"{definition.name} is set twice -> {previous_definition.location} and {definition.location}")
+        symbol_table[definition.name] = definition
+    return symbol_table
+
+
+def find_references(value: str) -> List[str]:
+    return REFERENCE_PATTERN.findall(QUOTED_STRING_PATTERN.sub("", value))
+
+
+def read_string_value(definition: ParameterDefinition) -> str:
+    return definition.value.strip().strip('"')
+
+
+def count_vector_entries(definition: ParameterDefinition) -> Tuple[Optional[int], int]:
+    # The declared length leads the value; a dv vector ends in its unit
+    tokens = definition.value.split()
+    declared_length = int(tokens[0]) if tokens and tokens[0].isdigit() else None
+    if definition.type == "sv":
+        return declared_length, len(QUOTED_STRING_PATTERN.findall(definition.value))
+    entries = tokens[1:]
+    if definition.type == "dv" and entries and entries[-1] in UNIT_DIMENSIONS:
+        entries = entries[:-1]
+    return declared_length, len(entries)
+
+
+def check_values(symbol_table: Dict[str, ParameterDefinition], report: PreflightReport):
+    for definition in symbol_table.values():
+        value = definition.value.strip()
+        if definition.type.endswith("v"):
+            declared_length, number_of_entries = count_vector_entries(definition)
+            if declared_length is None:
+                report.errors.append(f"{definition.location} {definition.name} must start with its number of entries -> {value}")
+            elif declared_length != number_of_entries:
+                report.errors.append(f"{definition.location} {definition.name} declares {declared_length} entries but has {number_of_entries} -> {value}")
+        elif definition.type == "s" and not (value.startswith('"') and value.endswith('"')):
+            report.errors.append(f"{definition.location} {definition.name} is a string and must be quoted -> {value}")
+        elif definition.type == "b" and value.lower() not in BOOLEAN_VALUES and not find_references(value):
+            report.errors.append(f"{definition.location} {definition.name} must be \"True\" or \"False\" -> {value}")
+        elif definition.type == "i" and not find_references(value) and not re.fullmatch(r'[-+]?\d+', value):
+            report.errors.append(f"{definition.location} {definition.name} must be an integer -> {value}")
+
+
+def find_dimension(definition: ParameterDefinition) -> Optional[str]:
+    tokens = definition.value.split()
+    return UNIT_DIMENSIONS.get(tokens[-1]) if tokens else None
+
+
+def check_units(symbol_table: Dict[str, ParameterDefinition], report: PreflightReport):
+    # A dimensioned parameter needs a unit of the right kind, and may only reference parameters of the same kind
+    for definition in symbol_table.values():
+        if definition.type != "d":
+            continue
+        tokens = definition.value.split()
+        if len(tokens) < 2:
+            report.errors.append(f"{definition.location} {definition.name} needs a unit -> {definition.value}")
+            continue
+        dimension = find_dimension(definition)
+        if dimension is None:
+            report.warnings.append(f"{definition.location} {definition.name} has a unit the pre-flight checks do not know -> {tokens[-1]}")
+            continue
+        expected_dimension = EXPECTED_DIMENSIONS.get(definition.name.split("/")[-1])
+        if expected_dimension is not None and dimension != expected_dimension:
+            report.errors.append(f"{definition.location} {definition.name} needs {expected_dimension} units, not {dimension} units -> {definition.value}")
+        for reference in find_references(definition.value):
+            referenced_definition = symbol_table.get(reference)
+            if referenced_definition is None or referenced_definition.type != "d":
+                continue
+            referenced_dimension = find_dimension(referenced_definition)
+            if referenced_dimension is not None and referenced_dimension != dimension:
+                report.errors.append(f"{definition.location} {definition.name} has {dimension} units but references {reference}, which has {referenced_dimension} units")
+
+
+def check_references(symbol_table: Dict[str, ParameterDefinition], report: PreflightReport):
+    for definition in symbol_table.values():
+        for reference in find_references(definition.value):
+            if reference not in symbol_table and not reference.startswith(f"Ge/{WORLD_COMPONENT}/"):
+                report.errors.append(f"{definition.location} {definition.name} references {reference}, which is never set")
+
+
+def list_components(symbol_table: Dict[str, ParameterDefinition]) -> Set[str]:
+    return {name.split("/")[1] for name in symbol_table if name.startswith("Ge/") and name.endswith("/Type") and name.count("/") == 2}
+
+
+def check_components(symbol_table: Dict[str, ParameterDefinition], components: Set[str], report: PreflightReport):
+    # Every component other than the world hangs from a defined parent, without any loop back to itself,
+    # and every Component or Parent setting names a defined component
+    for name, definition in symbol_table.items():
+        parts = name.split("/")
+        if len(parts) != 3 or parts[2] not in ("Component", "Parent") or definition.type != "s":
+            continue
+        if read_string_value(definition) not in components | {WORLD_COMPONENT}:
+            report.errors.append(f"{definition.location} {name} names {definition.value.strip()}, which is not a component of the geometry")
+    for component in sorted(components - {WORLD_COMPONENT}):
+        parent_definition = symbol_table.get(f"Ge/{component}/Parent")
+        if parent_definition is None:
+            report.errors.append(f"{symbol_table[f'Ge/{component}/Type'].location} Ge/{component} has no Parent")
+            continue
+        visited = [component]
+        parent = read_string_value(parent_definition)
+        while parent != WORLD_COMPONENT and parent in components:
+            if parent in visited:
+                report.errors.append(f"{parent_definition.location} Ge/{component} is its own ancestor -> {' -> '.join(visited + [parent])}")
+                break
+            visited.append(parent)
+            ancestor_definition = symbol_table.get(f"Ge/{parent}/Parent")
+            if ancestor_definition is None:
+                break
+            parent = read_string_value(ancestor_definition)
+    for name in symbol_table:
+        parts = name.split("/")
+        if parts[0] == "Ge" and len(parts) == 3 and parts[1] not in components | {WORLD_COMPONENT}:
+            report.errors.append(f"{symbol_table[name].location} Ge/{parts[1]} is set up but has no Type")
+            components.add(parts[1])
+
+
+def list_materials(symbol_table: Dict[str, ParameterDefinition]) -> Set[str]:
+    return {name.split("/")[1] for name in symbol_table if name.startswith("Ma/") and name.count("/") == 2}
+
+
+def check_materials(symbol_table: Dict[str, ParameterDefinition], components: Set[str], report: PreflightReport):
+    materials = list_materials(symbol_table)
+    for component in sorted(components):
+        material_definition = symbol_table.get(f"Ge/{component}/Material")
+        if material_definition is None:
+            continue
+        material = read_string_value(material_definition)
+        if material not in materials and material not in TOPAS_DEFAULT_MATERIALS and not material.startswith(NIST_MATERIAL_PREFIX):
+            report.errors.append(f"{material_definition.location} Ge/{component}/Material is {material}, which is neither defined under Ma/ nor a TOPAS or G4_ material")
+    for material in sorted(materials):
+        components_definition = symbol_table.get(f"Ma/{material}/Components")
+        if components_definition is None:
+            continue
+        fractions_definition = symbol_table.get(f"Ma/{material}/Fractions")
+        if fractions_definition is None:
+            report.errors.append(f"{components_definition.location} Ma/{material} lists its Components but no Fractions")
+        elif count_vector_entries(components_definition)[1] != count_vector_entries(fractions_definition)[1]:
+            report.errors.append(f"{fractions_definition.location} Ma/{material} has a different number of Fractions and Components")
+        else:
+            try:
+                fractions = [float(fraction) for fraction in fractions_definition.value.split()[1:]]
+            except ValueError:
+                fractions = None
+            if fractions is not None and abs(sum(fractions) - 1) > MATERIAL_FRACTION_TOLERANCE:
+                report.errors.append(f"{fractions_definition.location} Ma/{material}/Fractions sum to {sum(fractions):.6g}, not 1")
+        if f"Ma/{material}/Density" not in symbol_table:
+            report.errors.append(f"{components_definition.location} Ma/{material} has no Density")
+
+
+def check_scorer_components(symbol_table: Dict[str, ParameterDefinition], report: PreflightReport):
+    # A group has no volume of its own, so a scorer placed in one records nothing
+    for name, definition in symbol_table.items():
+        if not name.startswith("Sc/") or not name.endswith("/Component"):
+            continue
+        component = read_string_value(definition)
+        type_definition = symbol_table.get(f"Ge/{component}/Type")
+        if type_definition is not None and read_string_value(type_definition) == "Group":
+            report.errors.append(f"{definition.location} {name} is the group {component}, which has no volume to score in")
+
+
+def check_run_script(geometry_lines: List[str], script_lines: List[str], base_parameters_lines: Optional[List[str]]=None) -> PreflightReport:
+    # The geometry is checked with its own line numbers and the generated settings with the run script's.
+    # A run script that includes a base parameters file is checked together with it, the geometry then being in the base file.
+    report = PreflightReport()
+    definitions = parse_parameter_lines(list(enumerate(geometry_lines, start=1)), GEOMETRY_SOURCE_NAME, report)
+    if base_parameters_lines is not None:
+        definitions += parse_parameter_lines(split_generated_lines(base_parameters_lines, geometry_lines), BASE_PARAMETERS_SOURCE_NAME, report)
+    definitions += parse_parameter_lines(split_generated_lines(script_lines, geometry_lines), GENERATED_SOURCE_NAME, report)
+    symbol_table = build_symbol_table(definitions, report)
+    components = list_components(symbol_table)
+    check_values(symbol_table, report)
+    check_units(symbol_table, report)
+    check_references(symbol_table, report)
+    check_components(symbol_table, components, report)
+    check_materials(symbol_table, components, report)
+    check_scorer_components(symbol_table, report)
+    report.number_of_parameters = len(symbol_table)
+    report.number_of_components = len(components)
+    return report
+
+
+def run_preflight_checks(geometry_lines: List[str], script_lines: List[str], base_parameters_lines: Optional[List[str]]=None) -> PreflightReport:
+    start_time = time.perf_counter()
+    report = check_run_script(geometry_lines, script_lines, base_parameters_lines)
+    for warning in report.warnings:
+        print(f"Pre-flight warning -> {warning}")
+    if report.errors:
+        raise ValueError(f"Pre-flight checks found {len(report.errors)} problems with the geometry and experiment parameters:\n"
+                         + "\n".join(report.errors))
+    print(f"Pre-flight checks passed -> {report.number_of_parameters} parameters, {report.number_of_components} components "
+          f"({(time.perf_counter() - start_time) * 1000:.1f} ms)")
+    return report
@@ -0,0 +1,98 @@
+import os
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath, DERIVED_SCRIPT_PATTERN
+from topas_wrapper.result_cache import hash_script_lines
+from topas_wrapper.scorer_output import validate_scorer_output
+
+STALE_FOLDERNAME = "stale"
+
+
+def hash_run_script(script_path: Path) -> Optional[str]:
+    # A script that no longer reads, such as one whose included base file is gone, counts as changed
+    try:
+        return hash_script_lines(read_script_lines(script_path))
+    except (OSError, ValueError):
+        return None
+
+
+def find_run_name(filepath: Path) -> str:
+    # Logs, shard and retry scripts, outputs and their hidden sidecars all start with the name of their run
+    return DERIVED_SCRIPT_PATTERN.sub("", Path(filepath).name.lstrip(".").split(".")[0])
+
+
+def hash_run_scripts(scripts_folder: Path, excluded_filenames: Iterable[str]=()) -> Dict[str, Optional[str]]:
+    excluded_filenames = set(excluded_filenames)
+    return {script_path.stem: hash_run_script(script_path) for script_path in sorted(Path(scripts_folder).glob("*.txt"))
+            if script_path.name not in excluded_filenames and DERIVED_SCRIPT_PATTERN.search(script_path.stem) is None}
+
+
+def index_files_by_run_name(folder: Path) -> Dict[str, List[Path]]:
+    files_by_run_name = {}
+    for filepath in sorted(Path(folder).iterdir()):
+        if filepath.is_file():
+            files_by_run_name.setdefault(find_run_name(filepath), []).append(filepath)
+    return files_by_run_name
+
+
+def retire_files(filepaths: Iterable[Path], folder: Path) -> int:
+    # Stale files are moved rather than deleted, so a superseded result can still be recovered by hand
+    stale_folder = Path(folder) / STALE_FOLDERNAME
+    number_of_files = 0
+    for filepath in filepaths:
+        stale_folder.mkdir(exist_ok=True)
+        os.replace(filepath, stale_folder / filepath.name)
+        number_of_files += 1
+    return number_of_files
+
+
+def retire_run(run_name: str, script_files_by_run_name: Dict[str, List[Path]], data_files_by_run_name: Dict[str, List[Path]],
+               scripts_folder: Path, data_folder: Path, kept_script_filename: Optional[str]=None) -> int:
+    # Everything a run produced goes, and its run script too unless the run is still part of the sweep
+    script_files = [filepath for filepath in script_files_by_run_name.pop(run_name, []) if filepath.name != kept_script_filename]
+    return (retire_files(script_files, scripts_folder)
+            + retire_files(data_files_by_run_name.pop(run_name, []), data_folder))
+
+
+def iterate_regenerated_scripts(script_paths: Iterable[Path],
+                                previous_script_hashes: Dict[str, Optional[str]],
+                                scripts_folder: Path,
+                                data_folder: Path) -> Iterator[Path]:
+    # Compares each newly written script with the one it replaced. A changed run has its outputs, logs and
+    # derived scripts moved to a stale folder before it is yielded, an unchanged run keeps its data, and once
+    # the sweep is exhausted the runs that are no longer part of it are retired together with their scripts.
+    # The folders are indexed before the first script is yielded, so outputs of runs started since are never touched.
+    previous_script_hashes = dict(previous_script_hashes)
+    script_files_by_run_name = index_files_by_run_name(scripts_folder)
+    data_files_by_run_name = index_files_by_run_name(data_folder)
+    number_of_new_runs = 0
+    number_of_changed_runs = 0
+    number_of_unchanged_runs = 0
+    number_of_stale_files = 0
+    for script_path in script_paths:
+        run_name = script_path.stem
+        if run_name not in previous_script_hashes:
+            number_of_new_runs += 1
+        elif previous_script_hashes.pop(run_name) != hash_run_script(script_path):
+            number_of_changed_runs += 1
+        else:
+            number_of_unchanged_runs += 1
+            script_files_by_run_name.pop(run_name, None)
+            data_files_by_run_name.pop(run_name, None)
+        # A new run can still find leftovers under its name, such as outputs whose script was deleted by hand
+        number_of_stale_files += retire_run(run_name, script_files_by_run_name, data_files_by_run_name,
+                                            scripts_folder, data_folder, kept_script_filename=script_path.name)
+        yield script_path
+    for run_name in previous_script_hashes:
+        number_of_stale_files += retire_run(run_name, script_files_by_run_name, data_files_by_run_name, scripts_folder, data_folder)
+    print(f"Regenerated incrementally -> {number_of_new_runs} new, {number_of_changed_runs} changed, {number_of_unchanged_runs} unchanged "
+          f"and {len(previous_script_hashes)} removed runs, {number_of_stale_files} stale files moved to {STALE_FOLDERNAME}/")
+
+
+def has_valid_output(script_path: Path) -> bool:
+    # Only an unchanged run keeps its output through an incremental regeneration, so a valid one is up to date
+    try:
+        output_filepath = read_output_filepath(read_script_lines(script_path))
+    except (OSError, ValueError):
+        return False
+    return validate_scorer_output(output_filepath)
@@ -0,0 +1,98 @@
+import hashlib
+import os
+import re
+import shutil
+import uuid
+from pathlib import Path
+from typing import List, Optional
+from topas_wrapper.file_structure import FileStructure
+from topas_wrapper.script_reader import read_script_lines, OUTPUT_FILE_PATTERN
+
+SEED_FROM_TIME_PATTERN = re.compile(r'^b:Ts/SeedFromTime\s*=\s*"?True"?', re.IGNORECASE)
+
+
+def locate_result_cache_folder(relative_filepath: str=FileStructure.RESULT_CACHE.value) -> Path:
+    mod_path = Path(__file__).parent
+    return (mod_path / relative_filepath).resolve()
+
+
+def find_output_files(output_filepath: Path) -> List[Path]:
+    # TOPAS appends the extension for the output type (.csv, or .bin and .binheader) to OutputFile
+    output_filepath = Path(output_filepath)
+    if not output_filepath.parent.exists():
+        return []
+    return sorted(path for path in output_filepath.parent.glob(f"{output_filepath.name}.*") if path.is_file())
+
+
+def hash_script_lines(script_lines: List[str]) -> str:
+    # The output location is the only part of a rendered script that does not affect the result
+    hasher = hashlib.sha256()
+    for line in script_lines:
+        stripped_line = line.strip()
+        if OUTPUT_FILE_PATTERN.match(stripped_line):
+            continue
+        hasher.update(stripped_line.encode())
+        hasher.update(b"\n")
+    return hasher.hexdigest()
+
+
+def compute_script_hash(script_lines: List[str]) -> Optional[str]:
+    # Runs seeded from the clock are not reproducible, so they are never cached
+    if any(SEED_FROM_TIME_PATTERN.match(line.strip()) for line in script_lines):
+        return None
+    return hash_script_lines(script_lines)
+
+
+def link_or_copy(source: Path, destination: Path):
+    if destination.exists():
+        destination.unlink()
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy2(source, destination)
+
+
+class ResultCache:
+    def __init__(self, cache_folder: Optional[Path]=None):
+        self.cache_folder = locate_result_cache_folder() if cache_folder is None else Path(cache_folder).resolve()
+
+    def entry_folder(self, script_hash: str) -> Path:
+        return self.cache_folder / script_hash[:2] / script_hash
+
+    def key_for_script(self, script_path: Path) -> Optional[str]:
+        return compute_script_hash(read_script_lines(script_path))
+
+    def retrieve(self, script_hash: Optional[str], output_filepath: Path) -> bool:
+        if script_hash is None:
+            return False
+        entry_folder = self.entry_folder(script_hash)
+        if not entry_folder.is_dir():
+            return False
+        cached_files = sorted(entry_folder.iterdir())
+        if not cached_files:
+            return False
+        output_filepath = Path(output_filepath)
+        output_filepath.parent.mkdir(parents=True, exist_ok=True)
+        for cached_file in cached_files:
+            link_or_copy(cached_file, output_filepath.parent / f"{output_filepath.name}{cached_file.suffix}")
+        return True
+
+    def store(self, script_hash: Optional[str], output_filepath: Path) -> bool:
+        if script_hash is None:
+            return False
+        output_files = find_output_files(output_filepath)
+        if not output_files:
+            return False
+        entry_folder = self.entry_folder(script_hash)
+        if entry_folder.exists():
+            return True
+        # Fill a private folder first and rename it into place so readers never see a partial entry
+        staging_folder = entry_folder.parent / f".{script_hash}.{uuid.uuid4().hex}"
+        staging_folder.mkdir(parents=True)
+        for output_file in output_files:
+            link_or_copy(output_file, staging_folder / f"output{output_file.suffix}")
+        try:
+            staging_folder.rename(entry_folder)
+        except OSError:
+            shutil.rmtree(staging_folder)
+        return True
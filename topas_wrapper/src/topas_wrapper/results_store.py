@@ -0,0 +1,175 @@
+import argparse
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Dict, List, Optional
+import numpy as np
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.script_generator import BASE_PARAMETERS_FILENAME, EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath, read_parameter_value, DERIVED_SCRIPT_PATTERN
+from topas_wrapper.scorer_output import ScorerOutput, parse_scorer_header, load_scorer_output
+from topas_wrapper.create_file_structure import locate_experiment_folder
+from topas_wrapper.result_cache import find_output_files
+from topas_wrapper.file_structure import FileStructure
+
+RESULTS_STORE_FOLDERNAME = "results_store"
+METADATA_FILENAME = "metadata.npy"
+HEADER_FILENAME = "header.json"
+RUN_METADATA_DTYPE = np.dtype([("run_name", "U128"),
+                               ("beam_energy", np.float64),
+                               ("beam_energy_unit", "U8"),
+                               ("beam_energy_spread", np.float64),
+                               ("number_of_histories", np.int64),
+                               ("seed", np.int64),
+                               ("number_of_threads", np.int64)])
+
+
+def create_statistic_filename(statistic_name: str) -> str:
+    return f"{statistic_name}.npy"
+
+
+def list_run_scripts(scripts_folder: Path) -> List[Path]:
+    # Shard, batch and retry scripts only feed the output of their run script, which is what gets stored
+    return sorted(script_path for script_path in Path(scripts_folder).glob("*.txt")
+                  if script_path.name != BASE_PARAMETERS_FILENAME and DERIVED_SCRIPT_PATTERN.search(script_path.stem) is None)
+
+
+def read_required_parameter(script_lines: List[str], parameter_name: str, script_path: Path) -> str:
+    value = read_parameter_value(script_lines, parameter_name)
+    if value is None:
+        raise ValueError(f"The script does not set {parameter_name} -> {script_path}")
+    return value
+
+
+def read_run_metadata(script_path: Path, particle_source_component: str) -> np.ndarray:
+    # The parameters are read from what the script actually ran with, not decoded from its filename.
+    # A seed of 0 marks a run seeded from the clock, matching seed_number in the experiment parameters.
+    script_lines = read_script_lines(script_path)
+    beam_energy, beam_energy_unit = read_required_parameter(script_lines, f"So/{particle_source_component}/BeamEnergy", script_path).split()
+    seed = read_parameter_value(script_lines, "Ts/Seed")
+    run_metadata = np.zeros((), dtype=RUN_METADATA_DTYPE)
+    run_metadata["run_name"] = read_output_filepath(script_lines).name
+    run_metadata["beam_energy"] = float(beam_energy)
+    run_metadata["beam_energy_unit"] = beam_energy_unit
+    run_metadata["beam_energy_spread"] = float(read_required_parameter(script_lines, f"So/{particle_source_component}/BeamEnergySpread", script_path))
+    run_metadata["number_of_histories"] = int(read_required_parameter(script_lines, f"So/{particle_source_component}/NumberOfHistoriesInRun", script_path))
+    run_metadata["seed"] = 0 if seed is None else int(seed)
+    run_metadata["number_of_threads"] = int(read_required_parameter(script_lines, "Ts/NumberOfThreads", script_path))
+    return run_metadata
+
+
+class ResultsStore:
+    # One (run, x, y, z) array per statistic plus a metadata table with a row per run, sorted by
+    # (beam_energy, number_of_histories, seed). Statistics are memory-mapped, so opening the store reads
+    # only the metadata and a query reads only the rows and bins it slices.
+    def __init__(self, store_folder: Path):
+        self.store_folder = Path(store_folder)
+        metadata_filepath = self.store_folder / METADATA_FILENAME
+        if not metadata_filepath.exists():
+            raise FileNotFoundError(f"No results store exists at location -> {self.store_folder}")
+        self.metadata = np.load(metadata_filepath, allow_pickle=False)
+        self.header = parse_scorer_header(json.loads((self.store_folder / HEADER_FILENAME).read_text())["header_lines"])
+        self._statistics: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.metadata)
+
+    @property
+    def statistic_names(self) -> List[str]:
+        return self.header.statistic_names
+
+    def __getitem__(self, statistic_name: str) -> np.ndarray:
+        if statistic_name not in self.header.statistic_names:
+            raise KeyError(f"The results store has no statistic {statistic_name}, only {', '.join(self.header.statistic_names)}.")
+        if statistic_name not in self._statistics:
+            self._statistics[statistic_name] = np.load(self.store_folder / create_statistic_filename(statistic_name), mmap_mode="r")
+        return self._statistics[statistic_name]
+
+    def select(self, beam_energy: Optional[float]=None, number_of_histories: Optional[int]=None, seed: Optional[int]=None) -> np.ndarray:
+        # Row indices of the runs matching every given parameter, in store order
+        mask = np.ones(len(self.metadata), dtype=bool)
+        if beam_energy is not None:
+            mask &= np.isclose(self.metadata["beam_energy"], beam_energy)
+        if number_of_histories is not None:
+            mask &= self.metadata["number_of_histories"] == number_of_histories
+        if seed is not None:
+            mask &= self.metadata["seed"] == seed
+        return np.flatnonzero(mask)
+
+    def load(self, statistic_name: str, rows: np.ndarray) -> np.ndarray:
+        return np.asarray(self[statistic_name][rows])
+
+    def scorer_output(self, row: int) -> ScorerOutput:
+        statistics = {statistic_name: self[statistic_name][row] for statistic_name in self.header.statistic_names}
+        return ScorerOutput(self.header, statistics, self.store_folder / str(self.metadata["run_name"][row]))
+
+
+def locate_results_store_folder(experiment_folder: Path) -> Path:
+    return Path(experiment_folder) / RESULTS_STORE_FOLDERNAME
+
+
+def ingest_experiment(experiment_folder: Path, particle_source_component: str) -> ResultsStore:
+    # Runs are copied in one at a time into preallocated memory-mapped arrays, so ingesting never holds
+    # more than a single run in memory. The store is built beside the old one and swapped in once complete.
+    experiment_folder = Path(experiment_folder)
+    runs = []
+    for script_path in list_run_scripts(experiment_folder / "scripts"):
+        output_filepath = read_output_filepath(read_script_lines(script_path))
+        if not find_output_files(output_filepath):
+            print(f"No output for {script_path.name}, skipping it.")
+            continue
+        runs.append((read_run_metadata(script_path, particle_source_component), output_filepath))
+    if not runs:
+        raise FileNotFoundError(f"No scorer output to ingest exists at location -> {experiment_folder / 'data'}")
+    metadata = np.array([run_metadata for run_metadata, _ in runs], dtype=RUN_METADATA_DTYPE)
+    order = np.argsort(metadata, order=["beam_energy", "number_of_histories", "seed"], kind="stable")
+
+    store_folder = locate_results_store_folder(experiment_folder)
+    staging_folder = store_folder.parent / f".{store_folder.name}.{os.getpid()}.tmp"
+    shutil.rmtree(staging_folder, ignore_errors=True)
+    staging_folder.mkdir()
+    try:
+        reference_header = None
+        statistic_arrays = {}
+        for row, run_index in enumerate(order):
+            scorer_output = load_scorer_output(runs[run_index][1])
+            if reference_header is None:
+                reference_header = scorer_output.header
+                for statistic_name in reference_header.statistic_names:
+                    statistic_arrays[statistic_name] = np.lib.format.open_memmap(staging_folder / create_statistic_filename(statistic_name),
+                                                                                 mode="w+", dtype=np.float64,
+                                                                                 shape=(len(order),) + reference_header.shape)
+            elif scorer_output.shape != reference_header.shape or scorer_output.header.statistic_names != reference_header.statistic_names:
+                raise ValueError(f"The scorer output at {scorer_output.source_path} does not match the binning and statistics of the rest of the experiment.")
+            for statistic_name, statistic_array in statistic_arrays.items():
+                statistic_array[row] = scorer_output[statistic_name]
+        for statistic_array in statistic_arrays.values():
+            statistic_array.flush()
+        del statistic_arrays
+        np.save(staging_folder / METADATA_FILENAME, metadata[order])
+        (staging_folder / HEADER_FILENAME).write_text(json.dumps({"header_lines": reference_header.header_lines}, indent=4))
+        shutil.rmtree(store_folder, ignore_errors=True)
+        os.replace(staging_folder, store_folder)
+    except BaseException:
+        shutil.rmtree(staging_folder, ignore_errors=True)
+        raise
+    print(f"Ingested {len(order)} runs -> {store_folder}")
+    return ResultsStore(store_folder)
+
+
+def open_results_store(experiment_name: str) -> ResultsStore:
+    experiment_folder = locate_experiment_folder(experiment_name, FileStructure.EXPERIMENTS.value)
+    return ResultsStore(locate_results_store_folder(experiment_folder))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Consolidate an experiment's scorer outputs into one indexed results store.")
+    parser.add_argument("experiment_name")
+    arguments = parser.parse_args()
+    experiment_folder = locate_experiment_folder(arguments.experiment_name, FileStructure.EXPERIMENTS.value)
+    experiment_parameters = ExperimentParameters.from_json(experiment_folder / EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME)
+    ingest_experiment(experiment_folder, experiment_parameters.particle_source.component)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,330 @@
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+from topas_wrapper.get_data import load_experiment_parameters, ExperimentParameters
+from topas_wrapper.script_generator import generate_scripts, EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME
+from topas_wrapper.result_cache import ResultCache
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+from topas_wrapper.sharding import ShardedRun, shard_scripts, index_shard_scripts, mark_shard_complete, merge_sharded_run, load_sharded_run
+from topas_wrapper.scorer_output import validate_scorer_output, check_scorer_output_complete
+from topas_wrapper.manifest import RunManifest
+from topas_wrapper.regeneration import has_valid_output
+from topas_wrapper.create_file_structure import locate_experiment_folder
+from topas_wrapper.file_structure import FileStructure
+from topas_wrapper.input_constants import RunStatus
+from topas_wrapper.simulation_jobs import SimulationJob, SimulationResult, resolve_core_budget, cores_required
+from topas_wrapper.telemetry import TelemetryLedger
+
+TOPAS_EXECUTABLE = "topas"
+POLL_INTERVAL_SECONDS = 0.05
+# ru_maxrss is in kilobytes on Linux and bytes on macOS
+MAXIMUM_RSS_UNIT_BYTES = 1 if sys.platform == "darwin" else 1024
+
+
+@dataclass
+class RunningSimulation:
+    job: SimulationJob
+    process: subprocess.Popen
+    cores: int
+    start_time: float
+    log_path: Path
+    script_hash: Optional[str] = None
+    cpu_time: Optional[float] = None
+    peak_rss: Optional[int] = None
+
+
+def locate_topas_executable(topas_executable: str=TOPAS_EXECUTABLE) -> str:
+    executable_path = shutil.which(topas_executable)
+    if executable_path is None:
+        raise FileNotFoundError(f"No TOPAS executable found for -> {topas_executable}. \nAdd TOPAS to PATH or pass the full path to the executable.")
+    return executable_path
+
+
+def create_log_filepath(script_path: Path) -> Path:
+    return script_path.with_suffix(".log")
+
+
+def retrieve_cached_result(job: SimulationJob, result_cache: ResultCache) -> Tuple[Optional[str], bool]:
+    script_hash = result_cache.key_for_script(job.script_path)
+    output_filepath = read_output_filepath(read_script_lines(job.script_path))
+    return script_hash, result_cache.retrieve(script_hash, output_filepath)
+
+
+def store_cached_result(simulation: RunningSimulation, result_cache: ResultCache):
+    output_filepath = read_output_filepath(read_script_lines(simulation.job.script_path))
+    result_cache.store(simulation.script_hash, output_filepath)
+
+
+def validate_job_output(job: SimulationJob) -> bool:
+    try:
+        output_filepath = read_output_filepath(read_script_lines(job.script_path))
+    except (OSError, ValueError):
+        return False
+    return check_scorer_output_complete(output_filepath)
+
+
+def launch_simulation(job: SimulationJob, executable_path: str, cores: int) -> RunningSimulation:
+    script_path = Path(job.script_path).resolve()
+    log_path = create_log_filepath(script_path)
+    with log_path.open("w") as log_file:
+        process = subprocess.Popen([executable_path, str(script_path)],
+                                   cwd=script_path.parent,
+                                   stdout=log_file,
+                                   stderr=subprocess.STDOUT)
+    return RunningSimulation(job, process, cores, time.monotonic(), log_path)
+
+
+def reap_process(process: subprocess.Popen) -> Optional[Tuple[float, int]]:
+    # Reaps the process with wait4 rather than Popen.poll so its CPU time and peak memory are kept.
+    # Returns None while the process is still running.
+    pid, wait_status, resource_usage = os.wait4(process.pid, os.WNOHANG)
+    if pid == 0:
+        return None
+    process.returncode = os.waitstatus_to_exitcode(wait_status)
+    return resource_usage.ru_utime + resource_usage.ru_stime, resource_usage.ru_maxrss * MAXIMUM_RSS_UNIT_BYTES
+
+
+def poll_simulation(simulation: RunningSimulation) -> bool:
+    resource_usage = reap_process(simulation.process)
+    if resource_usage is None:
+        return False
+    simulation.cpu_time, simulation.peak_rss = resource_usage
+    return True
+
+
+def iterate_simulations(jobs: Iterable[SimulationJob],
+                        core_budget: Optional[int]=None,
+                        topas_executable: str=TOPAS_EXECUTABLE,
+                        lookahead: Optional[int]=None,
+                        result_cache: Optional[ResultCache]=None,
+                        manifest: Optional[RunManifest]=None) -> Iterator[SimulationResult]:
+    # Jobs are pulled lazily and packed first-fit from a window of queued jobs so the threads
+    # of all running jobs never exceed the core budget. Results are yielded as processes exit.
+    # Jobs whose script is already in the result cache are served from it without launching TOPAS.
+    # A run only succeeds when TOPAS exits cleanly and its output is complete.
+    executable_path = locate_topas_executable(topas_executable)
+    core_budget = resolve_core_budget(core_budget)
+    lookahead = core_budget if lookahead is None else max(lookahead, 1)
+
+    job_iterator = iter(jobs)
+    queued_jobs: Deque[SimulationJob] = deque()
+    running_simulations: Dict[int, RunningSimulation] = {}
+    script_hashes: Dict[Path, Optional[str]] = {}
+    cores_in_use = 0
+    jobs_exhausted = False
+
+    try:
+        while True:
+            while not jobs_exhausted and len(queued_jobs) < lookahead:
+                job = next(job_iterator, None)
+                if job is None:
+                    jobs_exhausted = True
+                    break
+                cores_required(job.number_of_threads, core_budget)
+                if result_cache is not None:
+                    script_hash, cache_hit = retrieve_cached_result(job, result_cache)
+                    if cache_hit:
+                        if manifest is not None:
+                            manifest.mark_finished(job.script_path, 0, RunStatus.completed, 0.0)
+                        yield SimulationResult(job, 0, 0.0, None, cached=True)
+                        continue
+                    script_hashes[job.script_path] = script_hash
+                queued_jobs.append(job)
+
+            for job in list(queued_jobs):
+                cores = cores_required(job.number_of_threads, core_budget)
+                if cores_in_use + cores > core_budget:
+                    continue
+                queued_jobs.remove(job)
+                running_simulation = launch_simulation(job, executable_path, cores)
+                running_simulation.script_hash = script_hashes.pop(job.script_path, None)
+                if manifest is not None:
+                    manifest.mark_running(job.script_path)
+                running_simulations[running_simulation.process.pid] = running_simulation
+                cores_in_use += cores
+
+            if not running_simulations:
+                if jobs_exhausted and not queued_jobs:
+                    return
+                continue
+
+            finished_simulations = [simulation for simulation in running_simulations.values() if poll_simulation(simulation)]
+            if not finished_simulations:
+                time.sleep(POLL_INTERVAL_SECONDS)
+                continue
+
+            for simulation in finished_simulations:
+                del running_simulations[simulation.process.pid]
+                cores_in_use -= simulation.cores
+                wall_time = time.monotonic() - simulation.start_time
+                return_code = simulation.process.returncode
+                output_valid = return_code == 0 and validate_job_output(simulation.job)
+                if result_cache is not None and output_valid:
+                    store_cached_result(simulation, result_cache)
+                if manifest is not None:
+                    status = RunStatus.completed if output_valid else RunStatus.failed
+                    manifest.mark_finished(simulation.job.script_path, return_code, status, wall_time)
+                yield SimulationResult(simulation.job, return_code, wall_time, simulation.log_path, output_valid=output_valid,
+                                       cpu_time=simulation.cpu_time, peak_rss=simulation.peak_rss)
+    finally:
+        for simulation in running_simulations.values():
+            simulation.process.kill()
+            simulation.process.wait()
+
+
+def run_simulations(jobs: Iterable[SimulationJob],
+                    core_budget: Optional[int]=None,
+                    topas_executable: str=TOPAS_EXECUTABLE,
+                    result_cache: Optional[ResultCache]=None,
+                    manifest: Optional[RunManifest]=None) -> List[SimulationResult]:
+    results = []
+    for result in iterate_simulations(jobs, core_budget, topas_executable, result_cache=result_cache, manifest=manifest):
+        report_simulation_result(result)
+        results.append(result)
+    report_simulation_summary(results)
+    return results
+
+
+def report_simulation_result(result: SimulationResult):
+    if result.cached:
+        print(f"Simulation retrieved from cache -> {result.job.script_path.name}")
+    elif result.succeeded:
+        print(f"Simulation successful -> {result.job.script_path.name} ({result.wall_time:.1f} s)")
+    elif result.timed_out:
+        print(f"Simulation timed out after {result.attempts} attempt(s) -> {result.job.script_path.name}. \nSee log -> {result.log_path}")
+    elif result.return_code == 0:
+        print(f"Simulation output missing or incomplete -> {result.job.script_path.name}. \nSee log -> {result.log_path}")
+    else:
+        print(f"Simulation failed with exit code {result.return_code} -> {result.job.script_path.name}. \nSee log -> {result.log_path}")
+
+
+def report_simulation_summary(results: List[SimulationResult]):
+    number_of_failures = sum(not result.succeeded for result in results)
+    print(f"{len(results) - number_of_failures} of {len(results)} simulations successful.")
+
+
+def run_sharded_simulations(script_paths: Iterable[Path],
+                            experiment_parameters: ExperimentParameters,
+                            topas_executable: str=TOPAS_EXECUTABLE,
+                            result_cache: Optional[ResultCache]=None,
+                            manifest: Optional[RunManifest]=None,
+                            telemetry_ledger: Optional[TelemetryLedger]=None) -> List[SimulationResult]:
+    sharded_runs = list(shard_scripts(script_paths,
+                                      experiment_parameters.number_of_shards,
+                                      experiment_parameters.seed_number,
+                                      experiment_parameters.particle_source.component))
+    if manifest is not None:
+        for sharded_run in sharded_runs:
+            manifest.register_all(sharded_run.shard_script_paths, sharded_run.script_path)
+    shard_script_paths = [shard_script_path for sharded_run in sharded_runs for shard_script_path in sharded_run.shard_script_paths]
+    return run_experiment_jobs(sharded_runs, shard_script_paths, experiment_parameters, topas_executable, result_cache, manifest, telemetry_ledger)
+
+
+def run_experiment_jobs(sharded_runs: List[ShardedRun],
+                        script_paths: List[Path],
+                        experiment_parameters: ExperimentParameters,
+                        topas_executable: str=TOPAS_EXECUTABLE,
+                        result_cache: Optional[ResultCache]=None,
+                        manifest: Optional[RunManifest]=None,
+                        telemetry_ledger: Optional[TelemetryLedger]=None) -> List[SimulationResult]:
+    # Shards are scheduled like any other job; a run's outputs are merged into its own
+    # output file as soon as its last shard finishes. Every result goes into the telemetry ledger.
+    sharded_run_by_script = index_shard_scripts(sharded_runs)
+    jobs = create_simulation_jobs(script_paths, experiment_parameters.number_of_threads)
+    results = []
+    for result in iterate_simulations(jobs, experiment_parameters.core_budget, topas_executable, result_cache=result_cache, manifest=manifest):
+        report_simulation_result(result)
+        results.append(result)
+        if telemetry_ledger is not None:
+            telemetry_ledger.record(result, experiment_parameters)
+        sharded_run = sharded_run_by_script.get(result.job.script_path)
+        if sharded_run is None or not result.succeeded:
+            continue
+        merged_output_filepath = mark_shard_complete(sharded_run, result.job.script_path)
+        if merged_output_filepath is not None:
+            print(f"Shards merged -> {merged_output_filepath.name}")
+    report_simulation_summary(results)
+    return results
+
+
+def create_simulation_jobs(script_paths: Iterable[Path], number_of_threads: int) -> Iterator[SimulationJob]:
+    for script_path in script_paths:
+        yield SimulationJob(Path(script_path), number_of_threads)
+
+
+def run_experiment(experiment_parameters: ExperimentParameters,
+                   topas_executable: str=TOPAS_EXECUTABLE,
+                   telemetry_ledger: Optional[TelemetryLedger]=None) -> List[SimulationResult]:
+    script_paths = generate_scripts(experiment_parameters)
+    result_cache = ResultCache() if experiment_parameters.use_result_cache else None
+    manifest = RunManifest(script_paths[0].parent.parent) if script_paths else None
+    telemetry_ledger = TelemetryLedger() if telemetry_ledger is None else telemetry_ledger
+    if experiment_parameters.regenerate_incrementally:
+        # Unchanged runs kept their outputs, so only new and changed runs are simulated
+        script_paths = [script_path for script_path in script_paths if not has_valid_output(script_path)]
+    try:
+        if experiment_parameters.number_of_shards > 1:
+            return run_sharded_simulations(script_paths, experiment_parameters, topas_executable, result_cache, manifest, telemetry_ledger)
+        if manifest is not None:
+            manifest.register_all(script_paths)
+        return run_experiment_jobs([], script_paths, experiment_parameters, topas_executable, result_cache, manifest, telemetry_ledger)
+    finally:
+        if manifest is not None:
+            manifest.close()
+        telemetry_ledger.close()
+
+
+def resume_experiment(experiment_name: str,
+                      topas_executable: str=TOPAS_EXECUTABLE,
+                      telemetry_ledger: Optional[TelemetryLedger]=None) -> List[SimulationResult]:
+    # Re-runs every job the manifest does not hold as completed with a valid output,
+    # using the parameters snapshot taken when the experiment's scripts were generated
+    experiment_folder = locate_experiment_folder(experiment_name, FileStructure.EXPERIMENTS.value)
+    experiment_parameters = ExperimentParameters.from_json(experiment_folder / EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME)
+    result_cache = ResultCache() if experiment_parameters.use_result_cache else None
+    manifest = RunManifest(experiment_folder)
+    telemetry_ledger = TelemetryLedger() if telemetry_ledger is None else telemetry_ledger
+    try:
+        entries = [entry for entry in manifest.entries() if entry.script_path.exists()]
+        incomplete_script_paths = [entry.script_path for entry in entries
+                                   if entry.status != RunStatus.completed or not validate_scorer_output(entry.output_path)]
+        print(f"Resuming -> {experiment_folder} with {len(incomplete_script_paths)} of {len(entries)} runs left to simulate.")
+
+        shard_script_paths_by_parent = {}
+        for entry in entries:
+            if entry.parent_script_path is not None:
+                shard_script_paths_by_parent.setdefault(entry.parent_script_path, []).append(entry.script_path)
+        sharded_runs = [load_sharded_run(parent_script_path, shard_script_paths, experiment_parameters.particle_source.component)
+                        for parent_script_path, shard_script_paths in shard_script_paths_by_parent.items()]
+        for sharded_run in sharded_runs:
+            sharded_run.completed_shards = [shard_script_path not in incomplete_script_paths for shard_script_path in sharded_run.shard_script_paths]
+            if sharded_run.complete and not validate_scorer_output(sharded_run.output_filepath):
+                merge_sharded_run(sharded_run)
+        return run_experiment_jobs(sharded_runs, incomplete_script_paths, experiment_parameters, topas_executable, result_cache, manifest, telemetry_ledger)
+    finally:
+        manifest.close()
+        telemetry_ledger.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate and run the TOPAS simulations described by EXPERIMENT_PARAMETERS.toml.")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("run", help="Generate the experiment's scripts and run them (default).")
+    resume_parser = subparsers.add_parser("resume", help="Re-run only the missing or failed runs of an existing experiment.")
+    resume_parser.add_argument("experiment_name")
+    arguments = parser.parse_args()
+    if arguments.command == "resume":
+        resume_experiment(arguments.experiment_name)
+        return
+    experiment_parameters = load_experiment_parameters()
+    run_experiment(experiment_parameters)
+
+if __name__=="__main__":
+    main()
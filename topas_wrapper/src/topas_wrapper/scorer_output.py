@@ -0,0 +1,370 @@
+import os
+import re
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from topas_wrapper.get_data import Scorer
+
+AXIS_PATTERN = re.compile(r'^#\s*(?P<axis>\w+) in (?P<number_of_bins>\d+) bins?\s+of (?P<bin_width>\S+) (?P<unit>\S+)')
+QUANTITY_PATTERN = re.compile(r'^#\s*(?P<quantity>\w+)\s*(\(\s*(?P<unit>[^)]*?)\s*\))?\s*:\s*(?P<statistics>.+)$')
+NUMBER_OF_INDEX_COLUMNS = 3
+TAIL_BLOCK_SIZE = 4096
+
+
+@dataclass
+class ScorerAxis:
+    name: str
+    number_of_bins: int
+    bin_width: float
+    unit: str
+
+    @property
+    def bin_centres(self) -> np.ndarray:
+        return (np.arange(self.number_of_bins) + 0.5) * self.bin_width
+
+
+@dataclass
+class ScorerHeader:
+    quantity: str
+    unit: Optional[str]
+    axes: List[ScorerAxis]
+    statistic_names: List[str]
+    header_lines: List[str]
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return tuple(axis.number_of_bins for axis in self.axes)
+
+
+@dataclass
+class ScorerOutput:
+    header: ScorerHeader
+    statistics: Dict[str, np.ndarray]
+    source_path: Path
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.header.shape
+
+    def __getitem__(self, statistic_name: str) -> np.ndarray:
+        return self.statistics[statistic_name]
+
+
+def parse_scorer_header(header_lines: List[str]) -> ScorerHeader:
+    axes = []
+    quantity = None
+    unit = None
+    statistic_names = []
+    for line in header_lines:
+        axis_match = AXIS_PATTERN.match(line)
+        if axis_match is not None:
+            axes.append(ScorerAxis(axis_match.group("axis"),
+                                   int(axis_match.group("number_of_bins")),
+                                   float(axis_match.group("bin_width")),
+                                   axis_match.group("unit")))
+            continue
+        if len(axes) == NUMBER_OF_INDEX_COLUMNS and quantity is None:
+            quantity_match = QUANTITY_PATTERN.match(line)
+            if quantity_match is not None:
+                quantity = quantity_match.group("quantity")
+                unit = quantity_match.group("unit")
+                statistic_names = quantity_match.group("statistics").split()
+    if len(axes) != NUMBER_OF_INDEX_COLUMNS:
+        raise ValueError(f"Expected {NUMBER_OF_INDEX_COLUMNS} binning lines in the scorer header, found {len(axes)}.")
+    if quantity is None or not statistic_names:
+        raise ValueError("The scorer header has no quantity and statistics line.")
+    return ScorerHeader(quantity, unit, axes, statistic_names, list(header_lines))
+
+
+def read_header_lines(filepath: Path) -> List[str]:
+    header_lines = []
+    with Path(filepath).open("r") as f:
+        for line in f:
+            if not line.startswith("#"):
+                break
+            header_lines.append(line.rstrip("\n"))
+    return header_lines
+
+
+def read_last_line(filepath: Path) -> str:
+    # Reads back from the end in blocks, so only the final line is read however large the file is.
+    # A file that does not end in a newline is still being written, so it has no complete last line.
+    with Path(filepath).open("rb") as f:
+        end = f.seek(0, os.SEEK_END)
+        start = end
+        tail = b""
+        while start > 0 and tail.count(b"\n") < 2:
+            start = max(start - TAIL_BLOCK_SIZE, 0)
+            f.seek(start)
+            tail = f.read(end - start)
+    if not tail.endswith(b"\n"):
+        return ""
+    return tail[:-1].rsplit(b"\n", 1)[-1].decode(errors="replace")
+
+
+def check_scorer_csv_complete(header: ScorerHeader, filepath: Path):
+    # TOPAS writes one row per bin in index order, so an output is only complete once its last row is the last bin
+    last_fields = read_last_line(filepath).split(",")
+    number_of_columns = NUMBER_OF_INDEX_COLUMNS + len(header.statistic_names)
+    last_bin = [number_of_bins - 1 for number_of_bins in header.shape]
+    try:
+        last_row_indices = [int(field) for field in last_fields[:NUMBER_OF_INDEX_COLUMNS]]
+    except ValueError:
+        last_row_indices = None
+    if len(last_fields) != number_of_columns or last_row_indices != last_bin:
+        raise ValueError(f"The scorer output at {filepath} is incomplete. \nExpected a last row of {number_of_columns} columns for bin {last_bin}.")
+
+
+def check_scorer_binary_complete(header: ScorerHeader, filepath: Path):
+    expected_size = int(np.prod(header.shape)) * len(header.statistic_names) * np.dtype(np.float64).itemsize
+    actual_size = filepath.stat().st_size
+    if actual_size != expected_size:
+        raise ValueError(f"The scorer output at {filepath} is incomplete. \nExpected {expected_size} bytes, found {actual_size}.")
+
+
+def check_shape_against_scorer(header: ScorerHeader, scorer: Optional[Scorer], filepath: Path):
+    if scorer is None:
+        return
+    expected_shape = tuple(1 if bins is None else bins for bins in (scorer.x_bins, scorer.y_bins, scorer.z_bins))
+    if header.shape != expected_shape:
+        raise ValueError(f"The scorer output at {filepath} has bins {header.shape} but the scorer config expects {expected_shape}.")
+
+
+def parse_scorer_csv(filepath: Path) -> ScorerOutput:
+    filepath = Path(filepath)
+    header = parse_scorer_header(read_header_lines(filepath))
+    number_of_columns = NUMBER_OF_INDEX_COLUMNS + len(header.statistic_names)
+    try:
+        rows = np.loadtxt(filepath, delimiter=",", comments="#", ndmin=2, dtype=np.float64)
+    except ValueError as e:
+        raise ValueError(f"The scorer output at {filepath} could not be parsed, it may be incomplete. \n{e}")
+    number_of_bins = int(np.prod(header.shape))
+    if rows.shape[0] != number_of_bins or (rows.size and rows.shape[1] != number_of_columns):
+        raise ValueError(f"The scorer output at {filepath} is incomplete. \nExpected {number_of_bins} rows of {number_of_columns} columns, found an array of shape {rows.shape}.")
+    flat_indices = np.ravel_multi_index(tuple(rows[:, i].astype(np.intp) for i in range(NUMBER_OF_INDEX_COLUMNS)), header.shape)
+    statistics = {}
+    for column, statistic_name in enumerate(header.statistic_names, start=NUMBER_OF_INDEX_COLUMNS):
+        values = np.empty(number_of_bins, dtype=np.float64)
+        values[flat_indices] = rows[:, column]
+        statistics[statistic_name] = values.reshape(header.shape)
+    return ScorerOutput(header, statistics, filepath)
+
+
+def create_sidecar_filepath(filepath: Path) -> Path:
+    # Hidden so the sidecar is never picked up as one of the run's own output files
+    filepath = Path(filepath)
+    return filepath.parent / f".{filepath.name}.npz"
+
+
+def load_sidecar(filepath: Path, sidecar_filepath: Path) -> Optional[ScorerOutput]:
+    if not sidecar_filepath.exists():
+        return None
+    source_stat = filepath.stat()
+    try:
+        with np.load(sidecar_filepath, allow_pickle=False) as sidecar:
+            if int(sidecar["source_mtime_ns"]) != source_stat.st_mtime_ns or int(sidecar["source_size"]) != source_stat.st_size:
+                return None
+            header = parse_scorer_header(list(sidecar["header_lines"]))
+            values = sidecar["values"]
+    except (OSError, ValueError, KeyError):
+        return None
+    statistics = {statistic_name: values[i] for i, statistic_name in enumerate(header.statistic_names)}
+    return ScorerOutput(header, statistics, filepath)
+
+
+def save_sidecar(scorer_output: ScorerOutput, sidecar_filepath: Path):
+    source_stat = scorer_output.source_path.stat()
+    values = np.stack([scorer_output.statistics[name] for name in scorer_output.header.statistic_names])
+    temporary_filepath = sidecar_filepath.parent / f"{sidecar_filepath.name}.{os.getpid()}.tmp"
+    try:
+        with temporary_filepath.open("wb") as f:
+            np.savez(f,
+                     source_mtime_ns=np.int64(source_stat.st_mtime_ns),
+                     source_size=np.int64(source_stat.st_size),
+                     header_lines=np.array(scorer_output.header.header_lines),
+                     values=values)
+        os.replace(temporary_filepath, sidecar_filepath)
+    except OSError:
+        # A read-only data folder only costs the speedup, the parsed output is still returned
+        temporary_filepath.unlink(missing_ok=True)
+
+
+def load_scorer_csv(filepath: Path, scorer: Optional[Scorer]=None, use_sidecar: bool=True) -> ScorerOutput:
+    filepath = Path(filepath)
+    if not filepath.exists():
+        raise FileNotFoundError(f"No scorer output exists at location -> {filepath}.")
+    sidecar_filepath = create_sidecar_filepath(filepath)
+    scorer_output = load_sidecar(filepath, sidecar_filepath) if use_sidecar else None
+    if scorer_output is None:
+        scorer_output = parse_scorer_csv(filepath)
+        if use_sidecar:
+            save_sidecar(scorer_output, sidecar_filepath)
+    check_shape_against_scorer(scorer_output.header, scorer, filepath)
+    return scorer_output
+
+
+def open_scorer_binary(filepath: Path, scorer: Optional[Scorer]=None) -> ScorerOutput:
+    # TOPAS writes one float64 per statistic for every bin, bins in (x, y, z) order with z fastest.
+    # Each statistic is a strided view into the memmap, so nothing is read until it is sliced.
+    filepath = Path(filepath)
+    header_filepath = filepath.with_suffix(".binheader")
+    if not filepath.exists() or not header_filepath.exists():
+        raise FileNotFoundError(f"Binary scorer output needs both {filepath.name} and {header_filepath.name} at location -> {filepath.parent}.")
+    header = parse_scorer_header(read_header_lines(header_filepath))
+    number_of_statistics = len(header.statistic_names)
+    check_scorer_binary_complete(header, filepath)
+    values = np.memmap(filepath, dtype=np.float64, mode="r", shape=header.shape + (number_of_statistics,))
+    statistics = {statistic_name: values[..., i] for i, statistic_name in enumerate(header.statistic_names)}
+    check_shape_against_scorer(header, scorer, filepath)
+    return ScorerOutput(header, statistics, filepath)
+
+
+def locate_scorer_file(output_filepath: Path) -> Path:
+    # Accepts the OutputFile path written into the script, which has no extension, or the file itself
+    output_filepath = Path(output_filepath)
+    if output_filepath.suffix in (".bin", ".binheader"):
+        return output_filepath.with_suffix(".bin")
+    if output_filepath.suffix == ".csv":
+        return output_filepath
+    binary_filepath = output_filepath.parent / f"{output_filepath.name}.bin"
+    if binary_filepath.exists():
+        return binary_filepath
+    return output_filepath.parent / f"{output_filepath.name}.csv"
+
+
+def load_scorer_output(output_filepath: Path, scorer: Optional[Scorer]=None, use_sidecar: bool=True) -> ScorerOutput:
+    # Binary output is memory-mapped rather than loaded, CSV output is parsed through the sidecar cache
+    filepath = locate_scorer_file(output_filepath)
+    if filepath.suffix == ".bin":
+        return open_scorer_binary(filepath, scorer)
+    return load_scorer_csv(filepath, scorer, use_sidecar)
+
+
+def combine_statistics(scorer_outputs: List[ScorerOutput], numbers_of_histories: List[int]) -> Dict[str, np.ndarray]:
+    # Per-history statistics are combined with history weighting. TOPAS accumulates the second
+    # moment about the mean and divides it by N - 1 for the variance, so the moments are pooled
+    # with the parallel-variance formula before the variance and standard deviation are rebuilt.
+    statistic_names = scorer_outputs[0].header.statistic_names
+    histories = np.asarray(numbers_of_histories, dtype=np.float64)
+    total_histories = histories.sum()
+    if total_histories <= 0:
+        raise ValueError("Scorer outputs can only be combined when they have at least one history between them.")
+
+    def means_of(scorer_output: ScorerOutput, number_of_histories: float) -> np.ndarray:
+        if "Mean" in scorer_output.statistics:
+            return np.asarray(scorer_output["Mean"])
+        if "Sum" in scorer_output.statistics:
+            return np.asarray(scorer_output["Sum"]) / max(number_of_histories, 1)
+        raise ValueError("Per-history statistics can only be combined when Mean or Sum is scored.")
+
+    def second_moments_of(scorer_output: ScorerOutput, number_of_histories: float) -> np.ndarray:
+        if "Second_Moment" in scorer_output.statistics:
+            return np.asarray(scorer_output["Second_Moment"])
+        if "Variance" in scorer_output.statistics:
+            return np.asarray(scorer_output["Variance"]) * max(number_of_histories - 1, 0)
+        return np.square(np.asarray(scorer_output["Standard_Deviation"])) * max(number_of_histories - 1, 0)
+
+    combined = {}
+    needs_moments = any(name in statistic_names for name in ("Mean", "Second_Moment", "Variance", "Standard_Deviation"))
+    if needs_moments:
+        means = [means_of(output, n) for output, n in zip(scorer_outputs, histories)]
+        combined_mean = sum(n * mean for n, mean in zip(histories, means)) / total_histories
+        combined_second_moment = sum(second_moments_of(output, n) + n * np.square(mean - combined_mean)
+                                     for output, n, mean in zip(scorer_outputs, histories, means))
+        combined_variance = combined_second_moment / max(total_histories - 1, 1)
+
+    for statistic_name in statistic_names:
+        if statistic_name in ("Sum", "Count_in_Bin", "Histories_with_Scorer_Active"):
+            combined[statistic_name] = sum(np.asarray(output[statistic_name]) for output in scorer_outputs)
+        elif statistic_name == "Mean":
+            combined[statistic_name] = combined_mean
+        elif statistic_name == "Second_Moment":
+            combined[statistic_name] = combined_second_moment
+        elif statistic_name == "Variance":
+            combined[statistic_name] = combined_variance
+        elif statistic_name == "Standard_Deviation":
+            combined[statistic_name] = np.sqrt(combined_variance)
+        elif statistic_name == "Max":
+            combined[statistic_name] = np.maximum.reduce([np.asarray(output[statistic_name]) for output in scorer_outputs])
+        elif statistic_name == "Min":
+            combined[statistic_name] = np.minimum.reduce([np.asarray(output[statistic_name]) for output in scorer_outputs])
+        else:
+            raise ValueError(f"Combining the scorer statistic {statistic_name} is not supported.")
+    return combined
+
+
+def merge_scorer_outputs(scorer_outputs: List[ScorerOutput], numbers_of_histories: List[int]) -> ScorerOutput:
+    if not scorer_outputs:
+        raise ValueError("At least one scorer output is needed to merge.")
+    if len(scorer_outputs) != len(numbers_of_histories):
+        raise ValueError(f"Got {len(scorer_outputs)} scorer outputs but {len(numbers_of_histories)} numbers of histories.")
+    reference_header = scorer_outputs[0].header
+    for scorer_output in scorer_outputs[1:]:
+        if scorer_output.shape != reference_header.shape or scorer_output.header.statistic_names != reference_header.statistic_names:
+            raise ValueError(f"The scorer output at {scorer_output.source_path} does not match the binning and statistics of {scorer_outputs[0].source_path}.")
+    statistics = combine_statistics(scorer_outputs, numbers_of_histories)
+    return ScorerOutput(reference_header, statistics, scorer_outputs[0].source_path)
+
+
+def write_scorer_csv(scorer_output: ScorerOutput, filepath: Path):
+    filepath = Path(filepath)
+    header = scorer_output.header
+    indices = np.indices(header.shape).reshape(NUMBER_OF_INDEX_COLUMNS, -1).T
+    values = np.column_stack([np.asarray(scorer_output[name]).reshape(-1) for name in header.statistic_names])
+    row_format = ", ".join(["%d"] * NUMBER_OF_INDEX_COLUMNS + ["%.10g"] * len(header.statistic_names))
+    temporary_filepath = filepath.parent / f".{filepath.name}.{os.getpid()}.tmp"
+    with temporary_filepath.open("w") as f:
+        for line in header.header_lines:
+            f.write(f"{line}\n")
+        np.savetxt(f, np.column_stack([indices, values]), fmt=row_format)
+    os.replace(temporary_filepath, filepath)
+
+
+def write_scorer_binary(scorer_output: ScorerOutput, filepath: Path):
+    filepath = Path(filepath)
+    header_filepath = filepath.with_suffix(".binheader")
+    header = scorer_output.header
+    values = np.stack([np.asarray(scorer_output[name], dtype=np.float64) for name in header.statistic_names], axis=-1)
+    temporary_filepath = filepath.parent / f".{filepath.name}.{os.getpid()}.tmp"
+    temporary_header_filepath = filepath.parent / f".{header_filepath.name}.{os.getpid()}.tmp"
+    values.tofile(temporary_filepath)
+    temporary_header_filepath.write_text("".join(f"{line}\n" for line in header.header_lines))
+    # The header goes first, so a .bin is never seen beside a half-written or missing header
+    os.replace(temporary_header_filepath, header_filepath)
+    os.replace(temporary_filepath, filepath)
+
+
+def write_scorer_output(scorer_output: ScorerOutput, output_filepath: Path, binary: bool=False) -> Path:
+    # Written in the TOPAS layout and moved into place once complete, so readers treat merged and simulated output alike
+    output_filepath = Path(output_filepath)
+    if binary:
+        filepath = output_filepath.parent / f"{output_filepath.name}.bin"
+        write_scorer_binary(scorer_output, filepath)
+    else:
+        filepath = output_filepath.parent / f"{output_filepath.name}.csv"
+        write_scorer_csv(scorer_output, filepath)
+    return filepath
+
+
+def validate_scorer_output(output_filepath: Path) -> bool:
+    # A run only counts as complete once its output parses in full, so partly written files are rejected
+    try:
+        load_scorer_output(output_filepath)
+    except (OSError, ValueError):
+        return False
+    return True
+
+
+def check_scorer_output_complete(output_filepath: Path) -> bool:
+    # Reads only the header and the end of the data, so it is cheap enough to run on every finished run while
+    # the scheduler waits on the others. The values are left to be checked when the output is first loaded.
+    try:
+        filepath = locate_scorer_file(output_filepath)
+        if filepath.suffix == ".bin":
+            check_scorer_binary_complete(parse_scorer_header(read_header_lines(filepath.with_suffix(".binheader"))), filepath)
+        else:
+            check_scorer_csv_complete(parse_scorer_header(read_header_lines(filepath)), filepath)
+    except (OSError, ValueError):
+        return False
+    return True
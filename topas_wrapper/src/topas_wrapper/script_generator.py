@@ -1,14 +1,17 @@
-import os
-import subprocess
 import json
-from typing import List
+import csv
+from typing import Iterable, Iterator, List, Tuple
+from dataclasses import dataclass
 from pathlib import Path
 from itertools import product
 from topas_wrapper.get_data import locate_experiment_config_file
 from topas_wrapper.get_data import load_experiment_parameters, ParticleSource, ExperimentPhysicsList, Scorer, ExperimentParameters
-from topas_wrapper.create_file_structure import create_file_structure, create_filename, create_output_filepath
+from topas_wrapper.create_file_structure import create_file_structure, create_filename, create_output_filepath, create_run_name, create_sweep_run_name
 from topas_wrapper.file_structure import FileStructure
-from topas_wrapper.input_constants import EnergyUnit
+from topas_wrapper.input_constants import EnergyUnit, ScriptGenerationMode
+from topas_wrapper.preflight import run_preflight_checks
+from topas_wrapper.regeneration import hash_run_scripts, iterate_regenerated_scripts
+from topas_wrapper.sweeps import iterate_sweep_points, apply_sweep_point, format_sweep_value, resolve_sweep_axes, report_sweep_sampling
 
 
 def generate_number_of_threads_text(number_of_threads: int) -> List[str]:
@@ -35,15 +38,29 @@ def load_experiment_geometry_text() -> List[str]:
     return geometry_lines
 
 
-def generate_particle_source_text(particle_source: ParticleSource, beam_energy: float, beam_energy_spread: float) -> List[str]:
+def generate_particle_source_header_text(particle_source: ParticleSource) -> List[str]:
     component = particle_source.component
-    particle_source_text = [
+    particle_source_header_text = [
         "!!!particle-source-start!!!",
         f's:So/{component}/Type = "{particle_source.type.value}"',
         f's:So/{component}/Component = "{particle_source.component}"',
-        f's:So/{component}/BeamParticle = "{particle_source.beam_particle.value}"',
+        f's:So/{component}/BeamParticle = "{particle_source.beam_particle.value}"'
+    ]
+    return particle_source_header_text
+
+
+def generate_beam_energy_text(particle_source: ParticleSource, beam_energy: float, beam_energy_spread: float) -> List[str]:
+    component = particle_source.component
+    beam_energy_text = [
         f'd:So/{component}/BeamEnergy = {beam_energy:.2f} {particle_source.beam_energy_unit.value}',
-        f'u:So/{component}/BeamEnergySpread = {beam_energy_spread:.2f}',
+        f'u:So/{component}/BeamEnergySpread = {beam_energy_spread:.2f}'
+    ]
+    return beam_energy_text
+
+
+def generate_particle_source_footer_text(particle_source: ParticleSource) -> List[str]:
+    component = particle_source.component
+    particle_source_footer_text = [
         f's:So/{component}/BeamPositionDistribution = "{particle_source.beam_position_distribution.value}"',
         f's:So/{component}/BeamPositionCutoffShape = "{particle_source.beam_position_cutoff_shape.value}"',
         f'd:So/{component}/BeamPositionCutoffX = {particle_source.beam_position_cutoff_x} {particle_source.beam_position_cutoff_x_units.value}',
@@ -57,18 +74,25 @@ def generate_particle_source_text(particle_source: ParticleSource, beam_energy:
         f'd:So/{component}/BeamAngularSpreadY = {particle_source.beam_angular_spread_y} {particle_source.beam_angular_spread_y_units.value}',
         "!!!particle-source-end!!!"
     ]
+    return particle_source_footer_text
+
+
+def generate_particle_source_text(particle_source: ParticleSource, beam_energy: float, beam_energy_spread: float) -> List[str]:
+    particle_source_text = generate_particle_source_header_text(particle_source)
+    particle_source_text += generate_beam_energy_text(particle_source, beam_energy, beam_energy_spread)
+    particle_source_text += generate_particle_source_footer_text(particle_source)
     return particle_source_text
 
 
 def generate_physics_lists_text(physics_list: ExperimentPhysicsList) -> List[str]:
     modules = physics_list.modules
     number_of_modules = len(modules)
-    string_of_modules = " ".join(f'"{module}"' for module in modules)
+    string_of_modules = " ".join(f'"{module.value}"' for module in modules)
     physics_list_text = [
         '!!!physics-lists-start!!!',
         f's:Ph/ListName = "{physics_list.list_name}"',
         f'b:Ph/ListProcesses = "{physics_list.list_processes}"',
-        f's:Ph/{physics_list.list_name}/Type = "{physics_list.type}"',
+        f's:Ph/{physics_list.list_name}/Type = "{physics_list.type.value}"',
         f'sv:Ph/{physics_list.list_name}/Modules = {number_of_modules} {string_of_modules}',
         f'd:Ph/{physics_list.list_name}/EMRangeMin = {physics_list.EM_range_min} {physics_list.EM_range_min_units.value}',
         f'd:Ph/{physics_list.list_name}/EMRangeMax = {physics_list.EM_range_max} {physics_list.EM_range_max_units.value}',
@@ -77,9 +101,9 @@ def generate_physics_lists_text(physics_list: ExperimentPhysicsList) -> List[str
     return physics_list_text
 
 
-def generate_scoring_text(scorer: Scorer, data_folder: Path, beam_energy: float, beam_energy_units: EnergyUnit, number_of_histories: int) -> List[str]:
+def generate_scorer_settings_text(scorer: Scorer) -> List[str]:
     scorer_text = [
-        '!!!scorer-start!!!'
+        '!!!scorer-start!!!',
         f's:Sc/Scorer/Quantity = "{scorer.quantity.value}"',
         f's:Sc/Scorer/Component = "{scorer.component}"',
         f'b:Sc/Scorer/OutputToConsole = "False"'
@@ -94,9 +118,19 @@ def generate_scoring_text(scorer: Scorer, data_folder: Path, beam_energy: float,
         scorer_text.append(f'i:Sc/Scorer/YBins = {scorer.y_bins}')
     if scorer.z_bins is not None:
         scorer_text.append(f'i:Sc/Scorer/ZBins = {scorer.z_bins}')
+    if scorer.output_type is not None:
+        scorer_text.append(f's:Sc/Scorer/OutputType = "{scorer.output_type.value}"')
+    return scorer_text
+
+
+def generate_scorer_output_text(output_filepath: Path) -> List[str]:
+    return [f's:Sc/Scorer/OutputFile = "{output_filepath}"', '!!!scorer-end!!!']
+
+
+def generate_scoring_text(scorer: Scorer, data_folder: Path, beam_energy: float, beam_energy_units: EnergyUnit, number_of_histories: int) -> List[str]:
+    scorer_text = generate_scorer_settings_text(scorer)
     output_filepath = create_output_filepath(data_folder, beam_energy, beam_energy_units, number_of_histories)
-    scorer_text.append(f's:Sc/Scorer/OutputFile = "{output_filepath}"')
-    scorer_text.append('!!!scorer-end!!!')
+    scorer_text += generate_scorer_output_text(output_filepath)
     return scorer_text
 
 
@@ -106,6 +140,9 @@ def generate_script(experiment_parameters: ExperimentParameters, energy_index: i
     number_of_threads_text = generate_number_of_threads_text(experiment_parameters.number_of_threads)
     script += number_of_threads_text
 
+    seed_number_text = generate_seed_number_text(experiment_parameters.seed_number)
+    script += seed_number_text
+
     number_of_histories = experiment_parameters.numbers_of_histories[number_of_histories_index]
     number_of_histories_text = generate_number_of_histories_text(number_of_histories, experiment_parameters.particle_source.component)
     script += number_of_histories_text
@@ -126,20 +163,155 @@ def generate_script(experiment_parameters: ExperimentParameters, energy_index: i
 
     return script
 
+def join_script_lines(script: List[str]) -> str:
+    return "".join(f"{line}\n" for line in script)
+
+
+@dataclass
+class CompiledSweepTemplate:
+    # Invariant blocks are rendered once per sweep; each run only fills in the histories,
+    # beam energy and output file lines between them.
+    data_folder: Path
+    run_settings_text: str
+    geometry_and_source_header_text: str
+    source_footer_physics_and_scorer_text: str
+    number_of_histories_texts: List[str]
+    beam_energy_texts: List[str]
+    run_names: List[List[str]]
+
+
+def compile_sweep_template(experiment_parameters: ExperimentParameters, data_folder: Path) -> CompiledSweepTemplate:
+    particle_source = experiment_parameters.particle_source
+    run_settings_text = generate_number_of_threads_text(experiment_parameters.number_of_threads)
+    run_settings_text += generate_seed_number_text(experiment_parameters.seed_number)
+    geometry_and_source_header_text = load_experiment_geometry_text()
+    geometry_and_source_header_text += generate_particle_source_header_text(particle_source)
+    source_footer_physics_and_scorer_text = generate_particle_source_footer_text(particle_source)
+    source_footer_physics_and_scorer_text += generate_physics_lists_text(experiment_parameters.physics_list)
+    source_footer_physics_and_scorer_text += generate_scorer_settings_text(experiment_parameters.scorer)
+
+    number_of_histories_texts = [join_script_lines(generate_number_of_histories_text(number_of_histories, particle_source.component))
+                                 for number_of_histories in experiment_parameters.numbers_of_histories]
+    beam_energy_texts = [join_script_lines(generate_beam_energy_text(particle_source, beam_energy, beam_energy_spread))
+                         for beam_energy, beam_energy_spread in zip(particle_source.beam_energy, particle_source.beam_energy_spreads)]
+    run_names = [[create_run_name(beam_energy, particle_source.beam_energy_unit, number_of_histories)
+                  for number_of_histories in experiment_parameters.numbers_of_histories]
+                 for beam_energy in particle_source.beam_energy]
+    return CompiledSweepTemplate(Path(data_folder).resolve(),
+                                 join_script_lines(run_settings_text),
+                                 join_script_lines(geometry_and_source_header_text),
+                                 join_script_lines(source_footer_physics_and_scorer_text),
+                                 number_of_histories_texts,
+                                 beam_energy_texts,
+                                 run_names)
+
+
+def render_compiled_script(template: CompiledSweepTemplate, energy_index: int, number_of_histories_index: int) -> str:
+    output_filepath = template.data_folder / template.run_names[energy_index][number_of_histories_index]
+    return "".join([template.run_settings_text,
+                    template.number_of_histories_texts[number_of_histories_index],
+                    template.geometry_and_source_header_text,
+                    template.beam_energy_texts[energy_index],
+                    template.source_footer_physics_and_scorer_text,
+                    join_script_lines(generate_scorer_output_text(output_filepath))])
+
+
+def iterate_compiled_scripts(template: CompiledSweepTemplate, combination_of_indices: Iterable[Tuple[int, int]]) -> Iterator[Tuple[str, str]]:
+    for energy_index, number_of_histories_index in combination_of_indices:
+        filename = f"{template.run_names[energy_index][number_of_histories_index]}.txt"
+        yield filename, render_compiled_script(template, energy_index, number_of_histories_index)
+
+
+BASE_PARAMETERS_FILENAME = "experiment_base_parameters.txt"
+EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME = "experiment_parameters.json"
+SWEEP_POINTS_FILENAME = "sweep_points.csv"
+
+
+def generate_base_parameters_text(experiment_parameters: ExperimentParameters) -> List[str]:
+    base_parameters_text = generate_seed_number_text(experiment_parameters.seed_number)
+    base_parameters_text += load_experiment_geometry_text()
+    base_parameters_text += generate_particle_source_header_text(experiment_parameters.particle_source)
+    base_parameters_text += generate_particle_source_footer_text(experiment_parameters.particle_source)
+    base_parameters_text += generate_physics_lists_text(experiment_parameters.physics_list)
+    base_parameters_text += generate_scorer_settings_text(experiment_parameters.scorer)
+    base_parameters_text.append('!!!scorer-end!!!')
+    return base_parameters_text
+
+
+def generate_include_file_script(experiment_parameters: ExperimentParameters, energy_index: int, number_of_histories_index: int,
+                                 data_folder: Path, base_parameters_filename: str=BASE_PARAMETERS_FILENAME) -> List[str]:
+    # The run script sits next to the base file and only holds what varies between runs;
+    # TOPAS gives parameters in the including file precedence over the included one
+    particle_source = experiment_parameters.particle_source
+    beam_energy = particle_source.beam_energy[energy_index]
+    beam_energy_spread = particle_source.beam_energy_spreads[energy_index]
+    number_of_histories = experiment_parameters.numbers_of_histories[number_of_histories_index]
+    output_filepath = create_output_filepath(data_folder, beam_energy, particle_source.beam_energy_unit, number_of_histories)
+
+    script = [f"includeFile = {base_parameters_filename}"]
+    script += generate_number_of_threads_text(experiment_parameters.number_of_threads)
+    script += generate_number_of_histories_text(number_of_histories, particle_source.component)
+    script += generate_beam_energy_text(particle_source, beam_energy, beam_energy_spread)
+    script.append(f's:Sc/Scorer/OutputFile = "{output_filepath}"')
+    return script
+
+
+def iterate_include_file_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path,
+                                 combination_of_indices: Iterable[Tuple[int, int]]) -> Iterator[Path]:
+    scripts_folder = Path(scripts_folder).resolve()
+    base_parameters_text = join_script_lines(generate_base_parameters_text(experiment_parameters))
+    write_script_text_to_file(base_parameters_text, scripts_folder, BASE_PARAMETERS_FILENAME)
+    particle_source = experiment_parameters.particle_source
+    for energy_index, number_of_histories_index in combination_of_indices:
+        script = generate_include_file_script(experiment_parameters, energy_index, number_of_histories_index, data_folder)
+        filename = create_filename(particle_source.beam_energy[energy_index],
+                                   particle_source.beam_energy_unit,
+                                   experiment_parameters.numbers_of_histories[number_of_histories_index])
+        yield write_script_text_to_file(join_script_lines(script), scripts_folder, filename)
+
+
+def generate_include_file_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path,
+                                  combination_of_indices: Iterable[Tuple[int, int]]) -> List[Path]:
+    return list(iterate_include_file_scripts(experiment_parameters, scripts_folder, data_folder, combination_of_indices))
+
+
 def write_script_to_file(script: List[int], script_folder_path: Path, filename: str):
-    filepath = (script_folder_path / filename).resolve()
-    with filepath.open("w") as f:
-        for line in script:
-            f.write(f"{line}\n")
+    write_script_text_to_file(join_script_lines(script), script_folder_path, filename)
 
 
-def generate_scripts(experiment_parameters: ExperimentParameters):
-    scripts_folder, data_folder, analysis_folder = create_file_structure(experiment_parameters.experiment_name,
-                                                                         FileStructure.EXPERIMENTS.value,
-                                                                         overwrite=experiment_parameters.overwrite_existing_experiment)
+def write_script_text_to_file(script_text: str, script_folder_path: Path, filename: str) -> Path:
+    # An identical script already on disk is left untouched, so regenerating only rewrites what changed
+    filepath = script_folder_path / filename
+    if filepath.is_file() and filepath.read_text() == script_text:
+        return filepath
+    filepath.write_text(script_text)
+    return filepath
+
+
+def iterate_written_compiled_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path,
+                                     combination_of_indices: Iterable[Tuple[int, int]]) -> Iterator[Path]:
+    template = compile_sweep_template(experiment_parameters, data_folder)
+    scripts_folder = Path(scripts_folder).resolve()
+    for filename, script_text in iterate_compiled_scripts(template, combination_of_indices):
+        yield write_script_text_to_file(script_text, scripts_folder, filename)
+
+
+def generate_compiled_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path,
+                              combination_of_indices: Iterable[Tuple[int, int]]) -> List[Path]:
+    return list(iterate_written_compiled_scripts(experiment_parameters, scripts_folder, data_folder, combination_of_indices))
+
+
+def write_experiment_parameters_snapshot(experiment_parameters: ExperimentParameters, experiment_folder: Path) -> Path:
+    # Lets an experiment be resumed with the parameters it was generated from, even after the TOML has changed
+    snapshot_filepath = Path(experiment_folder) / EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME
+    snapshot_filepath.write_text(experiment_parameters.model_dump_json(indent=4))
+    return snapshot_filepath
+
+
+def iterate_inline_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path,
+                           combination_of_indices: Iterable[Tuple[int, int]]) -> Iterator[Path]:
     beam_energies = experiment_parameters.particle_source.beam_energy
     numbers_of_histories = experiment_parameters.numbers_of_histories
-    combination_of_indices = [(i, j) for i, j in product(range(len(beam_energies)), range(len(numbers_of_histories)))]
     for index_combination in combination_of_indices:
         beam_energy_index = index_combination[0]
         number_of_histories_index = index_combination[1]
@@ -151,8 +323,99 @@ def generate_scripts(experiment_parameters: ExperimentParameters):
         script = generate_script(experiment_parameters, beam_energy_index, number_of_histories_index, data_folder)
         filename = create_filename(beam_energy, beam_energy_units, number_of_histories)
         write_script_to_file(script, scripts_folder, filename)
+        yield (scripts_folder / filename).resolve()
+
+
+def generate_sweep_point_script(run_parameters: ExperimentParameters, geometry_text: List[str], output_filepath: Path) -> List[str]:
+    particle_source = run_parameters.particle_source
+    script = generate_number_of_threads_text(run_parameters.number_of_threads)
+    script += generate_seed_number_text(run_parameters.seed_number)
+    script += generate_number_of_histories_text(run_parameters.numbers_of_histories[0], particle_source.component)
+    script += geometry_text
+    script += generate_particle_source_text(particle_source, particle_source.beam_energy[0], particle_source.beam_energy_spreads[0])
+    script += generate_physics_lists_text(run_parameters.physics_list)
+    script += generate_scorer_settings_text(run_parameters.scorer)
+    script += generate_scorer_output_text(output_filepath)
+    return script
+
+
+def iterate_sweep_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path) -> Iterator[Path]:
+    # Every point can change a different block, so each script is rendered whole. The parameters of each
+    # point are appended to sweep_points.csv as its script is written.
+    report_sweep_sampling(experiment_parameters)
+    scripts_folder = Path(scripts_folder).resolve()
+    data_folder = Path(data_folder).resolve()
+    parameters = [axis.parameter for axis in resolve_sweep_axes(experiment_parameters)]
+    geometry_text = load_experiment_geometry_text()
+    with (scripts_folder.parent / SWEEP_POINTS_FILENAME).open("w", newline="") as sweep_points_file:
+        writer = csv.writer(sweep_points_file)
+        writer.writerow(["run_name"] + [parameter.value for parameter in parameters])
+        for sweep_point_index, sweep_point in enumerate(iterate_sweep_points(experiment_parameters)):
+            run_name = create_sweep_run_name(sweep_point_index)
+            run_parameters = apply_sweep_point(experiment_parameters, sweep_point)
+            script = generate_sweep_point_script(run_parameters, geometry_text, data_folder / run_name)
+            script_path = write_script_text_to_file(join_script_lines(script), scripts_folder, f"{run_name}.txt")
+            writer.writerow([run_name] + [format_sweep_value(sweep_point[parameter]) for parameter in parameters])
+            sweep_points_file.flush()
+            yield script_path
+
+
+def iterate_experiment_scripts(experiment_parameters: ExperimentParameters, scripts_folder: Path, data_folder: Path) -> Iterator[Path]:
+    if experiment_parameters.sweep is not None:
+        yield from iterate_sweep_scripts(experiment_parameters, scripts_folder, data_folder)
+        return
+    beam_energies = experiment_parameters.particle_source.beam_energy
+    numbers_of_histories = experiment_parameters.numbers_of_histories
+    combination_of_indices = product(range(len(beam_energies)), range(len(numbers_of_histories)))
+    if experiment_parameters.script_generation_mode == ScriptGenerationMode.compiled:
+        yield from iterate_written_compiled_scripts(experiment_parameters, scripts_folder, data_folder, combination_of_indices)
+    elif experiment_parameters.script_generation_mode == ScriptGenerationMode.include_file:
+        yield from iterate_include_file_scripts(experiment_parameters, scripts_folder, data_folder, combination_of_indices)
+    else:
+        yield from iterate_inline_scripts(experiment_parameters, scripts_folder, data_folder, combination_of_indices)
+
+
+def check_first_run_script(experiment_parameters: ExperimentParameters):
+    # Renders the first run script the way iterate_experiment_scripts will write it, so the check sees what a
+    # sweep point or the include_file base parameters change, and checks it against the geometry
+    geometry_text = load_experiment_geometry_text()
+    data_folder = Path(".").resolve()
+    if experiment_parameters.sweep is not None:
+        run_parameters = apply_sweep_point(experiment_parameters, next(iterate_sweep_points(experiment_parameters)))
+        script = generate_sweep_point_script(run_parameters, geometry_text, data_folder / create_sweep_run_name(0))
+        return run_preflight_checks(geometry_text, script)
+    if experiment_parameters.script_generation_mode == ScriptGenerationMode.compiled:
+        script_text = render_compiled_script(compile_sweep_template(experiment_parameters, data_folder), 0, 0)
+        return run_preflight_checks(geometry_text, script_text.splitlines())
+    if experiment_parameters.script_generation_mode == ScriptGenerationMode.include_file:
+        return run_preflight_checks(geometry_text,
+                                    generate_include_file_script(experiment_parameters, 0, 0, data_folder),
+                                    generate_base_parameters_text(experiment_parameters))
+    return run_preflight_checks(geometry_text, generate_script(experiment_parameters, 0, 0, data_folder))
+
+
+def iterate_scripts(experiment_parameters: ExperimentParameters) -> Iterator[Path]:
+    # Each script is written just before its path is yielded, so a consumer can start running
+    # the first scripts while the rest of the sweep is still being generated. The first run script is checked
+    # against the geometry first, so a broken configuration fails before anything is written or queued.
+    check_first_run_script(experiment_parameters)
+    scripts_folder, data_folder, analysis_folder = create_file_structure(experiment_parameters.experiment_name,
+                                                                         FileStructure.EXPERIMENTS.value,
+                                                                         overwrite=experiment_parameters.overwrite_existing_experiment,
+                                                                         incremental=experiment_parameters.regenerate_incrementally)
+    # Taken before any script is rewritten, so the include_file base parameters are still the previous ones
+    previous_script_hashes = hash_run_scripts(scripts_folder, [BASE_PARAMETERS_FILENAME]) if experiment_parameters.regenerate_incrementally else None
+    write_experiment_parameters_snapshot(experiment_parameters, scripts_folder.parent)
+    script_paths = iterate_experiment_scripts(experiment_parameters, scripts_folder, data_folder)
+    if previous_script_hashes is not None:
+        script_paths = iterate_regenerated_scripts(script_paths, previous_script_hashes, scripts_folder, data_folder)
+    yield from script_paths
+
+
+def generate_scripts(experiment_parameters: ExperimentParameters):
+    script_paths = list(iterate_scripts(experiment_parameters))
     print("Scripts generation successful.")
-    return 
+    return script_paths
 
 def main():
     experiment_parameters = load_experiment_parameters()
@@ -160,76 +423,3 @@ def main():
 
 if __name__=="__main__":
     main()
-# # Define the numbers of histories
-# NUMBERS_OF_HISTORIES = [8000, 10000, 16000]
-# BASE_SCRIPT_PATH = 'convergence_testing_150MeV_slices.txt'
-
-# def main():
-#     # Directory to store the generated simulation scripts and outputs
-#     output_dir = 'results'
-#     os.makedirs(output_dir, exist_ok=True)
-
-#     # Read the base simulation script
-#     with open(BASE_SCRIPT_PATH, 'r') as file:
-#         base_script = file.read()
-
-#     # Store results for logging
-#     results = []
-
-#     # Loop over each energy value
-#     for number_of_histories in NUMBERS_OF_HISTORIES:
-#         if type(number_of_histories) is not int:
-#             print(f"NUMBER OF HISTORIES MUST BE AN INTEGER, not {number_of_histories} which is of type {type(number_of_histories)}.")
-#             return
-#         number_of_histories_string = f"{number_of_histories}"
-#         unique_block_name = f"ConvergenceTesting_150MeV_Histories_{number_of_histories_string}_slices"
-
-#         output_filename = f'output_histories_{number_of_histories}_slices.csv'
-#         output_path = os.path.join(output_dir, output_filename)
-
-#         modified_script = []
-#         scoring_block_started = False
-
-#         for line in base_script.splitlines():
-#             stripped = line.strip()
-
-#             # Replace number of histories
-#             if stripped.startswith('i:So/ProtonBeam/NumberOfHistoriesInRun'):
-#                 modified_script.append(f'i:So/ProtonBeam/NumberOfHistoriesInRun = {number_of_histories}')
-#             # Rename the scoring block
-#             elif 'Sc/ConvergenceTesting_150MeV' in stripped:
-#                 new_line = line.replace('ConvergenceTesting_150MeV', unique_block_name)
-#                 modified_script.append(new_line)
-#                 scoring_block_started = True
-#             # Add output file line directly below the scoring block header
-#             elif scoring_block_started and not stripped.startswith('#') and '/OutputFile' not in stripped:
-#                 modified_script.append(f's:Sc/{unique_block_name}/OutputFile = "{output_path}"')
-#                 scoring_block_started = False  # Insert only once
-#                 modified_script.append(line)
-#             else:
-#                 modified_script.append(line)
-
-#         modified_script_content = '\n'.join(modified_script)
-
-#         # Save the modified simulation script
-#         script_filename = f'histories_{number_of_histories}_script.txt'
-#         script_path = os.path.join(output_dir, script_filename)
-#         with open(script_path, 'w') as f:
-#             f.write(modified_script_content)
-
-#         # Run the TOPAS simulation
-#         try:
-#             subprocess.run(['/home/robin/topas/bin/topas', script_path], check=True)
-#             print(f"✅ Simulation for {number_of_histories} histories completed successfully.")
-#             # You could parse the output here to extract Bragg peak info
-#             results.append((output_path, number_of_histories_string, None, None))  # Placeholder for depth/uncertainty
-#         except subprocess.CalledProcessError as e:
-#             print(f"❌ Simulation for {number_of_histories} MeV failed: {e}")
-#             results.append((output_path, number_of_histories_string, 'FAILED', 'FAILED'))
-
-#     # Save paths and results to a summary file
-#     with open(os.path.join(output_dir, 'summary.csv'), 'w') as f:
-#         f.write('filepath,number_of_histories,bragg_peak_depth_mm,bragg_peak_uncertainty_mm\n')
-#         for row in results:
-#             f.write(','.join(str(x) for x in row) + '\n')
-
@@ -0,0 +1,49 @@
+import re
+from pathlib import Path
+from typing import List, Optional
+
+INCLUDE_FILE_PATTERN = re.compile(r'^includeFile\s*=\s*(?P<filenames>.+)$')
+OUTPUT_FILE_PATTERN = re.compile(r'^s:Sc/[^/\s]+/OutputFile\s*=\s*"(?P<output_filepath>[^"]*)"')
+PARAMETER_PATTERN = re.compile(r'^(?P<type>[a-z]+):(?P<name>[^\s=]+)\s*=\s*(?P<value>[^#]*?)\s*(#.*)?$')
+DERIVED_SCRIPT_PATTERN = re.compile(r'_(shard|batch|retry)_\d+$')
+
+
+def read_script_lines(script_path: Path, _included_from: Optional[List[Path]]=None) -> List[str]:
+    # includeFile lines are replaced by the lines of the files they name, resolved relative to the including script
+    script_path = Path(script_path).resolve()
+    included_from = [] if _included_from is None else _included_from
+    if script_path in included_from:
+        raise ValueError(f"Circular includeFile detected -> {' -> '.join(str(path) for path in included_from + [script_path])}")
+    script_lines = []
+    for line in script_path.read_text().splitlines():
+        match = INCLUDE_FILE_PATTERN.match(line.strip())
+        if match is None:
+            script_lines.append(line)
+            continue
+        for filename in match.group("filenames").split("#")[0].split():
+            included_path = script_path.parent / filename.strip('"')
+            if not included_path.exists():
+                raise FileNotFoundError(f"The file included by {script_path.name} does not exist -> {included_path}")
+            script_lines += read_script_lines(included_path, included_from + [script_path])
+    return script_lines
+
+
+def read_parameter_value(script_lines: List[str], parameter_name: str) -> Optional[str]:
+    # Later definitions win, which matches TOPAS giving an including file precedence over its includes
+    value = None
+    for line in script_lines:
+        match = PARAMETER_PATTERN.match(line.strip())
+        if match is not None and match.group("name") == parameter_name:
+            value = match.group("value")
+    return value
+
+
+def read_output_filepath(script_lines: List[str]) -> Path:
+    output_filepath = None
+    for line in script_lines:
+        match = OUTPUT_FILE_PATTERN.match(line.strip())
+        if match is not None:
+            output_filepath = Path(match.group("output_filepath"))
+    if output_filepath is None:
+        raise ValueError("The script has no scorer output file, so its results cannot be located.")
+    return output_filepath
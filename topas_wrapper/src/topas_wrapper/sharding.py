@@ -0,0 +1,115 @@
+import hashlib
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath, read_parameter_value
+from topas_wrapper.scorer_output import load_scorer_output, merge_scorer_outputs, write_scorer_output
+
+MAXIMUM_SEED = 2**31 - 1
+
+
+@dataclass
+class ShardedRun:
+    script_path: Path
+    output_filepath: Path
+    shard_script_paths: List[Path]
+    shard_output_filepaths: List[Path]
+    shard_numbers_of_histories: List[int]
+    completed_shards: List[bool] = field(default_factory=list)
+
+    @property
+    def complete(self) -> bool:
+        return all(self.completed_shards)
+
+
+def split_number_of_histories(number_of_histories: int, number_of_shards: int) -> List[int]:
+    # Shards that would get no histories are dropped rather than launched
+    quotient, remainder = divmod(number_of_histories, number_of_shards)
+    shard_numbers_of_histories = [quotient + (1 if i < remainder else 0) for i in range(number_of_shards)]
+    return [n for n in shard_numbers_of_histories if n > 0] or [0]
+
+
+def derive_seed(seed_number: int, *keys) -> int:
+    digest = hashlib.sha256(":".join(str(key) for key in (seed_number,) + keys).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % (MAXIMUM_SEED - 1) + 1
+
+
+def derive_shard_seed(seed_number: int, shard_index: int) -> int:
+    return derive_seed(seed_number, shard_index)
+
+
+def create_shard_name(run_name: str, shard_index: int) -> str:
+    return f"{run_name}_shard_{shard_index}"
+
+
+def generate_shard_script(run_script_filename: str, particle_source_component: str, seed_number: int,
+                          number_of_histories: int, output_filepath: Path) -> List[str]:
+    # The shard includes the full run script and overrides only its seed, histories and output file
+    return [f"includeFile = {run_script_filename}",
+            f"i:Ts/Seed = {seed_number}",
+            f"i:So/{particle_source_component}/NumberOfHistoriesInRun = {number_of_histories}",
+            f's:Sc/Scorer/OutputFile = "{output_filepath}"']
+
+
+def shard_script(script_path: Path, number_of_shards: int, seed_number: int, particle_source_component: str) -> ShardedRun:
+    script_path = Path(script_path).resolve()
+    script_lines = read_script_lines(script_path)
+    output_filepath = read_output_filepath(script_lines)
+    number_of_histories_value = read_parameter_value(script_lines, f"So/{particle_source_component}/NumberOfHistoriesInRun")
+    if number_of_histories_value is None:
+        raise ValueError(f"The script {script_path.name} does not set So/{particle_source_component}/NumberOfHistoriesInRun, so it cannot be sharded.")
+    shard_numbers_of_histories = split_number_of_histories(int(number_of_histories_value), number_of_shards)
+
+    shard_script_paths = []
+    shard_output_filepaths = []
+    for shard_index, shard_number_of_histories in enumerate(shard_numbers_of_histories):
+        shard_name = create_shard_name(script_path.stem, shard_index)
+        shard_output_filepath = output_filepath.parent / create_shard_name(output_filepath.name, shard_index)
+        shard_seed = derive_shard_seed(seed_number, shard_index)
+        shard_script_lines = generate_shard_script(script_path.name, particle_source_component, shard_seed,
+                                                   shard_number_of_histories, shard_output_filepath)
+        shard_script_path = script_path.parent / f"{shard_name}{script_path.suffix}"
+        shard_script_path.write_text("".join(f"{line}\n" for line in shard_script_lines))
+        shard_script_paths.append(shard_script_path)
+        shard_output_filepaths.append(shard_output_filepath)
+    return ShardedRun(script_path, output_filepath, shard_script_paths, shard_output_filepaths,
+                      shard_numbers_of_histories, [False] * len(shard_script_paths))
+
+
+def load_sharded_run(script_path: Path, shard_script_paths: List[Path], particle_source_component: str) -> ShardedRun:
+    # Rebuilds a sharded run from shard scripts already on disk, e.g. when resuming an experiment
+    script_path = Path(script_path)
+    output_filepath = read_output_filepath(read_script_lines(script_path))
+    shard_output_filepaths = []
+    shard_numbers_of_histories = []
+    for shard_script_path in shard_script_paths:
+        shard_script_lines = read_script_lines(shard_script_path)
+        shard_output_filepaths.append(read_output_filepath(shard_script_lines))
+        shard_numbers_of_histories.append(int(read_parameter_value(shard_script_lines, f"So/{particle_source_component}/NumberOfHistoriesInRun")))
+    return ShardedRun(script_path, output_filepath, list(shard_script_paths), shard_output_filepaths,
+                      shard_numbers_of_histories, [False] * len(shard_script_paths))
+
+
+def shard_scripts(script_paths: Iterable[Path], number_of_shards: int, seed_number: int, particle_source_component: str) -> Iterator[ShardedRun]:
+    for script_path in script_paths:
+        yield shard_script(script_path, number_of_shards, seed_number, particle_source_component)
+
+
+def merge_sharded_run(sharded_run: ShardedRun) -> Path:
+    shard_outputs = [load_scorer_output(shard_output_filepath, use_sidecar=False) for shard_output_filepath in sharded_run.shard_output_filepaths]
+    merged_output = merge_scorer_outputs(shard_outputs, sharded_run.shard_numbers_of_histories)
+    binary = shard_outputs[0].source_path.suffix == ".bin"
+    return write_scorer_output(merged_output, sharded_run.output_filepath, binary=binary)
+
+
+def index_shard_scripts(sharded_runs: Iterable[ShardedRun]) -> Dict[Path, ShardedRun]:
+    return {shard_script_path: sharded_run for sharded_run in sharded_runs for shard_script_path in sharded_run.shard_script_paths}
+
+
+def mark_shard_complete(sharded_run: ShardedRun, shard_script_path: Path) -> Optional[Path]:
+    # Merges the run once its last shard completes and returns the merged output, otherwise None
+    shard_index = sharded_run.shard_script_paths.index(shard_script_path)
+    sharded_run.completed_shards[shard_index] = True
+    if not sharded_run.complete:
+        return None
+    return merge_sharded_run(sharded_run)
@@ -0,0 +1,45 @@
+import os
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional
+
+
+@dataclass
+class SimulationJob:
+    script_path: Path
+    number_of_threads: int
+
+
+@dataclass
+class SimulationResult:
+    job: SimulationJob
+    return_code: int
+    wall_time: float
+    log_path: Optional[Path]
+    cached: bool = False
+    output_valid: bool = True
+    timed_out: bool = False
+    attempts: int = 1
+    cpu_time: Optional[float] = None
+    peak_rss: Optional[int] = None
+
+    @property
+    def succeeded(self) -> bool:
+        return self.return_code == 0 and self.output_valid
+
+
+def resolve_core_budget(core_budget: Optional[int]) -> int:
+    if core_budget is None:
+        return os.cpu_count() or 1
+    if core_budget < 1:
+        raise ValueError(f"The core budget must be at least one core, not {core_budget}.")
+    return core_budget
+
+
+def cores_required(number_of_threads: int, core_budget: int) -> int:
+    # Ts/NumberOfThreads = 0 makes TOPAS use every core, so the job takes the whole budget
+    if number_of_threads == 0:
+        return core_budget
+    if number_of_threads > core_budget:
+        raise ValueError(f"A job with Ts/NumberOfThreads = {number_of_threads} can never fit in a core budget of {core_budget}.")
+    return number_of_threads
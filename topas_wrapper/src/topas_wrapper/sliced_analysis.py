@@ -0,0 +1,129 @@
+import math
+from dataclasses import dataclass, field
+from typing import List, Optional, Sequence, Tuple
+import numpy as np
+from topas_wrapper.scorer_output import ScorerOutput
+
+DEFAULT_CHUNK_BYTES = 64 * 1024**2
+NUMBER_OF_AXES = 3
+Bounds = Tuple[Optional[Tuple[int, int]], ...]
+
+
+def resolve_bounds(bounds: Bounds, shape: Tuple[int, ...]) -> List[Tuple[int, int]]:
+    resolved_bounds = []
+    for axis, axis_bounds in enumerate(bounds):
+        lower, upper = (0, shape[axis]) if axis_bounds is None else axis_bounds
+        if not 0 <= lower < upper <= shape[axis]:
+            raise ValueError(f"Bounds {axis_bounds} are outside axis {axis}, which has {shape[axis]} bins.")
+        resolved_bounds.append((lower, upper))
+    return resolved_bounds
+
+
+@dataclass
+class BoxSum:
+    # Sums the grid inside a box over every axis not kept. Slices, projections, lateral
+    # profiles and ROI sums are all boxes that differ only in their bounds and kept axes.
+    keep_axes: Tuple[int, ...]
+    bounds: Bounds = (None, None, None)
+    result: Optional[np.ndarray] = field(default=None, init=False)
+    _bounds: Optional[List[Tuple[int, int]]] = field(default=None, init=False, repr=False)
+
+    def allocate(self, shape: Tuple[int, ...]):
+        self._bounds = resolve_bounds(self.bounds, shape)
+        result_shape = tuple(self._bounds[axis][1] - self._bounds[axis][0] for axis in sorted(self.keep_axes))
+        self.result = np.zeros(result_shape, dtype=np.float64)
+
+    def accumulate(self, chunk: np.ndarray, chunk_start: int):
+        (x_lower, x_upper), (y_lower, y_upper), (z_lower, z_upper) = self._bounds
+        overlap_lower = max(x_lower, chunk_start)
+        overlap_upper = min(x_upper, chunk_start + chunk.shape[0])
+        if overlap_lower >= overlap_upper:
+            return
+        box = chunk[overlap_lower - chunk_start:overlap_upper - chunk_start, y_lower:y_upper, z_lower:z_upper]
+        summed = box.sum(axis=tuple(axis for axis in range(NUMBER_OF_AXES) if axis not in self.keep_axes))
+        if 0 in self.keep_axes:
+            self.result[overlap_lower - x_lower:overlap_upper - x_lower] += summed
+        else:
+            self.result += summed
+
+    def chunk_alignment(self) -> int:
+        return 1
+
+
+@dataclass
+class Rebin:
+    # Sums blocks of factors bins together; a trailing partial block becomes a smaller final bin
+    factors: Tuple[int, int, int]
+    result: Optional[np.ndarray] = field(default=None, init=False)
+
+    def allocate(self, shape: Tuple[int, ...]):
+        if any(factor < 1 for factor in self.factors):
+            raise ValueError(f"Rebin factors must be at least one, not {self.factors}.")
+        self.result = np.zeros(tuple(math.ceil(size / factor) for size, factor in zip(shape, self.factors)), dtype=np.float64)
+
+    def accumulate(self, chunk: np.ndarray, chunk_start: int):
+        rebinned = chunk
+        for axis, factor in enumerate(self.factors):
+            if factor > 1:
+                rebinned = np.add.reduceat(rebinned, np.arange(0, rebinned.shape[axis], factor), axis=axis)
+        output_start = chunk_start // self.factors[0]
+        self.result[output_start:output_start + rebinned.shape[0]] += rebinned
+
+    def chunk_alignment(self) -> int:
+        return self.factors[0]
+
+
+def axis_slice(axis: int, index: int) -> BoxSum:
+    bounds = [None] * NUMBER_OF_AXES
+    bounds[axis] = (index, index + 1)
+    return BoxSum(tuple(other_axis for other_axis in range(NUMBER_OF_AXES) if other_axis != axis), tuple(bounds))
+
+
+def projection(keep_axes: Sequence[int]) -> BoxSum:
+    return BoxSum(tuple(keep_axes))
+
+
+def lateral_profile(axis: int, depth_bounds: Optional[Tuple[int, int]]=None) -> BoxSum:
+    # Profile along x (0) or y (1), summed over the other lateral axis and a window of depth bins
+    if axis not in (0, 1):
+        raise ValueError(f"A lateral profile runs along x (0) or y (1), not axis {axis}.")
+    return BoxSum((axis,), (None, None, depth_bounds))
+
+
+def roi_sum(x_bounds: Optional[Tuple[int, int]]=None,
+            y_bounds: Optional[Tuple[int, int]]=None,
+            z_bounds: Optional[Tuple[int, int]]=None) -> BoxSum:
+    return BoxSum((), (x_bounds, y_bounds, z_bounds))
+
+
+def rebin(x_factor: int=1, y_factor: int=1, z_factor: int=1) -> Rebin:
+    return Rebin((x_factor, y_factor, z_factor))
+
+
+def compute_chunk_planes(shape: Tuple[int, ...], itemsize: int, chunk_bytes: int, alignment: int) -> int:
+    plane_bytes = max(int(np.prod(shape[1:])) * itemsize, 1)
+    chunk_planes = max(chunk_bytes // plane_bytes, 1)
+    return max(chunk_planes // alignment, 1) * alignment
+
+
+def run_slice_pass(grid: np.ndarray, requests: Sequence, chunk_bytes: int=DEFAULT_CHUNK_BYTES) -> List[np.ndarray]:
+    # Reads the grid once, a block of x planes at a time, feeding every request from the same block.
+    # Peak memory is one float64 block plus the request results, however large the grid on disk is.
+    if grid.ndim != NUMBER_OF_AXES:
+        raise ValueError(f"Slicing needs an (x, y, z) grid, not an array with {grid.ndim} dimensions.")
+    shape = tuple(grid.shape)
+    # Allocated first so invalid requests are rejected before their alignment is used
+    for request in requests:
+        request.allocate(shape)
+    alignment = math.lcm(*(request.chunk_alignment() for request in requests)) if requests else 1
+    chunk_planes = compute_chunk_planes(shape, np.dtype(np.float64).itemsize, chunk_bytes, alignment)
+    for chunk_start in range(0, shape[0], chunk_planes):
+        chunk = np.asarray(grid[chunk_start:chunk_start + chunk_planes], dtype=np.float64)
+        for request in requests:
+            request.accumulate(chunk, chunk_start)
+    return [request.result for request in requests]
+
+
+def slice_scorer_output(scorer_output: ScorerOutput, requests: Sequence, statistic_name: str="Sum",
+                        chunk_bytes: int=DEFAULT_CHUNK_BYTES) -> List[np.ndarray]:
+    return run_slice_pass(scorer_output[statistic_name], requests, chunk_bytes)
@@ -0,0 +1,325 @@
+import asyncio
+import os
+import re
+import signal
+import subprocess
+import time
+from collections import deque
+from dataclasses import dataclass
+from pathlib import Path
+from typing import AsyncIterator, Deque, Dict, Iterable, Iterator, List, Optional, TextIO, Tuple
+from topas_wrapper.get_data import Supervisor
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath, read_parameter_value
+from topas_wrapper.sharding import derive_seed, generate_shard_script
+from topas_wrapper.result_cache import ResultCache, SEED_FROM_TIME_PATTERN
+from topas_wrapper.manifest import RunManifest
+from topas_wrapper.input_constants import RunStatus
+from topas_wrapper.run_simulations import (SimulationJob,
+                                           SimulationResult,
+                                           locate_topas_executable,
+                                           resolve_core_budget,
+                                           cores_required,
+                                           create_log_filepath,
+                                           retrieve_cached_result,
+                                           validate_job_output,
+                                           reap_process,
+                                           POLL_INTERVAL_SECONDS,
+                                           TOPAS_EXECUTABLE)
+
+# Geant4 prints "--> Event N starts" and TOPAS prints its history count, both zero-based
+PROGRESS_PATTERN = re.compile(r'(?:-->\s*Event|History)\s+(?P<history_number>\d+)', re.IGNORECASE)
+PROGRESS_REPORT_STEP = 0.1
+TERMINATE_GRACE_SECONDS = 5.0
+STREAM_LINE_LIMIT = 2**20
+
+
+@dataclass
+class SupervisedAttempt:
+    script_path: Path
+    log_path: Path
+    number_of_histories: int
+    timeout: float
+    histories_started: int = 0
+    reported_fraction: float = 0.0
+    cpu_time: Optional[float] = None
+    peak_rss: Optional[int] = None
+
+
+@dataclass
+class SupervisedProcess:
+    # A TOPAS process whose output is read through the event loop. It is reaped with wait4 by polling instead of
+    # by asyncio's child watcher, which would throw away the CPU time and peak memory of the run.
+    popen: subprocess.Popen
+    stdout: asyncio.StreamReader
+    stdout_transport: asyncio.ReadTransport
+    cpu_time: Optional[float] = None
+    peak_rss: Optional[int] = None
+
+    @property
+    def pid(self) -> int:
+        return self.popen.pid
+
+    @property
+    def returncode(self) -> Optional[int]:
+        return self.popen.returncode
+
+    async def wait(self) -> int:
+        while self.popen.returncode is None:
+            resource_usage = reap_process(self.popen)
+            if resource_usage is None:
+                await asyncio.sleep(POLL_INTERVAL_SECONDS)
+                continue
+            self.cpu_time, self.peak_rss = resource_usage
+        return self.popen.returncode
+
+
+def read_number_of_histories(script_lines: List[str], particle_source_component: str) -> int:
+    value = read_parameter_value(script_lines, f"So/{particle_source_component}/NumberOfHistoriesInRun")
+    return 0 if value is None else int(value)
+
+
+def compute_timeout(number_of_histories: int, settings: Supervisor) -> float:
+    return settings.minimum_timeout_seconds + settings.timeout_seconds_per_history * number_of_histories
+
+
+def compute_backoff(attempt: int, settings: Supervisor) -> float:
+    return settings.retry_backoff_seconds * 2 ** (attempt - 1)
+
+
+def create_retry_script(script_path: Path, attempt: int, particle_source_component: str) -> Path:
+    # The retry includes the original script and overrides only its seed, so it writes the same output file.
+    # A script seeded from the clock gets a fresh seed just by running again.
+    script_lines = read_script_lines(script_path)
+    if any(SEED_FROM_TIME_PATTERN.match(line.strip()) for line in script_lines):
+        return script_path
+    seed_number = int(read_parameter_value(script_lines, "Ts/Seed") or 0)
+    retry_seed = derive_seed(seed_number, script_path.stem, "retry", attempt)
+    retry_script_lines = generate_shard_script(script_path.name,
+                                               particle_source_component,
+                                               retry_seed,
+                                               read_number_of_histories(script_lines, particle_source_component),
+                                               read_output_filepath(script_lines))
+    retry_script_path = script_path.parent / f"{script_path.stem}_retry_{attempt}{script_path.suffix}"
+    retry_script_path.write_text("".join(f"{line}\n" for line in retry_script_lines))
+    return retry_script_path
+
+
+def record_progress(attempt: SupervisedAttempt, line: str):
+    match = PROGRESS_PATTERN.search(line)
+    if match is None or attempt.number_of_histories <= 0:
+        return
+    attempt.histories_started = max(attempt.histories_started, int(match.group("history_number")) + 1)
+    fraction = min(attempt.histories_started / attempt.number_of_histories, 1.0)
+    if fraction >= attempt.reported_fraction + PROGRESS_REPORT_STEP:
+        attempt.reported_fraction = fraction - fraction % PROGRESS_REPORT_STEP
+        print(f"Progress -> {attempt.script_path.name}: {fraction:.0%} ({attempt.histories_started} of {attempt.number_of_histories} histories)")
+
+
+async def start_process(executable_path: str, script_path: Path) -> SupervisedProcess:
+    # TOPAS runs in its own session so its whole process group can be killed
+    popen = subprocess.Popen([executable_path, str(script_path)],
+                             cwd=script_path.parent,
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT,
+                             start_new_session=True)
+    loop = asyncio.get_running_loop()
+    stdout = asyncio.StreamReader(limit=STREAM_LINE_LIMIT, loop=loop)
+    stdout_transport, _ = await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(stdout, loop=loop), popen.stdout)
+    return SupervisedProcess(popen, stdout, stdout_transport)
+
+
+async def stream_output(process: SupervisedProcess, log_file: TextIO, attempt: SupervisedAttempt):
+    async for line in process.stdout:
+        decoded_line = line.decode(errors="replace")
+        log_file.write(decoded_line)
+        record_progress(attempt, decoded_line)
+
+
+async def wait_for_exit(process: SupervisedProcess, log_file: TextIO, attempt: SupervisedAttempt) -> int:
+    await stream_output(process, log_file, attempt)
+    return await process.wait()
+
+
+async def terminate_process_group(process: SupervisedProcess):
+    # TOPAS runs in its own session, so its worker threads and any children go down with it
+    if process.returncode is not None:
+        return
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+    except ProcessLookupError:
+        await process.wait()
+        return
+    try:
+        await asyncio.wait_for(process.wait(), TERMINATE_GRACE_SECONDS)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await process.wait()
+
+
+async def run_attempt(attempt: SupervisedAttempt, executable_path: str) -> Tuple[int, bool]:
+    # Returns the exit code and whether the run was killed for exceeding its timeout
+    with attempt.log_path.open("w") as log_file:
+        process = await start_process(executable_path, attempt.script_path)
+        try:
+            await asyncio.wait_for(wait_for_exit(process, log_file, attempt), attempt.timeout)
+        except asyncio.TimeoutError:
+            await terminate_process_group(process)
+            return process.returncode, True
+        except asyncio.CancelledError:
+            await terminate_process_group(process)
+            raise
+        except (ValueError, asyncio.LimitOverrunError):
+            # A line longer than STREAM_LINE_LIMIT cannot be read from the pipe, so the run is stopped and,
+            # even if it had already exited cleanly, counted as failed since its log is incomplete
+            print(f"Simulation printed a line longer than {STREAM_LINE_LIMIT} bytes and was killed -> {attempt.script_path.name}")
+            await terminate_process_group(process)
+            return process.returncode or 1, False
+        finally:
+            process.stdout_transport.close()
+            attempt.cpu_time = process.cpu_time
+            attempt.peak_rss = process.peak_rss
+    return process.returncode, False
+
+
+async def supervise_job(job: SimulationJob, settings: Supervisor, executable_path: str, particle_source_component: str) -> SimulationResult:
+    # Failed, timed out and incomplete runs are retried with a fresh seed after a doubling backoff
+    script_path = Path(job.script_path).resolve()
+    number_of_histories = read_number_of_histories(read_script_lines(script_path), particle_source_component)
+    timeout = compute_timeout(number_of_histories, settings)
+    start_time = time.monotonic()
+    # CPU time adds up over every attempt, while peak memory is the highest any attempt reached
+    cpu_time = None
+    peak_rss = None
+    for attempt_number in range(settings.maximum_retries + 1):
+        if attempt_number > 0:
+            backoff = compute_backoff(attempt_number, settings)
+            print(f"Retrying in {backoff:.1f} s with a fresh seed -> {script_path.name} (attempt {attempt_number + 1} of {settings.maximum_retries + 1})")
+            await asyncio.sleep(backoff)
+            attempt_script_path = create_retry_script(script_path, attempt_number, particle_source_component)
+        else:
+            attempt_script_path = script_path
+        attempt = SupervisedAttempt(attempt_script_path, create_log_filepath(attempt_script_path), number_of_histories, timeout)
+        return_code, timed_out = await run_attempt(attempt, executable_path)
+        if attempt.cpu_time is not None:
+            cpu_time = (cpu_time or 0.0) + attempt.cpu_time
+            peak_rss = max(peak_rss or 0, attempt.peak_rss)
+        if timed_out:
+            print(f"Simulation exceeded its {timeout:.0f} s timeout and was killed -> {attempt_script_path.name}")
+        output_valid = return_code == 0 and not timed_out and validate_job_output(job)
+        if output_valid:
+            break
+    return SimulationResult(job, return_code, time.monotonic() - start_time, attempt.log_path,
+                            output_valid=output_valid, timed_out=timed_out, attempts=attempt_number + 1,
+                            cpu_time=cpu_time, peak_rss=peak_rss)
+
+
+async def supervise_simulations(jobs: Iterable[SimulationJob],
+                                settings: Supervisor,
+                                particle_source_component: str,
+                                core_budget: Optional[int]=None,
+                                topas_executable: str=TOPAS_EXECUTABLE,
+                                lookahead: Optional[int]=None,
+                                result_cache: Optional[ResultCache]=None,
+                                manifest: Optional[RunManifest]=None) -> AsyncIterator[SimulationResult]:
+    # Schedules like iterate_simulations, packing jobs first-fit under the core budget, but each job is
+    # a task that streams its output, enforces its timeout and retries. Closing the generator cancels
+    # every task, which kills the process groups of the runs still going.
+    executable_path = locate_topas_executable(topas_executable)
+    core_budget = resolve_core_budget(core_budget)
+    lookahead = core_budget if lookahead is None else max(lookahead, 1)
+
+    job_iterator = iter(jobs)
+    queued_jobs: Deque[SimulationJob] = deque()
+    running_tasks: Dict[asyncio.Task, int] = {}
+    script_hashes: Dict[Path, Optional[str]] = {}
+    cores_in_use = 0
+    jobs_exhausted = False
+
+    try:
+        while True:
+            while not jobs_exhausted and len(queued_jobs) < lookahead:
+                job = next(job_iterator, None)
+                if job is None:
+                    jobs_exhausted = True
+                    break
+                cores_required(job.number_of_threads, core_budget)
+                if result_cache is not None:
+                    script_hash, cache_hit = retrieve_cached_result(job, result_cache)
+                    if cache_hit:
+                        if manifest is not None:
+                            manifest.mark_finished(job.script_path, 0, RunStatus.completed, 0.0)
+                        yield SimulationResult(job, 0, 0.0, None, cached=True)
+                        continue
+                    script_hashes[job.script_path] = script_hash
+                queued_jobs.append(job)
+
+            for job in list(queued_jobs):
+                cores = cores_required(job.number_of_threads, core_budget)
+                if cores_in_use + cores > core_budget:
+                    continue
+                queued_jobs.remove(job)
+                if manifest is not None:
+                    manifest.mark_running(job.script_path)
+                running_tasks[asyncio.create_task(supervise_job(job, settings, executable_path, particle_source_component))] = cores
+                cores_in_use += cores
+
+            if not running_tasks:
+                if jobs_exhausted and not queued_jobs:
+                    return
+                continue
+
+            finished_tasks, _ = await asyncio.wait(running_tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished_tasks:
+                cores_in_use -= running_tasks.pop(task)
+                result = task.result()
+                script_hash = script_hashes.pop(result.job.script_path, None)
+                # A retried run used a different seed from its script, so it is not a result for the script's hash
+                if result_cache is not None and script_hash is not None and result.succeeded and result.attempts == 1:
+                    result_cache.store(script_hash, read_output_filepath(read_script_lines(result.job.script_path)))
+                if manifest is not None:
+                    status = RunStatus.completed if result.succeeded else RunStatus.failed
+                    manifest.mark_finished(result.job.script_path, result.return_code, status, result.wall_time)
+                yield result
+    finally:
+        for task in running_tasks:
+            task.cancel()
+        await asyncio.gather(*running_tasks, return_exceptions=True)
+
+
+async def fetch_next_result(results: AsyncIterator[SimulationResult]) -> Optional[SimulationResult]:
+    try:
+        return await results.__anext__()
+    except StopAsyncIteration:
+        return None
+
+
+def iterate_supervised_simulations(jobs: Iterable[SimulationJob],
+                                   settings: Supervisor,
+                                   particle_source_component: str,
+                                   core_budget: Optional[int]=None,
+                                   topas_executable: str=TOPAS_EXECUTABLE,
+                                   lookahead: Optional[int]=None,
+                                   result_cache: Optional[ResultCache]=None,
+                                   manifest: Optional[RunManifest]=None) -> Iterator[SimulationResult]:
+    # Drop-in for iterate_simulations in synchronous code. The event loop runs while the next result is
+    # awaited; an interrupt or closing the iterator cancels the supervisor and kills every running run.
+    loop = asyncio.new_event_loop()
+    results = supervise_simulations(jobs, settings, particle_source_component, core_budget, topas_executable,
+                                    lookahead, result_cache, manifest)
+    next_result_task = None
+    try:
+        while True:
+            next_result_task = loop.create_task(fetch_next_result(results))
+            result = loop.run_until_complete(next_result_task)
+            if result is None:
+                return
+            yield result
+    finally:
+        if next_result_task is not None and not next_result_task.done():
+            next_result_task.cancel()
+            loop.run_until_complete(asyncio.gather(next_result_task, return_exceptions=True))
+        loop.run_until_complete(results.aclose())
+        loop.close()
@@ -0,0 +1,186 @@
+from itertools import islice, product
+from typing import Dict, Iterator, List, Optional, Union
+import numpy as np
+from topas_wrapper.get_data import ExperimentParameters, SweepAxis
+from topas_wrapper.input_constants import PhysicsList, SweepParameter, SweepSampling
+
+SweepValue = Union[float, int, List[PhysicsList]]
+SweepPoint = Dict[SweepParameter, SweepValue]
+
+PARTICLE_SOURCE_SWEEP_PARAMETERS = [SweepParameter.beam_position_spread_x,
+                                    SweepParameter.beam_position_spread_y,
+                                    SweepParameter.beam_angular_spread_x,
+                                    SweepParameter.beam_angular_spread_y]
+
+SOBOL_BITS = 32
+# Degree s, coefficients a and initial direction numbers m of dimensions 2 onwards, from Joe and Kuo's
+# new-joe-kuo-6.21201 table; the first dimension is the van der Corput sequence
+SOBOL_DIRECTION_TABLE = [(1, 0, [1]),
+                         (2, 1, [1, 3]),
+                         (3, 1, [1, 3, 1]),
+                         (3, 2, [1, 1, 1]),
+                         (4, 1, [1, 1, 3, 3]),
+                         (4, 4, [1, 3, 5, 13]),
+                         (5, 2, [1, 1, 5, 5, 17]),
+                         (5, 4, [1, 1, 5, 5, 5]),
+                         (5, 7, [1, 1, 7, 11, 19])]
+MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS = len(SOBOL_DIRECTION_TABLE) + 1
+# Scripts write beam energies and spreads to two decimal places, so sampled values are rounded to match
+BEAM_ENERGY_DECIMALS = 2
+
+
+def create_value_axis(parameter: SweepParameter, values: List[float]) -> SweepAxis:
+    return SweepAxis.model_validate({"parameter": parameter, "values": values})
+
+
+def resolve_sweep_axes(experiment_parameters: ExperimentParameters) -> List[SweepAxis]:
+    # Beam energy and numbers of histories keep their usual lists as axes unless the sweep gives them one
+    sweep_axes = list(experiment_parameters.sweep.axes)
+    swept_parameters = [axis.parameter for axis in sweep_axes]
+    if SweepParameter.beam_energy not in swept_parameters:
+        sweep_axes.insert(0, create_value_axis(SweepParameter.beam_energy, experiment_parameters.particle_source.beam_energy))
+    if SweepParameter.number_of_histories not in swept_parameters:
+        sweep_axes.append(create_value_axis(SweepParameter.number_of_histories, experiment_parameters.numbers_of_histories))
+    return sweep_axes
+
+
+def convert_sweep_value(parameter: SweepParameter, value: SweepValue) -> SweepValue:
+    if parameter == SweepParameter.physics_modules:
+        return list(value)
+    if parameter == SweepParameter.number_of_histories:
+        return int(round(value))
+    if parameter in (SweepParameter.beam_energy, SweepParameter.beam_energy_spread):
+        return round(float(value), BEAM_ENERGY_DECIMALS)
+    return float(value)
+
+
+def list_axis_grid_values(axis: SweepAxis) -> List[SweepValue]:
+    values = axis.values if axis.values is not None else np.linspace(axis.minimum, axis.maximum, axis.number_of_points)
+    return [convert_sweep_value(axis.parameter, value) for value in values]
+
+
+def select_axis_value(axis: SweepAxis, unit_value: float) -> SweepValue:
+    # Listed values split the unit interval into equal strata, a range is scaled linearly onto it
+    if axis.values is not None:
+        value = axis.values[min(int(unit_value * len(axis.values)), len(axis.values) - 1)]
+    else:
+        value = axis.minimum + unit_value * (axis.maximum - axis.minimum)
+    return convert_sweep_value(axis.parameter, value)
+
+
+def count_grid_points(sweep_axes: List[SweepAxis]) -> Optional[int]:
+    # None when a range axis has no number_of_points, so only sampling can cover it
+    number_of_points = 1
+    for axis in sweep_axes:
+        if axis.values is None and axis.number_of_points is None:
+            return None
+        number_of_points *= len(axis.values) if axis.values is not None else axis.number_of_points
+    return number_of_points
+
+
+def iterate_grid_points(sweep_axes: List[SweepAxis]) -> Iterator[SweepPoint]:
+    parameters = [axis.parameter for axis in sweep_axes]
+    for values in product(*(list_axis_grid_values(axis) for axis in sweep_axes)):
+        yield dict(zip(parameters, values))
+
+
+def generate_latin_hypercube(number_of_samples: int, number_of_dimensions: int, rng: np.random.Generator) -> np.ndarray:
+    # Every dimension has exactly one sample in each of its number_of_samples equal strata
+    strata = np.column_stack([rng.permutation(number_of_samples) for _ in range(number_of_dimensions)])
+    return (strata + rng.random((number_of_samples, number_of_dimensions))) / number_of_samples
+
+
+def create_sobol_direction_numbers(number_of_dimensions: int) -> np.ndarray:
+    if number_of_dimensions > MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS:
+        raise ValueError(f"Sobol sampling supports at most {MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS} sweep axes, not {number_of_dimensions}.")
+    direction_numbers = np.zeros((SOBOL_BITS, number_of_dimensions), dtype=np.uint64)
+    for bit in range(SOBOL_BITS):
+        direction_numbers[bit, 0] = 1 << (SOBOL_BITS - bit - 1)
+    for dimension in range(1, number_of_dimensions):
+        degree, coefficients, initial_numbers = SOBOL_DIRECTION_TABLE[dimension - 1]
+        column = [0] * SOBOL_BITS
+        for bit in range(SOBOL_BITS):
+            if bit < degree:
+                column[bit] = initial_numbers[bit] << (SOBOL_BITS - bit - 1)
+                continue
+            column[bit] = column[bit - degree] ^ (column[bit - degree] >> degree)
+            for term in range(1, degree):
+                if (coefficients >> (degree - 1 - term)) & 1:
+                    column[bit] ^= column[bit - term]
+        direction_numbers[:, dimension] = column
+    return direction_numbers
+
+
+def iterate_sobol_points(number_of_dimensions: int, rng: Optional[np.random.Generator]=None) -> Iterator[np.ndarray]:
+    # Gray code order, so each point flips one direction number of the last. A random digital shift keeps
+    # the balance of every power-of-two prefix while moving the first point off the zero corner.
+    direction_numbers = create_sobol_direction_numbers(number_of_dimensions)
+    point = np.zeros(number_of_dimensions, dtype=np.uint64)
+    if rng is not None:
+        point = rng.integers(0, 2**SOBOL_BITS, size=number_of_dimensions, dtype=np.uint64)
+    scale = 1.0 / 2**SOBOL_BITS
+    for index in range(1, 2**SOBOL_BITS):
+        yield point * scale
+        point = point ^ direction_numbers[(index & -index).bit_length() - 1]
+
+
+def iterate_sweep_points(experiment_parameters: ExperimentParameters) -> Iterator[SweepPoint]:
+    sweep = experiment_parameters.sweep
+    sweep_axes = resolve_sweep_axes(experiment_parameters)
+    if sweep.sampling == SweepSampling.grid:
+        yield from iterate_grid_points(sweep_axes)
+        return
+    rng = np.random.default_rng(experiment_parameters.seed_number or None)
+    if sweep.sampling == SweepSampling.latin_hypercube:
+        unit_points = iter(generate_latin_hypercube(sweep.number_of_samples, len(sweep_axes), rng))
+    else:
+        unit_points = islice(iterate_sobol_points(len(sweep_axes), rng), sweep.number_of_samples)
+    for unit_point in unit_points:
+        yield {axis.parameter: select_axis_value(axis, unit_value) for axis, unit_value in zip(sweep_axes, unit_point)}
+
+
+def report_sweep_sampling(experiment_parameters: ExperimentParameters):
+    sweep = experiment_parameters.sweep
+    sweep_axes = resolve_sweep_axes(experiment_parameters)
+    number_of_grid_points = count_grid_points(sweep_axes)
+    axes_text = ", ".join(axis.parameter.value for axis in sweep_axes)
+    if sweep.sampling == SweepSampling.grid:
+        print(f"Sweeping a grid of {number_of_grid_points} points over -> {axes_text}")
+        return
+    grid_text = "" if number_of_grid_points is None else f" from a grid of {number_of_grid_points}"
+    print(f"Sweeping {sweep.number_of_samples} {sweep.sampling.value} points{grid_text} over -> {axes_text}")
+    number_of_samples = sweep.number_of_samples
+    if sweep.sampling == SweepSampling.sobol and number_of_samples & (number_of_samples - 1):
+        print(f"Sobol points are only balanced in powers of two, consider number_of_samples = {1 << (number_of_samples.bit_length() - 1)} or {1 << number_of_samples.bit_length()}.")
+
+
+def interpolate_beam_energy_spread(experiment_parameters: ExperimentParameters, beam_energy: float) -> float:
+    # An energy off the listed ones takes its spread from the neighbouring listed energies
+    particle_source = experiment_parameters.particle_source
+    order = np.argsort(particle_source.beam_energy)
+    return float(np.interp(beam_energy,
+                           np.asarray(particle_source.beam_energy)[order],
+                           np.asarray(particle_source.beam_energy_spreads)[order]))
+
+
+def apply_sweep_point(experiment_parameters: ExperimentParameters, sweep_point: SweepPoint) -> ExperimentParameters:
+    # The experiment parameters of a single run, with one beam energy and one number of histories
+    beam_energy = sweep_point[SweepParameter.beam_energy]
+    beam_energy_spread = sweep_point.get(SweepParameter.beam_energy_spread)
+    if beam_energy_spread is None:
+        beam_energy_spread = interpolate_beam_energy_spread(experiment_parameters, beam_energy)
+    particle_source_update = {"beam_energy": [beam_energy], "beam_energy_spreads": [beam_energy_spread]}
+    for parameter in PARTICLE_SOURCE_SWEEP_PARAMETERS:
+        if parameter in sweep_point:
+            particle_source_update[parameter.value] = sweep_point[parameter]
+    update = {"particle_source": experiment_parameters.particle_source.model_copy(update=particle_source_update),
+              "numbers_of_histories": [sweep_point[SweepParameter.number_of_histories]]}
+    if SweepParameter.physics_modules in sweep_point:
+        update["physics_list"] = experiment_parameters.physics_list.model_copy(update={"modules": sweep_point[SweepParameter.physics_modules]})
+    return experiment_parameters.model_copy(update=update)
+
+
+def format_sweep_value(value: SweepValue) -> str:
+    if isinstance(value, list):
+        return " ".join(module.value for module in value)
+    return f"{value:.10g}" if isinstance(value, float) else str(value)
@@ -0,0 +1,263 @@
+import math
+import re
+import sqlite3
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+import numpy as np
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.file_structure import FileStructure
+from topas_wrapper.results_store import read_run_metadata, read_required_parameter
+from topas_wrapper.result_cache import find_output_files
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath, read_parameter_value
+from topas_wrapper.sharding import split_number_of_histories
+from topas_wrapper.simulation_jobs import SimulationResult, cores_required, resolve_core_budget
+
+# log(wall time) = c0 + c1 log(beam energy) + c2 log(histories) + c3 log(cores)
+NUMBER_OF_MODEL_TERMS = 4
+MINIMUM_NUMBER_OF_MATCHING_RUNS = 2 * NUMBER_OF_MODEL_TERMS
+QUOTED_VALUE_PATTERN = re.compile(r'"([^"]*)"')
+
+
+@dataclass
+class CostModel:
+    coefficients: np.ndarray
+    residual_factor: float
+    number_of_runs: int
+    configuration_key: Optional[str]
+
+    def predict(self, beam_energy: float, number_of_histories: int, cores: int) -> float:
+        features = np.array([1.0, math.log(beam_energy), math.log(max(number_of_histories, 1)), math.log(max(cores, 1))])
+        return float(math.exp(features @ self.coefficients))
+
+
+def locate_telemetry_ledger(relative_filepath: str=FileStructure.TELEMETRY_LEDGER.value) -> Path:
+    mod_path = Path(__file__).parent
+    return (mod_path / relative_filepath).resolve()
+
+
+def format_configuration_key(physics_list: str, physics_modules: List[str], quantity: str, bins: Tuple[Optional[int], ...]) -> str:
+    # Runs only share a cost model when their physics and scoring grid match
+    modules = " ".join(physics_modules)
+    bins = "x".join(str(1 if number_of_bins is None else number_of_bins) for number_of_bins in bins)
+    return f"{physics_list}[{modules}]:{quantity}:{bins}"
+
+
+def create_configuration_key(experiment_parameters: ExperimentParameters) -> str:
+    physics_list = experiment_parameters.physics_list
+    scorer = experiment_parameters.scorer
+    return format_configuration_key(physics_list.list_name,
+                                    [str(module.value) for module in physics_list.modules],
+                                    scorer.quantity.value,
+                                    (scorer.x_bins, scorer.y_bins, scorer.z_bins))
+
+
+@dataclass
+class RunConfiguration:
+    physics_list: str
+    physics_modules: List[str]
+    quantity: str
+    bins: Tuple[Optional[int], Optional[int], Optional[int]]
+
+    @property
+    def configuration_key(self) -> str:
+        return format_configuration_key(self.physics_list, self.physics_modules, self.quantity, self.bins)
+
+
+def read_run_configuration(script_path: Path) -> RunConfiguration:
+    # Read from what the script actually ran with, since a sweep point can change the physics modules
+    script_lines = read_script_lines(script_path)
+    physics_list = read_required_parameter(script_lines, "Ph/ListName", script_path).strip('"')
+    physics_modules = QUOTED_VALUE_PATTERN.findall(read_required_parameter(script_lines, f"Ph/{physics_list}/Modules", script_path))
+    quantity = read_required_parameter(script_lines, "Sc/Scorer/Quantity", script_path).strip('"')
+    bins = tuple(None if value is None else int(value)
+                 for value in (read_parameter_value(script_lines, f"Sc/Scorer/{axis_name}Bins") for axis_name in "XYZ"))
+    return RunConfiguration(physics_list, physics_modules, quantity, bins)
+
+
+def measure_output_size(output_filepath: Path) -> int:
+    return sum(path.stat().st_size for path in find_output_files(output_filepath))
+
+
+class TelemetryLedger:
+    # Shared by every experiment so the cost model keeps learning across sweeps
+    def __init__(self, ledger_path: Optional[Path]=None):
+        self.ledger_path = locate_telemetry_ledger() if ledger_path is None else Path(ledger_path)
+        self.ledger_path.parent.mkdir(parents=True, exist_ok=True)
+        self.connection = sqlite3.connect(self.ledger_path)
+        with self.connection:
+            self.connection.execute("""
+                CREATE TABLE IF NOT EXISTS runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    recorded_at REAL NOT NULL,
+                    experiment_name TEXT NOT NULL,
+                    script_name TEXT NOT NULL,
+                    configuration_key TEXT NOT NULL,
+                    physics_list TEXT NOT NULL,
+                    physics_modules TEXT NOT NULL,
+                    scorer_x_bins INTEGER,
+                    scorer_y_bins INTEGER,
+                    scorer_z_bins INTEGER,
+                    beam_energy REAL NOT NULL,
+                    number_of_histories INTEGER NOT NULL,
+                    number_of_threads INTEGER NOT NULL,
+                    cores INTEGER NOT NULL,
+                    wall_time REAL NOT NULL,
+                    cpu_time REAL,
+                    peak_rss INTEGER,
+                    histories_per_second REAL,
+                    output_size INTEGER,
+                    attempts INTEGER NOT NULL
+                )""")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS runs_by_configuration ON runs (configuration_key)")
+
+    def close(self):
+        self.connection.close()
+
+    def record(self, result: SimulationResult, experiment_parameters: ExperimentParameters):
+        # Cached and failed runs say nothing about how long a run takes, so only simulated successes are kept
+        if result.cached or not result.succeeded:
+            return
+        script_path = result.job.script_path
+        particle_source_component = experiment_parameters.particle_source.component
+        run_metadata = read_run_metadata(script_path, particle_source_component)
+        run_configuration = read_run_configuration(script_path)
+        number_of_histories = int(run_metadata["number_of_histories"])
+        core_budget = resolve_core_budget(experiment_parameters.core_budget)
+        with self.connection:
+            self.connection.execute("""
+                INSERT INTO runs (recorded_at, experiment_name, script_name, configuration_key, physics_list, physics_modules,
+                                  scorer_x_bins, scorer_y_bins, scorer_z_bins, beam_energy, number_of_histories,
+                                  number_of_threads, cores, wall_time, cpu_time, peak_rss, histories_per_second,
+                                  output_size, attempts)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (time.time(),
+                 experiment_parameters.experiment_name,
+                 script_path.name,
+                 run_configuration.configuration_key,
+                 run_configuration.physics_list,
+                 " ".join(run_configuration.physics_modules),
+                 *run_configuration.bins,
+                 float(run_metadata["beam_energy"]),
+                 number_of_histories,
+                 result.job.number_of_threads,
+                 cores_required(result.job.number_of_threads, core_budget),
+                 result.wall_time,
+                 result.cpu_time,
+                 result.peak_rss,
+                 number_of_histories / result.wall_time if result.wall_time > 0 else None,
+                 measure_output_size(read_output_filepath(read_script_lines(script_path))),
+                 result.attempts))
+
+    def read_cost_samples(self, configuration_key: Optional[str]=None) -> np.ndarray:
+        query = "SELECT beam_energy, number_of_histories, cores, wall_time FROM runs WHERE wall_time > 0 AND beam_energy > 0"
+        parameters: Tuple = ()
+        if configuration_key is not None:
+            query += " AND configuration_key = ?"
+            parameters = (configuration_key,)
+        return np.array(self.connection.execute(query, parameters).fetchall(), dtype=np.float64).reshape(-1, 4)
+
+    def fit_cost_model(self, configuration_key: Optional[str]=None) -> Optional[CostModel]:
+        # Prefers runs with the same physics and scoring grid, falling back to every run in the ledger
+        samples = self.read_cost_samples(configuration_key)
+        if len(samples) < MINIMUM_NUMBER_OF_MATCHING_RUNS and configuration_key is not None:
+            samples = self.read_cost_samples()
+            configuration_key = None
+        if len(samples) < MINIMUM_NUMBER_OF_MATCHING_RUNS:
+            return None
+        return fit_cost_model(samples, configuration_key)
+
+    def has_cost_model(self) -> bool:
+        return len(self.read_cost_samples()) >= MINIMUM_NUMBER_OF_MATCHING_RUNS
+
+    def fit_script_cost_models(self, script_paths: List[Path]) -> List[Optional[CostModel]]:
+        # A sweep can change the physics or scoring grid from run to run, so each script gets the model of its own configuration
+        cost_models_by_key: Dict[str, Optional[CostModel]] = {}
+        cost_models = []
+        for script_path in script_paths:
+            configuration_key = read_run_configuration(script_path).configuration_key
+            if configuration_key not in cost_models_by_key:
+                cost_models_by_key[configuration_key] = self.fit_cost_model(configuration_key)
+            cost_models.append(cost_models_by_key[configuration_key])
+        return cost_models
+
+
+def fit_cost_model(samples: np.ndarray, configuration_key: Optional[str]=None) -> CostModel:
+    # Least squares in log space; the residual factor is the typical multiplicative error of a prediction
+    features = np.column_stack([np.ones(len(samples)),
+                                np.log(samples[:, 0]),
+                                np.log(np.maximum(samples[:, 1], 1)),
+                                np.log(np.maximum(samples[:, 2], 1))])
+    log_wall_times = np.log(samples[:, 3])
+    coefficients = np.linalg.lstsq(features, log_wall_times, rcond=None)[0]
+    residuals = log_wall_times - features @ coefficients
+    residual_factor = float(math.exp(math.sqrt(np.mean(residuals**2))))
+    return CostModel(coefficients, residual_factor, len(samples), configuration_key)
+
+
+def predict_script_wall_time(cost_model: CostModel, script_path: Path, experiment_parameters: ExperimentParameters) -> float:
+    run_metadata = read_run_metadata(script_path, experiment_parameters.particle_source.component)
+    cores = cores_required(int(run_metadata["number_of_threads"]), resolve_core_budget(experiment_parameters.core_budget))
+    return cost_model.predict(float(run_metadata["beam_energy"]), int(run_metadata["number_of_histories"]), cores)
+
+
+def order_longest_first(script_paths: List[Path], cost_models: List[CostModel],
+                        experiment_parameters: ExperimentParameters) -> Tuple[List[Path], List[CostModel]]:
+    # Starting the longest runs first stops one long run from being left alone at the end of the sweep.
+    # The cost models are given one per script and come back in the new order with their scripts.
+    predicted_wall_times = [predict_script_wall_time(cost_model, script_path, experiment_parameters)
+                            for script_path, cost_model in zip(script_paths, cost_models)]
+    order = sorted(range(len(script_paths)), key=lambda i: predicted_wall_times[i], reverse=True)
+    return [script_paths[i] for i in order], [cost_models[i] for i in order]
+
+
+def predict_job_wall_times(script_paths: List[Path], cost_models: List[CostModel], experiment_parameters: ExperimentParameters) -> List[float]:
+    # A sharded script becomes one job per shard, each with its share of the histories
+    core_budget = resolve_core_budget(experiment_parameters.core_budget)
+    predicted_wall_times = []
+    for script_path, cost_model in zip(script_paths, cost_models):
+        run_metadata = read_run_metadata(script_path, experiment_parameters.particle_source.component)
+        cores = cores_required(int(run_metadata["number_of_threads"]), core_budget)
+        for number_of_histories in split_number_of_histories(int(run_metadata["number_of_histories"]), experiment_parameters.number_of_shards):
+            predicted_wall_times.append(cost_model.predict(float(run_metadata["beam_energy"]), number_of_histories, cores))
+    return predicted_wall_times
+
+
+def estimate_sweep_wall_time(predicted_wall_times: List[float], cores: int, core_budget: int) -> float:
+    # Replays the scheduler with the predicted wall times, starting jobs in order as cores free up
+    running: List[Tuple[float, int]] = []
+    clock = 0.0
+    cores_in_use = 0
+    for wall_time in predicted_wall_times:
+        while cores_in_use + cores > core_budget:
+            running.sort()
+            finish_time, finished_cores = running.pop(0)
+            clock = max(clock, finish_time)
+            cores_in_use -= finished_cores
+        running.append((clock + wall_time, cores))
+        cores_in_use += cores
+    return max([finish_time for finish_time, _ in running], default=clock)
+
+
+def format_duration(seconds: float) -> str:
+    hours, remainder = divmod(int(round(seconds)), 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}h {minutes:02d}m {seconds:02d}s" if hours else f"{minutes}m {seconds:02d}s"
+
+
+def report_sweep_estimate(script_paths: List[Path], cost_models: List[CostModel], experiment_parameters: ExperimentParameters) -> float:
+    core_budget = resolve_core_budget(experiment_parameters.core_budget)
+    cores = cores_required(experiment_parameters.number_of_threads, core_budget)
+    estimate = estimate_sweep_wall_time(predict_job_wall_times(script_paths, cost_models, experiment_parameters), cores, core_budget)
+    number_of_matched_runs = sum(cost_model.configuration_key is not None for cost_model in cost_models)
+    if number_of_matched_runs == len(cost_models):
+        basis = "runs with the same configuration"
+    elif number_of_matched_runs == 0:
+        basis = "runs of any configuration"
+    else:
+        basis = f"runs with the same configuration for {number_of_matched_runs} of them and of any configuration for the rest"
+    residual_factor = max((cost_model.residual_factor for cost_model in cost_models), default=1.0)
+    print(f"Estimated sweep wall time -> {format_duration(estimate)} for {len(script_paths)} runs on {core_budget} cores "
+          f"(typically within a factor of {residual_factor:.2f}, fitted to {basis}).")
+    return estimate
@@ -0,0 +1,353 @@
+import json
+import os
+import socket
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Set
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.script_generator import generate_scripts, EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME
+from topas_wrapper.sharding import shard_scripts, load_sharded_run, merge_sharded_run
+from topas_wrapper.result_cache import ResultCache
+from topas_wrapper.regeneration import has_valid_output
+from topas_wrapper.create_file_structure import locate_experiment_folder
+from topas_wrapper.file_structure import FileStructure
+from topas_wrapper.telemetry import TelemetryLedger
+from topas_wrapper.run_simulations import (SimulationJob,
+                                           SimulationResult,
+                                           iterate_simulations,
+                                           report_simulation_result,
+                                           TOPAS_EXECUTABLE)
+
+QUEUE_FOLDERNAME = "queue"
+PENDING_FOLDERNAME = "pending"
+CLAIMED_FOLDERNAME = "claimed"
+DONE_FOLDERNAME = "done"
+FAILED_FOLDERNAME = "failed"
+LEASE_SEPARATOR = "@"
+JOB_SUFFIX = ".json"
+DEFAULT_LEASE_TIMEOUT_SECONDS = 300.0
+DEFAULT_MAXIMUM_ATTEMPTS = 3
+DEFAULT_IDLE_POLL_SECONDS = 10.0
+
+
+@dataclass
+class QueueLease:
+    lease_path: Path
+    job_name: str
+    script_path: Path
+    number_of_threads: int
+    parent_script_path: Optional[Path]
+    attempts: int
+
+
+def create_worker_id() -> str:
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def write_json_atomically(data: Dict, filepath: Path):
+    temporary_filepath = filepath.parent / f".{filepath.name}.{create_worker_id()}.tmp"
+    temporary_filepath.write_text(json.dumps(data, indent=4))
+    os.replace(temporary_filepath, filepath)
+
+
+def rewrite_lease(job: Dict, lease_path: Path):
+    # Written in place, so a lease that another worker expired and moved away meanwhile raises
+    # FileNotFoundError instead of being recreated in claimed next to its copy in pending
+    with lease_path.open("r+") as f:
+        f.write(json.dumps(job, indent=4))
+        f.truncate()
+
+
+class WorkQueue:
+    # Every job is a JSON file that moves between the pending, claimed, done and failed folders by rename,
+    # which is atomic on a shared filesystem, so exactly one worker wins each claim. A claimed job is renamed
+    # to carry its worker's id and kept fresh by touching it; a claim whose mtime stops moving for longer
+    # than the lease timeout belongs to a dead worker and is put back in pending.
+    # Script paths are stored relative to the experiment folder, but the scripts hold absolute output
+    # paths, so every host must mount the shared filesystem at the same location.
+    def __init__(self, experiment_folder: Path,
+                 lease_timeout_seconds: float=DEFAULT_LEASE_TIMEOUT_SECONDS,
+                 maximum_attempts: int=DEFAULT_MAXIMUM_ATTEMPTS):
+        self.experiment_folder = Path(experiment_folder).resolve()
+        self.queue_folder = self.experiment_folder / QUEUE_FOLDERNAME
+        self.lease_timeout_seconds = lease_timeout_seconds
+        self.maximum_attempts = maximum_attempts
+
+    def folder(self, state: str) -> Path:
+        return self.queue_folder / state
+
+    def list_job_files(self, state: str) -> List[Path]:
+        # Hidden files are other workers' half-written job files
+        return sorted(path for path in self.folder(state).iterdir() if not path.name.startswith("."))
+
+    def create(self):
+        for state in (PENDING_FOLDERNAME, CLAIMED_FOLDERNAME, DONE_FOLDERNAME, FAILED_FOLDERNAME):
+            self.folder(state).mkdir(parents=True, exist_ok=True)
+
+    def enqueue(self, script_path: Path, number_of_threads: int, parent_script_path: Optional[Path]=None):
+        script_path = Path(script_path).resolve()
+        job = {"script_path": str(script_path.relative_to(self.experiment_folder)),
+               "number_of_threads": number_of_threads,
+               "parent_script_path": None if parent_script_path is None else str(Path(parent_script_path).resolve().relative_to(self.experiment_folder)),
+               "attempts": 0}
+        # A job enqueued again, such as a changed run after an incremental regeneration, replaces its finished record
+        for state in (DONE_FOLDERNAME, FAILED_FOLDERNAME):
+            (self.folder(state) / f"{script_path.stem}{JOB_SUFFIX}").unlink(missing_ok=True)
+        write_json_atomically(job, self.folder(PENDING_FOLDERNAME) / f"{script_path.stem}{JOB_SUFFIX}")
+
+    def read_filesystem_time(self, worker_id: str) -> float:
+        # Leases are aged against the shared filesystem's clock, not this host's, so clock skew between hosts cannot expire a live lease
+        clock_filepath = self.queue_folder / f".clock{LEASE_SEPARATOR}{worker_id}"
+        clock_filepath.touch()
+        os.utime(clock_filepath)
+        filesystem_time = clock_filepath.stat().st_mtime
+        clock_filepath.unlink(missing_ok=True)
+        return filesystem_time
+
+    def expire_stale_leases(self, worker_id: str) -> int:
+        filesystem_time = self.read_filesystem_time(worker_id)
+        number_expired = 0
+        for lease_path in self.list_job_files(CLAIMED_FOLDERNAME):
+            job_name, _, owner = lease_path.name.partition(LEASE_SEPARATOR)
+            try:
+                if filesystem_time - lease_path.stat().st_mtime <= self.lease_timeout_seconds:
+                    continue
+                os.rename(lease_path, self.folder(PENDING_FOLDERNAME) / job_name)
+            except FileNotFoundError:
+                # The owner finished it, or another worker expired it first
+                continue
+            print(f"Expired the stale lease of worker {owner} -> {job_name}")
+            number_expired += 1
+        return number_expired
+
+    def claim(self, worker_id: str) -> Optional[QueueLease]:
+        for job_path in self.list_job_files(PENDING_FOLDERNAME):
+            lease_path = self.folder(CLAIMED_FOLDERNAME) / f"{job_path.name}{LEASE_SEPARATOR}{worker_id}"
+            try:
+                os.rename(job_path, lease_path)
+                # A rename keeps the mtime the job had in pending, which would make a long-queued job look stale at once
+                os.utime(lease_path)
+                job = json.loads(lease_path.read_text())
+                job["attempts"] += 1
+                if job["attempts"] > self.maximum_attempts:
+                    job["error"] = f"Gave up after {self.maximum_attempts} attempts whose workers stopped renewing their leases."
+                    self.move_lease(lease_path, job, FAILED_FOLDERNAME)
+                    print(f"Job failed after {self.maximum_attempts} attempts -> {job_path.name}")
+                    continue
+                rewrite_lease(job, lease_path)
+            except FileNotFoundError:
+                # Claimed by another worker first, or expired by one before this claim was complete
+                continue
+            parent_script_path = job["parent_script_path"]
+            return QueueLease(lease_path,
+                              job_path.name,
+                              self.experiment_folder / job["script_path"],
+                              job["number_of_threads"],
+                              None if parent_script_path is None else self.experiment_folder / parent_script_path,
+                              job["attempts"])
+        return None
+
+    def move_lease(self, lease_path: Path, job: Dict, state: str):
+        job_name = lease_path.name.partition(LEASE_SEPARATOR)[0]
+        rewrite_lease(job, lease_path)
+        os.rename(lease_path, self.folder(state) / job_name)
+
+    def complete(self, lease: QueueLease, result: SimulationResult, worker_id: str):
+        # Failed runs go back to pending until they run out of attempts
+        try:
+            job = json.loads(lease.lease_path.read_text())
+        except FileNotFoundError:
+            print(f"Lost the lease on {lease.job_name} before it finished, so another worker owns its result.")
+            return
+        job.update({"worker_id": worker_id,
+                    "return_code": result.return_code,
+                    "wall_time": result.wall_time,
+                    "cached": result.cached,
+                    "output_valid": result.output_valid})
+        if result.succeeded:
+            state = DONE_FOLDERNAME
+        elif lease.attempts < self.maximum_attempts:
+            state = PENDING_FOLDERNAME
+        else:
+            state = FAILED_FOLDERNAME
+        try:
+            self.move_lease(lease.lease_path, job, state)
+        except FileNotFoundError:
+            print(f"Lost the lease on {lease.job_name} before it finished, so another worker owns its result.")
+
+    def release(self, lease: QueueLease):
+        # Hands an unfinished job back without using up an attempt, for a worker that is shutting down
+        try:
+            job = json.loads(lease.lease_path.read_text())
+        except FileNotFoundError:
+            return
+        job["attempts"] -= 1
+        try:
+            self.move_lease(lease.lease_path, job, PENDING_FOLDERNAME)
+        except FileNotFoundError:
+            return
+
+    def count_jobs(self) -> Dict[str, int]:
+        return {state: len(self.list_job_files(state))
+                for state in (PENDING_FOLDERNAME, CLAIMED_FOLDERNAME, DONE_FOLDERNAME, FAILED_FOLDERNAME)}
+
+    def is_drained(self) -> bool:
+        job_counts = self.count_jobs()
+        return job_counts[PENDING_FOLDERNAME] == 0 and job_counts[CLAIMED_FOLDERNAME] == 0
+
+    def find_sibling_shards(self, parent_script_path: Path) -> Dict[str, List[Path]]:
+        relative_parent_script_path = str(Path(parent_script_path).relative_to(self.experiment_folder))
+        shard_script_paths_by_state = {}
+        for state in (PENDING_FOLDERNAME, CLAIMED_FOLDERNAME, DONE_FOLDERNAME, FAILED_FOLDERNAME):
+            for job_path in self.list_job_files(state):
+                try:
+                    job = json.loads(job_path.read_text())
+                except (FileNotFoundError, json.JSONDecodeError):
+                    # Moved or rewritten by another worker while being read; it is counted as not done
+                    shard_script_paths_by_state.setdefault(PENDING_FOLDERNAME, []).append(job_path)
+                    continue
+                if job["parent_script_path"] == relative_parent_script_path:
+                    shard_script_paths_by_state.setdefault(state, []).append(self.experiment_folder / job["script_path"])
+        return shard_script_paths_by_state
+
+
+class LeaseHeartbeat(threading.Thread):
+    # Touches every lease the worker holds, including jobs still waiting for cores, so none of them look stale
+    def __init__(self, interval_seconds: float):
+        super().__init__(daemon=True)
+        self.interval_seconds = interval_seconds
+        self.lease_paths: Set[Path] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def hold(self, lease: QueueLease):
+        with self.lock:
+            self.lease_paths.add(lease.lease_path)
+
+    def drop(self, lease: QueueLease):
+        with self.lock:
+            self.lease_paths.discard(lease.lease_path)
+
+    def run(self):
+        while not self.stopped.wait(self.interval_seconds):
+            with self.lock:
+                lease_paths = list(self.lease_paths)
+            for lease_path in lease_paths:
+                try:
+                    os.utime(lease_path)
+                except FileNotFoundError:
+                    print(f"Lost the lease on {lease_path.name}, another worker may be running it too.")
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def enqueue_experiment(experiment_parameters: ExperimentParameters) -> WorkQueue:
+    script_paths = generate_scripts(experiment_parameters)
+    if not script_paths:
+        raise ValueError("The experiment parameters describe no runs.")
+    work_queue = WorkQueue(script_paths[0].parent.parent)
+    if experiment_parameters.regenerate_incrementally:
+        # Unchanged runs kept their outputs, so only new and changed runs are queued
+        script_paths = [script_path for script_path in script_paths if not has_valid_output(script_path)]
+    work_queue.create()
+    if experiment_parameters.number_of_shards > 1:
+        for sharded_run in shard_scripts(script_paths,
+                                         experiment_parameters.number_of_shards,
+                                         experiment_parameters.seed_number,
+                                         experiment_parameters.particle_source.component):
+            for shard_script_path in sharded_run.shard_script_paths:
+                work_queue.enqueue(shard_script_path, experiment_parameters.number_of_threads, sharded_run.script_path)
+    else:
+        for script_path in script_paths:
+            work_queue.enqueue(script_path, experiment_parameters.number_of_threads)
+    print(f"Enqueued {work_queue.count_jobs()[PENDING_FOLDERNAME]} jobs -> {work_queue.queue_folder}")
+    return work_queue
+
+
+def iterate_leased_jobs(work_queue: WorkQueue, worker_id: str, heartbeat: LeaseHeartbeat,
+                        lease_by_script: Dict[Path, QueueLease]) -> Iterator[SimulationJob]:
+    # Claims one job at a time as the scheduler has room, and stops once nothing is left to claim
+    while True:
+        lease = work_queue.claim(worker_id)
+        if lease is None:
+            return
+        heartbeat.hold(lease)
+        lease_by_script[lease.script_path] = lease
+        yield SimulationJob(lease.script_path, lease.number_of_threads)
+
+
+def merge_completed_shards(work_queue: WorkQueue, parent_script_path: Path, particle_source_component: str) -> Optional[Path]:
+    # Whichever worker sees the last shard of a run done merges it; a concurrent second merge writes the same file
+    shard_script_paths_by_state = work_queue.find_sibling_shards(parent_script_path)
+    if set(shard_script_paths_by_state) != {DONE_FOLDERNAME}:
+        return None
+    sharded_run = load_sharded_run(parent_script_path, shard_script_paths_by_state[DONE_FOLDERNAME], particle_source_component)
+    return merge_sharded_run(sharded_run)
+
+
+def run_worker(experiment_name: str,
+               core_budget: Optional[int]=None,
+               topas_executable: str=TOPAS_EXECUTABLE,
+               lease_timeout_seconds: float=DEFAULT_LEASE_TIMEOUT_SECONDS,
+               idle_poll_seconds: float=DEFAULT_IDLE_POLL_SECONDS,
+               telemetry_ledger: Optional[TelemetryLedger]=None) -> List[SimulationResult]:
+    # Runs queued jobs until the queue is drained, waiting on other workers' claims in case their leases expire
+    experiment_folder = locate_experiment_folder(experiment_name, FileStructure.EXPERIMENTS.value)
+    experiment_parameters = ExperimentParameters.from_json(experiment_folder / EXPERIMENT_PARAMETERS_SNAPSHOT_FILENAME)
+    core_budget = experiment_parameters.core_budget if core_budget is None else core_budget
+    result_cache = ResultCache() if experiment_parameters.use_result_cache else None
+    work_queue = WorkQueue(experiment_folder, lease_timeout_seconds)
+    telemetry_ledger = TelemetryLedger() if telemetry_ledger is None else telemetry_ledger
+    worker_id = create_worker_id()
+    heartbeat = LeaseHeartbeat(lease_timeout_seconds / 4)
+    heartbeat.start()
+    lease_by_script: Dict[Path, QueueLease] = {}
+    results = []
+    print(f"Worker {worker_id} started -> {work_queue.queue_folder}")
+    try:
+        while True:
+            work_queue.expire_stale_leases(worker_id)
+            jobs = iterate_leased_jobs(work_queue, worker_id, heartbeat, lease_by_script)
+            number_of_results = len(results)
+            for result in iterate_simulations(jobs, core_budget, topas_executable, lookahead=1, result_cache=result_cache):
+                report_simulation_result(result)
+                results.append(result)
+                telemetry_ledger.record(result, experiment_parameters)
+                lease = lease_by_script.pop(result.job.script_path)
+                heartbeat.drop(lease)
+                work_queue.complete(lease, result, worker_id)
+                if result.succeeded and lease.parent_script_path is not None:
+                    merged_output_filepath = merge_completed_shards(work_queue, lease.parent_script_path, experiment_parameters.particle_source.component)
+                    if merged_output_filepath is not None:
+                        print(f"Shards merged -> {merged_output_filepath.name}")
+            if work_queue.is_drained():
+                break
+            if len(results) == number_of_results:
+                time.sleep(idle_poll_seconds)
+    finally:
+        heartbeat.stop()
+        for lease in lease_by_script.values():
+            work_queue.release(lease)
+        telemetry_ledger.close()
+    print(f"Worker {worker_id} finished after {len(results)} jobs, {sum(result.succeeded for result in results)} successful.")
+    return results
+
+
+def report_queue_status(experiment_name: str, lease_timeout_seconds: float=DEFAULT_LEASE_TIMEOUT_SECONDS) -> Dict[str, int]:
+    experiment_folder = locate_experiment_folder(experiment_name, FileStructure.EXPERIMENTS.value)
+    work_queue = WorkQueue(experiment_folder, lease_timeout_seconds)
+    job_counts = work_queue.count_jobs()
+    print(", ".join(f"{number_of_jobs} {state}" for state, number_of_jobs in job_counts.items()))
+    filesystem_time = work_queue.read_filesystem_time(create_worker_id())
+    for lease_path in work_queue.list_job_files(CLAIMED_FOLDERNAME):
+        job_name, _, owner = lease_path.name.partition(LEASE_SEPARATOR)
+        try:
+            age = filesystem_time - lease_path.stat().st_mtime
+        except FileNotFoundError:
+            continue
+        print(f"{job_name} claimed by {owner}, lease renewed {age:.0f} s ago{' (stale)' if age > lease_timeout_seconds else ''}")
+    return job_counts
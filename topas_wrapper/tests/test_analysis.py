@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+from topas_wrapper.analysis import compute_bragg_peak_metrics, find_level_crossings, fit_parabolic_peaks
+
+BIN_WIDTH = 0.1
+DEPTHS = (np.arange(200) + 0.5) * BIN_WIDTH
+
+
+def create_triangle(peak_depth: float, half_width: float) -> np.ndarray:
+    # Linear between bin centres when the peak and corners sit on them, so linear interpolation is exact
+    return np.maximum(0.0, 1 - np.abs(DEPTHS - peak_depth) / half_width)
+
+
+def create_gaussian(peak_depth: float, sigma: float, peak_value: float=1.0) -> np.ndarray:
+    return peak_value * np.exp(-0.5 * np.square((DEPTHS - peak_depth) / sigma))
+
+
+def test_parabola_peak_is_found_between_bins():
+    profiles = 3.0 - 2.0 * np.square(DEPTHS[None, :] - np.array([[7.43], [12.05]]))
+    peak_depths, peak_values = fit_parabolic_peaks(profiles, DEPTHS)
+    np.testing.assert_allclose(peak_depths, [7.43, 12.05])
+    np.testing.assert_allclose(peak_values, [3.0, 3.0])
+
+
+def test_peak_at_the_edge_falls_back_to_the_bin_centre():
+    peak_depths, peak_values = fit_parabolic_peaks(DEPTHS, DEPTHS)
+    assert peak_depths[0] == DEPTHS[-1]
+    assert peak_values[0] == DEPTHS[-1]
+
+
+def test_triangle_metrics_are_exact():
+    # Peak at 10.05 with a half width of 2, so the levels are crossed at 10.05 + 2 * (1 - level)
+    metrics = compute_bragg_peak_metrics(create_triangle(10.05, 2.0), DEPTHS)
+    np.testing.assert_allclose(metrics["bragg_peak_depth"], [10.05])
+    np.testing.assert_allclose(metrics["bragg_peak_value"], [1.0])
+    np.testing.assert_allclose(metrics["r90"], [10.25])
+    np.testing.assert_allclose(metrics["r80"], [10.45])
+    np.testing.assert_allclose(metrics["peak_width"], [2.0])
+
+
+def test_gaussian_metrics_match_the_analytic_values():
+    sigma = 0.6
+    profiles = np.vstack([create_gaussian(8.0, sigma, 5.0), create_gaussian(13.27, sigma, 0.2)])
+    metrics = compute_bragg_peak_metrics(profiles, DEPTHS)
+    np.testing.assert_allclose(metrics["bragg_peak_depth"], [8.0, 13.27], atol=0.01)
+    np.testing.assert_allclose(metrics["bragg_peak_value"], [5.0, 0.2], rtol=0.005)
+    np.testing.assert_allclose(metrics["r90"], np.array([8.0, 13.27]) + sigma * np.sqrt(2 * np.log(1 / 0.9)), atol=0.01)
+    np.testing.assert_allclose(metrics["r80"], np.array([8.0, 13.27]) + sigma * np.sqrt(2 * np.log(1 / 0.8)), atol=0.01)
+    np.testing.assert_allclose(metrics["peak_width"], 2 * sigma * np.sqrt(2 * np.log(2)), atol=0.01)
+
+
+def test_proximal_crossings_mirror_the_distal_ones():
+    profiles = np.vstack([create_triangle(10.05, 2.0), create_triangle(5.05, 1.0)])
+    levels = np.array([0.5, 0.25])
+    np.testing.assert_allclose(find_level_crossings(profiles, DEPTHS, levels), [11.05, 5.80])
+    np.testing.assert_allclose(find_level_crossings(profiles, DEPTHS, levels, distal=False), [9.05, 4.30])
+
+
+def test_curve_that_never_crosses_a_level_gives_nan():
+    # A plateau that falls to 85% before the scored depth ends crosses R90 but never R80, and a curve still
+    # rising at the last bin crosses nothing distal to its peak
+    plateau = np.where(DEPTHS < 15.0, 1.0, 0.85)
+    rising = DEPTHS / DEPTHS[-1]
+    metrics = compute_bragg_peak_metrics(np.vstack([plateau, rising, create_triangle(10.05, 2.0)]), DEPTHS)
+    assert np.isfinite(metrics["r90"][0])
+    np.testing.assert_allclose(metrics["r90"][0], 14.95 + 0.1 * (1 - 0.9) / 0.15)
+    assert np.isnan(metrics["r80"][0])
+    assert np.isnan(metrics["peak_width"][0])
+    assert np.isnan([metrics["r90"][1], metrics["r80"][1], metrics["peak_width"][1]]).all()
+    # The other profiles stacked with them are unaffected
+    np.testing.assert_allclose(metrics["r80"][2], 10.45)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,121 @@
+from typing import Tuple
+import numpy as np
+import pytest
+from topas_wrapper.depth_dose_library import (DepthDoseLibrary,
+                                              sample_curves,
+                                              compute_leave_one_out_errors,
+                                              compute_error_coefficients)
+
+NODE_ENERGIES = np.array([70.0, 90.0, 100.0, 120.0, 150.0])
+DEPTHS = (np.arange(500) + 0.5) * 0.05
+NUMBER_OF_HISTORIES = 1000
+
+
+def compute_range(beam_energies: np.ndarray) -> np.ndarray:
+    # Bragg-Kleeman rule for protons in water, in cm
+    return 0.0022 * beam_energies**1.77
+
+
+def create_curves(beam_energies: np.ndarray, scales_with_range: bool=True) -> Tuple[np.ndarray, np.ndarray]:
+    # A plateau and peak ending at the range. Scaled with the range, every curve is the same shape stretched in
+    # depth, which the library interpolates exactly; with a fixed peak width and falloff it can only approximate them.
+    ranges = compute_range(beam_energies)
+    if scales_with_range:
+        positions, peak_width, falloff_width = DEPTHS[None, :] / ranges[:, None] - 1, 0.08, 0.03
+    else:
+        positions, peak_width, falloff_width = DEPTHS[None, :] - ranges[:, None], 0.5, 0.3
+    curves = 0.15 * (1 - np.tanh(positions / falloff_width)) + 0.7 * np.exp(-np.square(positions / peak_width))
+    return curves / curves.max(axis=1, keepdims=True), ranges
+
+
+def create_library(scales_with_range: bool=True) -> DepthDoseLibrary:
+    curves, ranges = create_curves(NODE_ENERGIES, scales_with_range)
+    peak_doses = np.linspace(2.0, 1.0, len(NODE_ENERGIES))
+    leave_one_out_errors = compute_leave_one_out_errors(NODE_ENERGIES, curves, ranges, peak_doses, DEPTHS)
+    return DepthDoseLibrary(NODE_ENERGIES, "MeV", DEPTHS, "cm", curves, peak_doses, ranges,
+                            np.full(len(NODE_ENERGIES), NUMBER_OF_HISTORIES),
+                            compute_error_coefficients(NODE_ENERGIES, leave_one_out_errors))
+
+
+def test_query_at_a_node_returns_its_curve_and_range():
+    library = create_library()
+    query = library.query(NODE_ENERGIES)
+    np.testing.assert_allclose(query.curves, library.curves, atol=1e-12)
+    np.testing.assert_allclose(query.ranges, library.ranges, rtol=1e-12)
+    np.testing.assert_allclose(query.peak_doses, library.peak_doses, rtol=1e-12)
+    np.testing.assert_allclose(query.doses, library.curves * library.peak_doses[:, None], rtol=1e-12, atol=1e-12)
+    np.testing.assert_array_equal(query.error_estimates, 0)
+
+
+def test_query_between_nodes_follows_the_stretched_curve():
+    beam_energies = np.array([75.0, 110.0, 137.5])
+    query = create_library().query(beam_energies)
+    curves, ranges = create_curves(beam_energies)
+    np.testing.assert_allclose(query.ranges, ranges, rtol=1e-12)
+    assert np.abs(query.curves - curves).max() < 0.01
+
+
+@pytest.mark.parametrize("beam_energies", [[69.9], [100, 150.1], [-1]])
+def test_energy_outside_the_library_is_rejected(beam_energies):
+    with pytest.raises(ValueError, match="The library covers 70 to 150 MeV"):
+        create_library().query(beam_energies)
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 64])
+def test_chunked_queries_match_the_unchunked_query(chunk_size):
+    library = create_library()
+    beam_energies = np.random.default_rng(0).uniform(70, 150, 50)
+    query = library.query(beam_energies, chunk_size=len(beam_energies))
+    chunked_query = library.query(beam_energies, chunk_size=chunk_size)
+    for attribute in ("curves", "ranges", "peak_doses", "error_estimates"):
+        np.testing.assert_array_equal(getattr(chunked_query, attribute), getattr(query, attribute))
+
+
+def test_curve_is_flat_before_the_first_bin_and_falls_to_zero_one_bin_past_the_last():
+    curves = np.array([[2.0, 4.0, 6.0]])
+    depths = np.array([0.5, 1.5, 2.5])
+    positions = np.array([[0.0, 1.0, 2.5, 3.0, 3.5, 5.0]])
+    np.testing.assert_allclose(sample_curves(curves, np.array([0]), positions, depths), [[2.0, 3.0, 6.0, 3.0, 0.0, 0.0]])
+
+
+def test_leave_one_out_errors_are_small_for_curves_that_scale_with_range():
+    curves, ranges = create_curves(NODE_ENERGIES)
+    errors = compute_leave_one_out_errors(NODE_ENERGIES, curves, ranges, np.ones(len(NODE_ENERGIES)), DEPTHS)
+    assert np.isnan(errors[[0, -1]]).all()
+    assert (errors[1:-1] < 0.005).all()
+    curves, ranges = create_curves(NODE_ENERGIES, scales_with_range=False)
+    errors = compute_leave_one_out_errors(NODE_ENERGIES, curves, ranges, np.ones(len(NODE_ENERGIES)), DEPTHS)
+    assert (errors[1:-1] > 0.02).all()
+
+
+def test_error_coefficients_scale_leave_one_out_errors_by_the_gap():
+    beam_energies = np.array([70.0, 80.0, 100.0, 130.0])
+    error_coefficients = compute_error_coefficients(beam_energies, np.array([np.nan, 0.02, 0.05, np.nan]))
+    np.testing.assert_allclose(error_coefficients, [0.02 / 30**2, 0.02 / 30**2, 0.05 / 50**2, 0.05 / 50**2])
+    assert np.isnan(compute_error_coefficients(beam_energies[:2], np.full(2, np.nan))).all()
+
+
+def test_error_estimates_vanish_at_nodes_and_track_the_actual_error():
+    library = create_library(scales_with_range=False)
+    beam_energies = np.linspace(100, 120, 21)
+    error_estimates = library.query(beam_energies).error_estimates
+    assert error_estimates[0] == error_estimates[-1] == 0
+    # The coefficient is blended between the nodes, so the largest estimate sits near, not exactly at, the middle
+    assert (error_estimates[1:-1] > 0).all()
+    assert 8 <= np.argmax(error_estimates) <= 12
+    np.testing.assert_allclose(error_estimates[10], 0.5 * (library.error_coefficients[2] + library.error_coefficients[3]) * 20**2)
+    midpoints = 0.5 * (NODE_ENERGIES[:-1] + NODE_ENERGIES[1:])
+    query = library.query(midpoints)
+    actual_errors = np.abs(query.curves - create_curves(midpoints, scales_with_range=False)[0]).max(axis=1)
+    assert ((query.error_estimates > 0.5 * actual_errors) & (query.error_estimates < 2 * actual_errors)).all()
+
+
+def test_library_round_trips_through_a_file(tmp_path):
+    library = create_library()
+    loaded_library = DepthDoseLibrary.load(library.save(tmp_path / "library.npz"))
+    assert (loaded_library.beam_energy_unit, loaded_library.depth_unit) == ("MeV", "cm")
+    np.testing.assert_array_equal(loaded_library.query(100.5).curves, library.query(100.5).curves)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
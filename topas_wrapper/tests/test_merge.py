@@ -0,0 +1,139 @@
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+import pytest
+from topas_wrapper import scorer_output
+from topas_wrapper.scorer_output import (ScorerOutput,
+                                         parse_scorer_header,
+                                         combine_statistics,
+                                         merge_scorer_outputs,
+                                         load_scorer_output,
+                                         write_scorer_output)
+from topas_wrapper.sharding import ShardedRun, merge_sharded_run
+
+SHAPE = (2, 1, 5)
+SHARD_NUMBERS_OF_HISTORIES = [40, 7, 1, 25]
+STATISTIC_NAMES = ["Sum", "Mean", "Count_in_Bin", "Second_Moment", "Variance", "Standard_Deviation", "Min", "Max"]
+HEADER_LINES = ["# Results for scorer: Scorer",
+                "# X in 2 bins of 1 cm",
+                "# Y in 1 bin of 1 cm",
+                "# Z in 5 bins of 0.5 cm",
+                f"# EnergyDeposit ( MeV ) : {'   '.join(STATISTIC_NAMES)}"]
+
+
+def score_histories(deposits: np.ndarray) -> Dict[str, np.ndarray]:
+    # The statistics TOPAS would write for these per-history deposits, one row per history
+    mean = deposits.mean(axis=0)
+    second_moment = np.square(deposits - mean).sum(axis=0)
+    variance = second_moment / max(len(deposits) - 1, 1)
+    return {"Sum": deposits.sum(axis=0),
+            "Mean": mean,
+            "Count_in_Bin": np.count_nonzero(deposits, axis=0).astype(np.float64),
+            "Second_Moment": second_moment,
+            "Variance": variance,
+            "Standard_Deviation": np.sqrt(variance),
+            "Min": deposits.min(axis=0),
+            "Max": deposits.max(axis=0)}
+
+
+@pytest.fixture
+def deposits() -> np.ndarray:
+    # Mostly empty bins with the odd large deposit, so the shards differ in mean, spread and extremes
+    rng = np.random.default_rng(7)
+    deposits = rng.exponential(2.0, (sum(SHARD_NUMBERS_OF_HISTORIES),) + SHAPE)
+    return np.where(rng.random(deposits.shape) < 0.6, 0.0, deposits)
+
+
+def split_into_shards(deposits: np.ndarray, folder: Path) -> List[ScorerOutput]:
+    header = parse_scorer_header(HEADER_LINES)
+    boundaries = np.cumsum(SHARD_NUMBERS_OF_HISTORIES)[:-1]
+    return [ScorerOutput(header, score_histories(shard_deposits), folder / f"run_shard_{shard_index}")
+            for shard_index, shard_deposits in enumerate(np.split(deposits, boundaries))]
+
+
+def assert_statistics_match(statistics: Dict[str, np.ndarray], expected_statistics: Dict[str, np.ndarray], rtol: float=1e-12):
+    assert sorted(statistics) == sorted(expected_statistics)
+    for statistic_name, expected_values in expected_statistics.items():
+        np.testing.assert_allclose(statistics[statistic_name], expected_values, rtol=rtol, atol=1e-12, err_msg=statistic_name)
+
+
+def test_combined_shards_match_statistics_over_every_history(tmp_path, deposits):
+    shard_outputs = split_into_shards(deposits, tmp_path)
+    assert_statistics_match(combine_statistics(shard_outputs, SHARD_NUMBERS_OF_HISTORIES), score_histories(deposits))
+
+
+@pytest.mark.parametrize("statistic_names", [["Sum", "Variance"], ["Sum", "Standard_Deviation"], ["Mean", "Second_Moment"]])
+def test_moments_are_rebuilt_from_any_scored_spread(tmp_path, deposits, statistic_names):
+    header = parse_scorer_header(HEADER_LINES[:-1] + [f"# EnergyDeposit ( MeV ) : {'   '.join(statistic_names)}"])
+    shard_outputs = [ScorerOutput(header, {name: shard_output[name] for name in statistic_names}, shard_output.source_path)
+                     for shard_output in split_into_shards(deposits, tmp_path)]
+    expected_statistics = score_histories(deposits)
+    assert_statistics_match(combine_statistics(shard_outputs, SHARD_NUMBERS_OF_HISTORIES),
+                            {name: expected_statistics[name] for name in statistic_names})
+
+
+def test_combining_needs_a_history(tmp_path, deposits):
+    with pytest.raises(ValueError, match="at least one history"):
+        combine_statistics(split_into_shards(deposits, tmp_path)[:1], [0])
+
+
+def test_unsupported_statistic_is_rejected(tmp_path):
+    header = parse_scorer_header(HEADER_LINES[:-1] + ["# EnergyDeposit ( MeV ) : Sum   Median"])
+    shard_output = ScorerOutput(header, {"Sum": np.ones(SHAPE), "Median": np.ones(SHAPE)}, tmp_path / "run")
+    with pytest.raises(ValueError, match="Median is not supported"):
+        combine_statistics([shard_output, shard_output], [1, 1])
+
+
+def test_mismatched_outputs_are_not_merged(tmp_path, deposits):
+    shard_outputs = split_into_shards(deposits, tmp_path)
+    header = parse_scorer_header(HEADER_LINES[:-2] + ["# Z in 4 bins of 0.5 cm", HEADER_LINES[-1]])
+    other_output = ScorerOutput(header, {name: values[..., :4] for name, values in shard_outputs[1].statistics.items()}, tmp_path / "other")
+    with pytest.raises(ValueError, match="does not match the binning and statistics"):
+        merge_scorer_outputs([shard_outputs[0], other_output], SHARD_NUMBERS_OF_HISTORIES[:2])
+    with pytest.raises(ValueError, match="4 scorer outputs but 3 numbers of histories"):
+        merge_scorer_outputs(shard_outputs, SHARD_NUMBERS_OF_HISTORIES[:3])
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_sharded_run_merges_to_statistics_over_every_history(tmp_path, deposits, binary):
+    shard_outputs = split_into_shards(deposits, tmp_path)
+    for shard_output in shard_outputs:
+        write_scorer_output(shard_output, shard_output.source_path, binary=binary)
+    sharded_run = ShardedRun(tmp_path / "run.txt", tmp_path / "run",
+                             [tmp_path / f"run_shard_{shard_index}.txt" for shard_index in range(len(shard_outputs))],
+                             [shard_output.source_path for shard_output in shard_outputs],
+                             SHARD_NUMBERS_OF_HISTORIES, [True] * len(shard_outputs))
+    merged_filepath = merge_sharded_run(sharded_run)
+    assert merged_filepath == tmp_path / ("run.bin" if binary else "run.csv")
+    merged_output = load_scorer_output(tmp_path / "run", use_sidecar=False)
+    assert merged_output.header.header_lines == HEADER_LINES
+    # CSV output keeps ten significant figures, binary output every bit
+    assert_statistics_match(merged_output.statistics, score_histories(deposits), rtol=1e-12 if binary else 1e-9)
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_writers_round_trip_and_leave_no_temporary_files(tmp_path, deposits, binary):
+    [output, *_] = split_into_shards(deposits, tmp_path)
+    filepath = write_scorer_output(output, tmp_path / "run", binary=binary)
+    assert sorted(path.name for path in tmp_path.iterdir()) == (["run.bin", "run.binheader"] if binary else ["run.csv"])
+    assert_statistics_match(load_scorer_output(filepath, use_sidecar=False).statistics, output.statistics, rtol=1e-12 if binary else 1e-9)
+
+
+def test_binary_header_is_moved_into_place_before_the_values(tmp_path, deposits, monkeypatch):
+    replaced_filepaths = []
+    replace = scorer_output.os.replace
+
+    def record_replace(source, destination):
+        # Both files are still temporary when each move starts
+        assert Path(source).name.endswith(".tmp")
+        replaced_filepaths.append(Path(destination).name)
+        replace(source, destination)
+
+    monkeypatch.setattr(scorer_output.os, "replace", record_replace)
+    [output, *_] = split_into_shards(deposits, tmp_path)
+    write_scorer_output(output, tmp_path / "run", binary=True)
+    assert replaced_filepaths == ["run.binheader", "run.bin"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
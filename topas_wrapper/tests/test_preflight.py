@@ -0,0 +1,168 @@
+from pathlib import Path
+from typing import List
+import pytest
+from topas_wrapper import script_generator
+from topas_wrapper.get_data import ExperimentParameters, Sweep
+from topas_wrapper.input_constants import ScriptGenerationMode
+from topas_wrapper.preflight import check_run_script, run_preflight_checks, BASE_PARAMETERS_SOURCE_NAME
+from topas_wrapper.script_generator import check_first_run_script, BASE_PARAMETERS_FILENAME
+
+EXPERIMENT_PARAMETERS_PATH = Path(__file__).resolve().parents[1] / "EXPERIMENT_PARAMETERS.toml"
+VALID_GEOMETRY_LINES = ['sv:Ma/Plastic/Components = 2 "Carbon" "Hydrogen"',
+                        "uv:Ma/Plastic/Fractions = 2 0.9 0.1",
+                        "d:Ma/Plastic/Density = 1.0 g/cm3",
+                        's:Ge/World/Type = "TsBox"',
+                        's:Ge/World/Material = "Air"',
+                        "d:Ge/World/HLX = 1 m",
+                        's:Ge/Box/Type = "TsBox"',
+                        's:Ge/Box/Parent = "World"',
+                        's:Ge/Box/Material = "Plastic"',
+                        "d:Ge/Box/HLZ = 10 cm",
+                        "d:Ge/Box/TransZ = Ge/Box/HLZ cm",
+                        's:Ge/Holder/Type = "Group"',
+                        's:Ge/Holder/Parent = "World"']
+VALID_SCRIPT_LINES = ["i:Ts/NumberOfThreads = 1",
+                      'b:Ts/ShowCPUTime = "True"',
+                      "d:So/Beam/BeamEnergy = 100 MeV",
+                      's:Sc/Scorer/Component = "Box"',
+                      'sv:Sc/Scorer/OnlyIncludeParticlesNamed = 1 "proton"']
+
+
+def replace_line(lines: List[str], name: str, new_line: str=None) -> List[str]:
+    # Swaps the line setting name for new_line, or drops it when there is none
+    replaced_lines = [new_line if line.split("=")[0].split(":")[1].strip() == name else line for line in lines]
+    return [line for line in replaced_lines if line is not None]
+
+
+# Each fixture breaks one check of an otherwise valid geometry and run script
+FAILING_FIXTURES = {
+    "not_a_parameter": (VALID_GEOMETRY_LINES, VALID_SCRIPT_LINES + ["Ts/NumberOfThreads 1"],
+                        "is not a TOPAS parameter"),
+    "duplicate": (VALID_GEOMETRY_LINES, VALID_SCRIPT_LINES + ["d:Ge/Box/HLZ = 5 cm"],
+                  "Ge/Box/HLZ is set twice"),
+    "vector_length": (VALID_GEOMETRY_LINES, replace_line(VALID_SCRIPT_LINES, "Sc/Scorer/OnlyIncludeParticlesNamed", 'sv:Sc/Scorer/OnlyIncludeParticlesNamed = 2 "proton"'),
+                      "declares 2 entries but has 1"),
+    "unquoted_string": (replace_line(VALID_GEOMETRY_LINES, "Ge/Box/Material", "s:Ge/Box/Material = Plastic"), VALID_SCRIPT_LINES,
+                        "is a string and must be quoted"),
+    "boolean": (VALID_GEOMETRY_LINES, replace_line(VALID_SCRIPT_LINES, "Ts/ShowCPUTime", 'b:Ts/ShowCPUTime = "Yes"'),
+                'must be "True" or "False"'),
+    "integer": (VALID_GEOMETRY_LINES, replace_line(VALID_SCRIPT_LINES, "Ts/NumberOfThreads", "i:Ts/NumberOfThreads = 1.5"),
+                "must be an integer"),
+    "missing_unit": (replace_line(VALID_GEOMETRY_LINES, "Ge/Box/HLZ", "d:Ge/Box/HLZ = 10"), VALID_SCRIPT_LINES,
+                     "Ge/Box/HLZ needs a unit"),
+    "wrong_unit": (replace_line(VALID_GEOMETRY_LINES, "Ge/Box/HLZ", "d:Ge/Box/HLZ = 10 MeV"), VALID_SCRIPT_LINES,
+                   "Ge/Box/HLZ needs length units, not energy units"),
+    "referenced_unit": (VALID_GEOMETRY_LINES + ["d:Ge/Box/TransX = So/Beam/BeamEnergy cm"], VALID_SCRIPT_LINES,
+                        "references So/Beam/BeamEnergy, which has energy units"),
+    "unknown_reference": (VALID_GEOMETRY_LINES + ["d:Ge/Box/TransX = Ge/Missing/HLX cm"], VALID_SCRIPT_LINES,
+                          "references Ge/Missing/HLX, which is never set"),
+    "unknown_parent": (replace_line(VALID_GEOMETRY_LINES, "Ge/Box/Parent", 's:Ge/Box/Parent = "Nowhere"'), VALID_SCRIPT_LINES,
+                       'names "Nowhere", which is not a component of the geometry'),
+    "no_parent": (replace_line(VALID_GEOMETRY_LINES, "Ge/Box/Parent"), VALID_SCRIPT_LINES,
+                  "Ge/Box has no Parent"),
+    "parent_loop": (replace_line(replace_line(VALID_GEOMETRY_LINES, "Ge/Box/Parent", 's:Ge/Box/Parent = "Holder"'),
+                                 "Ge/Holder/Parent", 's:Ge/Holder/Parent = "Box"'), VALID_SCRIPT_LINES,
+                    "is its own ancestor"),
+    "no_type": (replace_line(VALID_GEOMETRY_LINES, "Ge/Holder/Type"), VALID_SCRIPT_LINES,
+                "Ge/Holder is set up but has no Type"),
+    "unknown_material": (replace_line(VALID_GEOMETRY_LINES, "Ge/Box/Material", 's:Ge/Box/Material = "Unobtainium"'), VALID_SCRIPT_LINES,
+                         "Unobtainium, which is neither defined under Ma/ nor a TOPAS or G4_ material"),
+    "no_fractions": (replace_line(VALID_GEOMETRY_LINES, "Ma/Plastic/Fractions"), VALID_SCRIPT_LINES,
+                     "Ma/Plastic lists its Components but no Fractions"),
+    "fraction_count": (replace_line(VALID_GEOMETRY_LINES, "Ma/Plastic/Fractions", "uv:Ma/Plastic/Fractions = 3 0.8 0.1 0.1"), VALID_SCRIPT_LINES,
+                       "Ma/Plastic has a different number of Fractions and Components"),
+    "fraction_sum": (replace_line(VALID_GEOMETRY_LINES, "Ma/Plastic/Fractions", "uv:Ma/Plastic/Fractions = 2 0.9 0.2"), VALID_SCRIPT_LINES,
+                     "Ma/Plastic/Fractions sum to 1.1, not 1"),
+    "no_density": (replace_line(VALID_GEOMETRY_LINES, "Ma/Plastic/Density"), VALID_SCRIPT_LINES,
+                   "Ma/Plastic has no Density"),
+    "scorer_in_group": (VALID_GEOMETRY_LINES, replace_line(VALID_SCRIPT_LINES, "Sc/Scorer/Component", 's:Sc/Scorer/Component = "Holder"'),
+                        "is the group Holder, which has no volume to score in"),
+}
+
+
+@pytest.fixture
+def experiment_parameters() -> ExperimentParameters:
+    return ExperimentParameters.from_toml(EXPERIMENT_PARAMETERS_PATH)
+
+
+@pytest.fixture
+def checked_scripts(monkeypatch) -> List[tuple]:
+    # Keeps the lines each pre-flight check is given instead of only whether they passed
+    checked_scripts = []
+    preflight_checks = script_generator.run_preflight_checks
+
+    def record_preflight_checks(geometry_lines, script_lines, base_parameters_lines=None):
+        checked_scripts.append((script_lines, base_parameters_lines))
+        return preflight_checks(geometry_lines, script_lines, base_parameters_lines)
+
+    monkeypatch.setattr(script_generator, "run_preflight_checks", record_preflight_checks)
+    return checked_scripts
+
+
+def test_valid_fixture_passes():
+    report = check_run_script(VALID_GEOMETRY_LINES, VALID_SCRIPT_LINES)
+    assert report.errors == []
+    assert report.warnings == []
+    assert report.number_of_components == 3
+
+
+@pytest.mark.parametrize("fixture_name", FAILING_FIXTURES)
+def test_failing_fixture_is_caught(fixture_name):
+    geometry_lines, script_lines, expected_error = FAILING_FIXTURES[fixture_name]
+    report = check_run_script(geometry_lines, script_lines)
+    assert any(expected_error in error for error in report.errors), report.errors
+
+
+def test_errors_point_at_their_source_line():
+    geometry_lines = replace_line(VALID_GEOMETRY_LINES, "Ge/Box/HLZ", "d:Ge/Box/HLZ = 10")
+    script_lines = ["i:Ts/NumberOfThreads = 1.5"] + geometry_lines + VALID_SCRIPT_LINES[1:]
+    report = check_run_script(geometry_lines, script_lines)
+    assert "EXPERIMENT_GEOMETRY.txt:10 Ge/Box/HLZ needs a unit -> 10" in report.errors
+    assert "generated run script:1 Ts/NumberOfThreads must be an integer -> 1.5" in report.errors
+
+
+def test_unknown_unit_is_a_warning():
+    report = check_run_script(VALID_GEOMETRY_LINES + ["d:Ge/Box/TransX = 3 furlong"], VALID_SCRIPT_LINES)
+    assert report.errors == []
+    assert report.warnings == ["EXPERIMENT_GEOMETRY.txt:14 Ge/Box/TransX has a unit the pre-flight checks do not know -> furlong"]
+
+
+def test_failed_checks_raise_with_every_problem():
+    geometry_lines = replace_line(VALID_GEOMETRY_LINES, "Ma/Plastic/Density")
+    script_lines = replace_line(VALID_SCRIPT_LINES, "Ts/NumberOfThreads", "i:Ts/NumberOfThreads = many")
+    with pytest.raises(ValueError, match="found 2 problems"):
+        run_preflight_checks(geometry_lines, script_lines)
+
+
+def test_base_parameters_are_checked_with_the_run_script():
+    base_parameters_lines = ["i:Ts/Seed = 1"] + VALID_GEOMETRY_LINES + ['s:Sc/Scorer/Component = "Holder"']
+    script_lines = [f"includeFile = {BASE_PARAMETERS_FILENAME}", "i:Ts/NumberOfThreads = 1", "d:So/Beam/BeamEnergy = 100 MeV"]
+    report = check_run_script(VALID_GEOMETRY_LINES, script_lines, base_parameters_lines)
+    assert report.errors == [f"{BASE_PARAMETERS_SOURCE_NAME}:15 Sc/Scorer/Component is the group Holder, which has no volume to score in"]
+
+
+@pytest.mark.parametrize("script_generation_mode", list(ScriptGenerationMode))
+def test_first_run_script_of_the_experiment_passes(experiment_parameters, script_generation_mode):
+    report = check_first_run_script(experiment_parameters.model_copy(update={"script_generation_mode": script_generation_mode}))
+    assert report.errors == []
+
+
+def test_include_file_mode_checks_the_base_file_and_run_script(experiment_parameters, checked_scripts):
+    check_first_run_script(experiment_parameters.model_copy(update={"script_generation_mode": ScriptGenerationMode.include_file}))
+    [(script_lines, base_parameters_lines)] = checked_scripts
+    assert script_lines[0] == f"includeFile = {BASE_PARAMETERS_FILENAME}"
+    assert any(line.startswith("s:Ph/ListName") for line in base_parameters_lines)
+
+
+def test_sweep_checks_the_first_sweep_point(experiment_parameters, checked_scripts):
+    sweep = Sweep.model_validate({"sampling": "grid",
+                                  "axes": [{"parameter": "physics_modules", "values": [["g4em-standard_opt3", "g4decay"]]}]})
+    check_first_run_script(experiment_parameters.model_copy(update={"sweep": sweep}))
+    [(script_lines, base_parameters_lines)] = checked_scripts
+    assert base_parameters_lines is None
+    assert 'sv:Ph/Default/Modules = 2 "g4em-standard_opt3" "g4decay"' in script_lines
+    assert any(line.endswith('/sweep_point_000000"') for line in script_lines)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
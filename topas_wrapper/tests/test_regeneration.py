@@ -0,0 +1,168 @@
+from pathlib import Path
+from typing import List
+import numpy as np
+import pytest
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.input_constants import ScriptGenerationMode
+from topas_wrapper.main import run_pipeline
+from topas_wrapper.regeneration import has_valid_output, STALE_FOLDERNAME
+from topas_wrapper.run_simulations import run_experiment
+from topas_wrapper.script_generator import generate_scripts, BASE_PARAMETERS_FILENAME
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+from topas_wrapper.scorer_output import ScorerOutput, parse_scorer_header, write_scorer_output
+from topas_wrapper.telemetry import TelemetryLedger
+from topas_wrapper.work_queue import enqueue_experiment, PENDING_FOLDERNAME
+
+EXPERIMENT_PARAMETERS_PATH = Path(__file__).resolve().parents[1] / "EXPERIMENT_PARAMETERS.toml"
+STUB_TOPAS_PATH = Path(__file__).resolve().parents[1] / "benchmarks" / "stub_topas.py"
+HEADER_LINES = ["# Results for scorer: Scorer",
+                "# X in 1 bin of 1 cm",
+                "# Y in 1 bin of 1 cm",
+                "# Z in 4 bins of 1 cm",
+                "# EnergyDeposit ( MeV ) : Sum"]
+
+
+@pytest.fixture
+def experiment_parameters(tmp_path, monkeypatch) -> ExperimentParameters:
+    # An absolute experiment name puts the experiment in the test's folder instead of experiments/
+    monkeypatch.setenv("STUB_TOPAS_STARTUP_SECONDS", "0")
+    monkeypatch.setenv("STUB_TOPAS_SECONDS_PER_HISTORY", "0")
+    experiment_parameters = ExperimentParameters.from_toml(EXPERIMENT_PARAMETERS_PATH)
+    return experiment_parameters.model_copy(update={"experiment_name": str(tmp_path / "experiment"),
+                                                    "overwrite_existing_experiment": False,
+                                                    "regenerate_incrementally": True,
+                                                    "use_result_cache": False,
+                                                    "numbers_of_histories": [10]})
+
+
+def update_particle_source(experiment_parameters: ExperimentParameters, **update) -> ExperimentParameters:
+    particle_source = experiment_parameters.particle_source.model_copy(update=update)
+    return experiment_parameters.model_copy(update={"particle_source": particle_source})
+
+
+def write_run_files(script_path: Path):
+    # Stands in for a finished run: its output and sidecar, a log, and the shard and retry files it left behind
+    output_filepath = read_output_filepath(read_script_lines(script_path))
+    write_scorer_output(ScorerOutput(parse_scorer_header(HEADER_LINES), {"Sum": np.ones((1, 1, 4))}, output_filepath), output_filepath)
+    assert has_valid_output(script_path)
+    script_path.with_suffix(".log").write_text("done\n")
+    (script_path.parent / f"{script_path.stem}_shard_0.txt").write_text(f"includeFile = {script_path.name}\n")
+    (script_path.parent / f"{script_path.stem}_retry_1.txt").write_text(f"includeFile = {script_path.name}\n")
+    output_filepath.with_name(f"{output_filepath.name}_shard_0.csv").write_text("")
+
+
+def list_names(folder: Path) -> List[str]:
+    return sorted(path.name for path in folder.iterdir() if path.is_file()) if folder.is_dir() else []
+
+
+def list_run_files(folder: Path, run_name: str) -> List[str]:
+    return [name for name in list_names(folder) if name.lstrip(".").startswith(run_name)]
+
+
+def generate_with_run_files(experiment_parameters: ExperimentParameters) -> List[Path]:
+    script_paths = generate_scripts(experiment_parameters)
+    for script_path in script_paths:
+        write_run_files(script_path)
+    return script_paths
+
+
+def test_unchanged_script_keeps_its_data(experiment_parameters):
+    script_paths = generate_with_run_files(experiment_parameters)
+    scripts_folder = script_paths[0].parent
+    data_folder = scripts_folder.parent / "data"
+    script_names, data_names = list_names(scripts_folder), list_names(data_folder)
+    assert generate_scripts(experiment_parameters) == script_paths
+    assert list_names(scripts_folder) == script_names
+    assert list_names(data_folder) == data_names
+    assert not (data_folder / STALE_FOLDERNAME).exists()
+    assert all(has_valid_output(script_path) for script_path in script_paths)
+
+
+def test_changed_script_moves_its_files_to_stale(experiment_parameters):
+    [script_path, *_] = generate_with_run_files(experiment_parameters)
+    scripts_folder = script_path.parent
+    data_folder = scripts_folder.parent / "data"
+    run_name = script_path.stem
+    run_script_files, run_data_files = list_run_files(scripts_folder, run_name), list_run_files(data_folder, run_name)
+    assert f".{run_name}.csv.npz" in run_data_files
+    generate_scripts(update_particle_source(experiment_parameters, beam_position_spread_x=0.6))
+    assert list_run_files(scripts_folder, run_name) == [script_path.name]
+    assert list_run_files(data_folder, run_name) == []
+    assert list_run_files(scripts_folder / STALE_FOLDERNAME, run_name) == [name for name in run_script_files if name != script_path.name]
+    assert list_run_files(data_folder / STALE_FOLDERNAME, run_name) == run_data_files
+    assert "BeamPositionSpreadX = 0.6 cm" in script_path.read_text()
+    assert not has_valid_output(script_path)
+
+
+def test_run_no_longer_in_the_sweep_is_retired_with_its_script(experiment_parameters):
+    script_paths = generate_with_run_files(experiment_parameters)
+    scripts_folder = script_paths[0].parent
+    data_folder = scripts_folder.parent / "data"
+    removed_run_name = script_paths[-1].stem
+    removed_script_files = list_run_files(scripts_folder, removed_run_name)
+    removed_data_files = list_run_files(data_folder, removed_run_name)
+    particle_source = experiment_parameters.particle_source
+    kept_script_paths = generate_scripts(update_particle_source(experiment_parameters,
+                                                                beam_energy=particle_source.beam_energy[:-1],
+                                                                beam_energy_spreads=particle_source.beam_energy_spreads[:-1]))
+    assert kept_script_paths == script_paths[:-1]
+    assert list_run_files(scripts_folder, removed_run_name) == []
+    assert list_run_files(scripts_folder / STALE_FOLDERNAME, removed_run_name) == removed_script_files
+    assert list_run_files(data_folder / STALE_FOLDERNAME, removed_run_name) == removed_data_files
+    assert all(has_valid_output(script_path) for script_path in kept_script_paths)
+
+
+def test_include_file_base_change_is_detected(experiment_parameters):
+    # The run scripts are rewritten byte for byte, so only the hash taken before the base file is rewritten tells them apart
+    experiment_parameters = experiment_parameters.model_copy(update={"script_generation_mode": ScriptGenerationMode.include_file})
+    script_paths = generate_with_run_files(experiment_parameters)
+    scripts_folder = script_paths[0].parent
+    run_script_texts = [script_path.read_text() for script_path in script_paths]
+    generate_scripts(update_particle_source(experiment_parameters, beam_position_spread_x=0.6))
+    assert [script_path.read_text() for script_path in script_paths] == run_script_texts
+    assert "BeamPositionSpreadX = 0.6 cm" in (scripts_folder / BASE_PARAMETERS_FILENAME).read_text()
+    assert not any(has_valid_output(script_path) for script_path in script_paths)
+    assert len(list_names(scripts_folder.parent / "data" / STALE_FOLDERNAME)) == 3 * len(script_paths)
+
+
+def add_beam_energy(experiment_parameters: ExperimentParameters, beam_energy: float) -> ExperimentParameters:
+    particle_source = experiment_parameters.particle_source
+    return update_particle_source(experiment_parameters,
+                                  beam_energy=particle_source.beam_energy + [beam_energy],
+                                  beam_energy_spreads=particle_source.beam_energy_spreads + [particle_source.beam_energy_spreads[-1]])
+
+
+def read_recorded_script_names(ledger_path: Path) -> List[str]:
+    telemetry_ledger = TelemetryLedger(ledger_path)
+    script_names = [script_name for script_name, in telemetry_ledger.connection.execute("SELECT script_name FROM runs ORDER BY id")]
+    telemetry_ledger.close()
+    return script_names
+
+
+def test_run_experiment_skips_only_up_to_date_runs(tmp_path, experiment_parameters):
+    run_experiment(experiment_parameters, str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    [result] = run_experiment(add_beam_energy(experiment_parameters, 190), str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    assert result.succeeded
+    assert result.job.script_path.name == "beam_energy_190p00_MeV_number_of_histories_10.txt"
+
+
+def test_enqueue_experiment_skips_only_up_to_date_runs(tmp_path, experiment_parameters):
+    run_experiment(experiment_parameters, str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    work_queue = enqueue_experiment(add_beam_energy(experiment_parameters, 190))
+    [job_filepath] = work_queue.list_job_files(PENDING_FOLDERNAME)
+    assert "beam_energy_190p00_MeV_number_of_histories_10" in job_filepath.name
+
+
+def test_run_pipeline_skips_only_up_to_date_runs(tmp_path, experiment_parameters):
+    ledger_path = tmp_path / "telemetry.sqlite"
+    run_pipeline(experiment_parameters, str(STUB_TOPAS_PATH), telemetry_ledger=TelemetryLedger(ledger_path))
+    number_of_runs = len(experiment_parameters.particle_source.beam_energy)
+    assert len(read_recorded_script_names(ledger_path)) == number_of_runs
+    metrics = run_pipeline(add_beam_energy(experiment_parameters, 190), str(STUB_TOPAS_PATH), telemetry_ledger=TelemetryLedger(ledger_path))
+    assert read_recorded_script_names(ledger_path)[number_of_runs:] == ["beam_energy_190p00_MeV_number_of_histories_10.txt"]
+    # The up-to-date runs are still analysed
+    assert len(metrics) == number_of_runs + 1
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,109 @@
+from pathlib import Path
+from typing import Dict, List
+import numpy as np
+import pytest
+from topas_wrapper.get_data import ExperimentParameters
+from topas_wrapper.results_store import ingest_experiment, ResultsStore, locate_results_store_folder
+from topas_wrapper.script_generator import generate_scripts
+from topas_wrapper.script_reader import read_script_lines, read_output_filepath
+from topas_wrapper.scorer_output import ScorerOutput, parse_scorer_header, write_scorer_output
+
+EXPERIMENT_PARAMETERS_PATH = Path(__file__).resolve().parents[1] / "EXPERIMENT_PARAMETERS.toml"
+SHAPE = (2, 3, 5)
+HEADER_LINES = ["# Results for scorer: Scorer",
+                "# X in 2 bins of 1 cm",
+                "# Y in 3 bins of 1 cm",
+                "# Z in 5 bins of 0.5 cm",
+                "# EnergyDeposit ( MeV ) : Sum   Mean"]
+NUMBERS_OF_HISTORIES = [10, 20]
+
+
+@pytest.fixture
+def experiment_parameters(tmp_path) -> ExperimentParameters:
+    # An absolute experiment name puts the experiment in the test's folder instead of experiments/
+    experiment_parameters = ExperimentParameters.from_toml(EXPERIMENT_PARAMETERS_PATH)
+    return experiment_parameters.model_copy(update={"experiment_name": str(tmp_path / "experiment"),
+                                                    "overwrite_existing_experiment": True,
+                                                    "numbers_of_histories": NUMBERS_OF_HISTORIES})
+
+
+def write_output(output_filepath: Path, rng: np.random.Generator, binary: bool=False) -> Dict[str, np.ndarray]:
+    statistics = {"Sum": rng.random(SHAPE), "Mean": rng.random(SHAPE)}
+    write_scorer_output(ScorerOutput(parse_scorer_header(HEADER_LINES), statistics, output_filepath), output_filepath, binary=binary)
+    return statistics
+
+
+def write_derived_scripts(script_path: Path, rng: np.random.Generator) -> List[Path]:
+    # Shard, batch and retry scripts with outputs of their own, none of which belong in the store
+    output_filepath = read_output_filepath(read_script_lines(script_path))
+    derived_script_paths = []
+    for suffix in ("shard_0", "batch_1", "retry_2"):
+        derived_script_path = script_path.parent / f"{script_path.stem}_{suffix}.txt"
+        derived_output_filepath = output_filepath.parent / f"{output_filepath.name}_{suffix}"
+        derived_script_path.write_text(f"includeFile = {script_path.name}\n"
+                                       f's:Sc/Scorer/OutputFile = "{derived_output_filepath}"\n')
+        write_output(derived_output_filepath, rng)
+        derived_script_paths.append(derived_script_path)
+    return derived_script_paths
+
+
+@pytest.fixture
+def experiment(experiment_parameters) -> Dict[tuple, Dict[str, np.ndarray]]:
+    # Every run gets its own random statistics, keyed by (beam energy, number of histories)
+    rng = np.random.default_rng(5)
+    run_statistics = {}
+    script_paths = generate_scripts(experiment_parameters)
+    energies_and_histories = [(beam_energy, number_of_histories) for beam_energy in experiment_parameters.particle_source.beam_energy
+                              for number_of_histories in NUMBERS_OF_HISTORIES]
+    for script_path in script_paths:
+        beam_energy, number_of_histories = next((beam_energy, number_of_histories) for beam_energy, number_of_histories in energies_and_histories
+                                                if script_path.stem == f"beam_energy_{beam_energy:.2f}_MeV_number_of_histories_{number_of_histories}".replace(".", "p"))
+        output_filepath = read_output_filepath(read_script_lines(script_path))
+        run_statistics[(beam_energy, number_of_histories)] = write_output(output_filepath, rng, binary=len(run_statistics) % 2 == 1)
+        write_derived_scripts(script_path, rng)
+    return run_statistics
+
+
+def test_selected_runs_round_trip(experiment_parameters, experiment):
+    experiment_folder = Path(experiment_parameters.experiment_name)
+    store = ingest_experiment(experiment_folder, experiment_parameters.particle_source.component)
+    assert len(store) == len(experiment)
+    assert not any(run_name.endswith(("shard_0", "batch_1", "retry_2")) for run_name in store.metadata["run_name"])
+    assert store.statistic_names == ["Sum", "Mean"]
+    # Sorted by beam energy, then histories
+    assert list(zip(store.metadata["beam_energy"], store.metadata["number_of_histories"])) == sorted(experiment)
+    for (beam_energy, number_of_histories), statistics in experiment.items():
+        [row] = store.select(beam_energy=beam_energy, number_of_histories=number_of_histories)
+        assert store.metadata["run_name"][row].endswith(f"_{number_of_histories}")
+        for statistic_name, values in statistics.items():
+            np.testing.assert_allclose(store.load(statistic_name, np.array([row]))[0], values, rtol=1e-9)
+            np.testing.assert_allclose(store.scorer_output(row)[statistic_name], values, rtol=1e-9)
+
+
+def test_select_by_one_parameter_returns_every_match(experiment_parameters, experiment):
+    store = ingest_experiment(Path(experiment_parameters.experiment_name), experiment_parameters.particle_source.component)
+    rows = store.select(beam_energy=130)
+    assert list(store.metadata["number_of_histories"][rows]) == NUMBERS_OF_HISTORIES
+    np.testing.assert_allclose(store.load("Sum", rows), [experiment[(130, n)]["Sum"] for n in NUMBERS_OF_HISTORIES], rtol=1e-9)
+    assert len(store.select(number_of_histories=20)) == len(experiment_parameters.particle_source.beam_energy)
+    assert len(store.select(beam_energy=131)) == 0
+    assert len(store.select(seed=experiment_parameters.seed_number)) == len(experiment)
+
+
+def test_store_reopens_from_disk_and_skips_runs_without_output(experiment_parameters, experiment, capsys):
+    experiment_folder = Path(experiment_parameters.experiment_name)
+    [missing_script_path, *_] = sorted((experiment_folder / "scripts").glob("beam_energy_170p00*_10.txt"))
+    output_filepath = read_output_filepath(read_script_lines(missing_script_path))
+    for filepath in output_filepath.parent.glob(f"{output_filepath.name}.*"):
+        filepath.unlink()
+    ingest_experiment(experiment_folder, experiment_parameters.particle_source.component)
+    assert f"No output for {missing_script_path.name}, skipping it." in capsys.readouterr().out
+    store = ResultsStore(locate_results_store_folder(experiment_folder))
+    assert len(store) == len(experiment) - 1
+    assert len(store.select(beam_energy=170, number_of_histories=10)) == 0
+    with pytest.raises(KeyError, match="no statistic Variance"):
+        store["Variance"]
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
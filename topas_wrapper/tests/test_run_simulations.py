@@ -0,0 +1,125 @@
+import sys
+from pathlib import Path
+from typing import Dict, List, Tuple
+import pytest
+from topas_wrapper.run_simulations import SimulationJob, run_simulations
+
+# Stands in for topas. It reads how long to run, how many output rows to write and what to exit with from
+# the parameter file, and records when it starts and ends so the tests can see which runs overlapped.
+STUB_TOPAS_SOURCE = '''
+import sys
+import time
+from pathlib import Path
+
+script_path = Path(sys.argv[1])
+parameters = {}
+for line in script_path.read_text().splitlines():
+    name, _, value = line.partition("=")
+    parameters[name.split(":")[-1].strip()] = value.strip().strip('"')
+
+def record(event):
+    with (script_path.parent / "events.txt").open("a") as f:
+        f.write(f"{event} {script_path.stem} {time.time()}\\n")
+
+record("start")
+print(f"Stub TOPAS running -> {script_path.name}", flush=True)
+time.sleep(float(parameters["Stub/Seconds"]))
+number_of_rows = int(parameters["Stub/OutputRows"])
+if number_of_rows >= 0:
+    with open(parameters["Sc/Scorer/OutputFile"] + ".csv", "w") as f:
+        f.write("# X in 1 bin of 1 cm\\n# Y in 1 bin of 1 cm\\n# Z in 2 bins of 1 cm\\n# EnergyDeposit ( MeV ) : Sum\\n")
+        f.write("".join(f"0, 0, {z}, 1.5\\n" for z in range(number_of_rows)))
+record("end")
+sys.exit(int(parameters["Stub/ExitCode"]))
+'''
+COMPLETE_OUTPUT_ROWS = 2
+RUN_SECONDS = 0.3
+
+
+@pytest.fixture
+def stub_topas(tmp_path) -> str:
+    stub_path = tmp_path / "topas"
+    stub_path.write_text(f"#!{sys.executable}\n{STUB_TOPAS_SOURCE}")
+    stub_path.chmod(0o755)
+    return str(stub_path)
+
+
+def create_job(folder: Path, run_name: str, number_of_threads: int, exit_code: int=0,
+               output_rows: int=COMPLETE_OUTPUT_ROWS, seconds: float=RUN_SECONDS) -> SimulationJob:
+    script_path = folder / f"{run_name}.txt"
+    script_path.write_text(f"i:Ts/NumberOfThreads = {number_of_threads}\n"
+                           f"s:Sc/Scorer/OutputFile = \"{folder / run_name}\"\n"
+                           f"d:Stub/Seconds = {seconds}\n"
+                           f"i:Stub/OutputRows = {output_rows}\n"
+                           f"i:Stub/ExitCode = {exit_code}\n")
+    return SimulationJob(script_path, number_of_threads)
+
+
+def read_run_intervals(folder: Path) -> Dict[str, Tuple[float, float]]:
+    events = {}
+    for line in (folder / "events.txt").read_text().splitlines():
+        event, run_name, event_time = line.split()
+        events[(event, run_name)] = float(event_time)
+    return {run_name: (start_time, events[("end", run_name)]) for (event, run_name), start_time in events.items() if event == "start"}
+
+
+def find_overlapping_runs(run_intervals: Dict[str, Tuple[float, float]], run_name: str) -> List[str]:
+    start_time, end_time = run_intervals[run_name]
+    return [other_run_name for other_run_name, (other_start_time, other_end_time) in run_intervals.items()
+            if other_run_name != run_name and other_start_time < end_time and start_time < other_end_time]
+
+
+def compute_peak_cores(run_intervals: Dict[str, Tuple[float, float]], cores: Dict[str, int]) -> int:
+    changes = sorted([(start_time, cores[run_name]) for run_name, (start_time, _) in run_intervals.items()]
+                     + [(end_time, -cores[run_name]) for run_name, (_, end_time) in run_intervals.items()])
+    cores_in_use = 0
+    peak_cores = 0
+    for _, change in changes:
+        cores_in_use += change
+        peak_cores = max(peak_cores, cores_in_use)
+    return peak_cores
+
+
+def test_jobs_are_packed_under_the_core_budget(tmp_path, stub_topas):
+    threads = {"run_0": 2, "run_1": 3, "run_2": 1, "run_3": 2, "run_4": 4, "run_5": 1}
+    jobs = [create_job(tmp_path, run_name, number_of_threads) for run_name, number_of_threads in threads.items()]
+    results = run_simulations(jobs, core_budget=4, topas_executable=stub_topas)
+    assert [result.succeeded for result in results] == [True] * len(jobs)
+    assert compute_peak_cores(read_run_intervals(tmp_path), threads) == 4
+    # run_1 does not fit beside run_0, but run_2 from further down the queue is started in its place
+    assert "run_2" in find_overlapping_runs(read_run_intervals(tmp_path), "run_0")
+
+
+def test_zero_threads_takes_the_whole_budget(tmp_path, stub_topas):
+    jobs = [create_job(tmp_path, "run_0", 1), create_job(tmp_path, "run_1", 0), create_job(tmp_path, "run_2", 1)]
+    results = run_simulations(jobs, core_budget=4, topas_executable=stub_topas)
+    assert all(result.succeeded for result in results)
+    assert find_overlapping_runs(read_run_intervals(tmp_path), "run_1") == []
+
+
+def test_job_larger_than_the_core_budget_is_rejected(tmp_path, stub_topas):
+    with pytest.raises(ValueError):
+        run_simulations([create_job(tmp_path, "run_0", 8)], core_budget=4, topas_executable=stub_topas)
+
+
+def test_failures_are_reported(tmp_path, stub_topas, capsys):
+    jobs = [create_job(tmp_path, "succeeds", 1),
+            create_job(tmp_path, "crashes", 1, exit_code=3, output_rows=-1),
+            create_job(tmp_path, "writes_nothing", 1, output_rows=-1),
+            create_job(tmp_path, "stops_short", 1, output_rows=COMPLETE_OUTPUT_ROWS - 1)]
+    results = {result.job.script_path.stem: result for result in run_simulations(jobs, core_budget=4, topas_executable=stub_topas)}
+    output = capsys.readouterr().out
+    assert results["succeeds"].succeeded
+    assert results["crashes"].return_code == 3
+    assert not results["crashes"].succeeded
+    for run_name in ("writes_nothing", "stops_short"):
+        assert results[run_name].return_code == 0
+        assert not results[run_name].output_valid
+        assert f"Simulation output missing or incomplete -> {run_name}.txt" in output
+    assert "Simulation failed with exit code 3 -> crashes.txt" in output
+    assert "1 of 4 simulations successful." in output
+    assert "Stub TOPAS running -> crashes.txt" in results["crashes"].log_path.read_text()
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,63 @@
+from pathlib import Path
+import numpy as np
+import pytest
+from topas_wrapper.scorer_output import (ScorerOutput,
+                                         parse_scorer_header,
+                                         write_scorer_output,
+                                         check_scorer_output_complete,
+                                         validate_scorer_output)
+
+SHAPE = (2, 3, 40)
+HEADER_LINES = ["# Results for scorer: Scorer",
+                "# X in 2 bins of 1 cm",
+                "# Y in 3 bins of 1 cm",
+                "# Z in 40 bins of 0.5 cm",
+                "# EnergyDeposit ( MeV ) : Sum   Mean"]
+
+
+def write_output(output_filepath: Path, binary: bool=False) -> Path:
+    rng = np.random.default_rng(0)
+    statistics = {"Sum": rng.random(SHAPE), "Mean": rng.random(SHAPE)}
+    return write_scorer_output(ScorerOutput(parse_scorer_header(HEADER_LINES), statistics, output_filepath), output_filepath, binary=binary)
+
+
+def truncate(filepath: Path, number_of_bytes: int):
+    with filepath.open("r+b") as f:
+        f.truncate(filepath.stat().st_size - number_of_bytes)
+
+
+@pytest.mark.parametrize("binary", [False, True])
+def test_complete_output_is_complete(tmp_path, binary):
+    write_output(tmp_path / "run", binary)
+    assert check_scorer_output_complete(tmp_path / "run")
+    assert validate_scorer_output(tmp_path / "run")
+
+
+def test_csv_cut_mid_row_is_incomplete(tmp_path):
+    truncate(write_output(tmp_path / "run"), 3)
+    assert not check_scorer_output_complete(tmp_path / "run")
+
+
+def test_csv_cut_between_rows_is_incomplete(tmp_path):
+    filepath = write_output(tmp_path / "run")
+    lines = filepath.read_text().splitlines(keepends=True)
+    filepath.write_text("".join(lines[:-5]))
+    assert not check_scorer_output_complete(tmp_path / "run")
+
+
+def test_csv_with_only_a_header_is_incomplete(tmp_path):
+    (tmp_path / "run.csv").write_text("".join(f"{line}\n" for line in HEADER_LINES))
+    assert not check_scorer_output_complete(tmp_path / "run")
+
+
+def test_binary_cut_short_is_incomplete(tmp_path):
+    truncate(write_output(tmp_path / "run", binary=True), 8)
+    assert not check_scorer_output_complete(tmp_path / "run")
+
+
+def test_missing_output_is_incomplete(tmp_path):
+    assert not check_scorer_output_complete(tmp_path / "run")
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,106 @@
+import math
+from typing import Tuple
+import numpy as np
+import pytest
+from topas_wrapper.sliced_analysis import (BoxSum,
+                                           axis_slice,
+                                           projection,
+                                           lateral_profile,
+                                           roi_sum,
+                                           rebin,
+                                           run_slice_pass)
+
+SHAPE = (11, 7, 13)
+PLANE_BYTES = SHAPE[1] * SHAPE[2] * np.dtype(np.float64).itemsize
+# From one x plane per chunk up to the whole grid in a single chunk
+CHUNK_PLANES = [1, 2, 4, 5, SHAPE[0]]
+
+
+@pytest.fixture
+def grid() -> np.ndarray:
+    return np.random.default_rng(1).random(SHAPE)
+
+
+def rebin_directly(grid: np.ndarray, factors: Tuple[int, int, int]) -> np.ndarray:
+    # Pads every axis with zeros up to a whole number of blocks, so trailing partial blocks sum what they have
+    padded_shape = tuple(math.ceil(size / factor) * factor for size, factor in zip(grid.shape, factors))
+    padded_grid = np.zeros(padded_shape)
+    padded_grid[:grid.shape[0], :grid.shape[1], :grid.shape[2]] = grid
+    blocked_shape = [size for padded_size, factor in zip(padded_shape, factors) for size in (padded_size // factor, factor)]
+    return padded_grid.reshape(blocked_shape).sum(axis=(1, 3, 5))
+
+
+@pytest.mark.parametrize("chunk_planes", CHUNK_PLANES)
+def test_requests_match_direct_sums(grid, chunk_planes):
+    requests = [axis_slice(0, 4),
+                axis_slice(2, 12),
+                projection((2,)),
+                projection((0, 2)),
+                lateral_profile(1, (3, 9)),
+                roi_sum((2, 9), (1, 6), (0, 5)),
+                roi_sum(),
+                rebin(3, 2, 4),
+                rebin(1, 1, 13)]
+    expected_results = [grid[4],
+                        grid[:, :, 12],
+                        grid.sum(axis=(0, 1)),
+                        grid.sum(axis=1),
+                        grid[:, :, 3:9].sum(axis=(0, 2)),
+                        grid[2:9, 1:6, 0:5].sum(),
+                        grid.sum(),
+                        rebin_directly(grid, (3, 2, 4)),
+                        grid.sum(axis=2, keepdims=True)]
+    results = run_slice_pass(grid, requests, chunk_bytes=chunk_planes * PLANE_BYTES)
+    for result, expected_result in zip(results, expected_results):
+        assert result.shape == np.shape(expected_result)
+        np.testing.assert_allclose(result, expected_result, rtol=1e-12)
+
+
+@pytest.mark.parametrize("x_factor", [2, 3, 4, 11, 20])
+def test_rebin_keeps_a_trailing_partial_block_across_chunk_sizes(grid, x_factor):
+    # Chunks are rounded to whole x blocks, so a block is never split between two chunks
+    for chunk_planes in CHUNK_PLANES:
+        [result] = run_slice_pass(grid, [rebin(x_factor, 5, 1)], chunk_bytes=chunk_planes * PLANE_BYTES)
+        assert result.shape == (math.ceil(SHAPE[0] / x_factor), 2, SHAPE[2])
+        np.testing.assert_allclose(result, rebin_directly(grid, (x_factor, 5, 1)), rtol=1e-12)
+
+
+def test_memory_mapped_float32_grid_is_summed_in_float64(tmp_path, grid):
+    filepath = tmp_path / "grid.bin"
+    grid.astype(np.float32).tofile(filepath)
+    mapped_grid = np.memmap(filepath, dtype=np.float32, mode="r", shape=SHAPE)
+    [result] = run_slice_pass(mapped_grid, [projection((2,))], chunk_bytes=2 * PLANE_BYTES)
+    assert result.dtype == np.float64
+    np.testing.assert_allclose(result, grid.astype(np.float32).astype(np.float64).sum(axis=(0, 1)), rtol=1e-12)
+
+
+def test_requests_are_reset_between_passes(grid):
+    request = projection((0,))
+    run_slice_pass(grid, [request])
+    [result] = run_slice_pass(grid, [request])
+    np.testing.assert_allclose(result, grid.sum(axis=(1, 2)))
+
+
+@pytest.mark.parametrize("request_factory, expected_error", [
+    (lambda: roi_sum(x_bounds=(5, 12)), "outside axis 0"),
+    (lambda: roi_sum(z_bounds=(4, 4)), "outside axis 2"),
+    (lambda: lateral_profile(2), "not axis 2"),
+    (lambda: rebin(0, 1, 1), "at least one"),
+])
+def test_invalid_requests_are_rejected(grid, request_factory, expected_error):
+    with pytest.raises(ValueError, match=expected_error):
+        run_slice_pass(grid, [request_factory()])
+
+
+def test_grid_must_be_three_dimensional():
+    with pytest.raises(ValueError, match="2 dimensions"):
+        run_slice_pass(np.zeros((3, 4)), [roi_sum()])
+
+
+def test_box_bounds_are_not_constructor_arguments():
+    with pytest.raises(TypeError):
+        BoxSum((0,), (None, None, None), None, [(0, 1)] * 3)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,155 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+from typing import List
+import pytest
+from topas_wrapper import supervisor
+from topas_wrapper.get_data import Supervisor
+from topas_wrapper.script_reader import read_script_lines, read_parameter_value
+from topas_wrapper.run_simulations import SimulationJob
+from topas_wrapper.supervisor import iterate_supervised_simulations, supervise_job
+
+STUB_TOPAS_PATH = Path(__file__).resolve().parents[1] / "benchmarks" / "stub_topas.py"
+PARTICLE_SOURCE_COMPONENT = "Beam"
+SEED_NUMBER = 7
+PROCESS_EXIT_SECONDS = 5.0
+
+
+@pytest.fixture(autouse=True)
+def fast_stub_topas(monkeypatch):
+    monkeypatch.setenv("STUB_TOPAS_STARTUP_SECONDS", "0")
+    monkeypatch.setenv("STUB_TOPAS_SECONDS_PER_HISTORY", "0")
+
+
+@pytest.fixture
+def started_processes(monkeypatch) -> List[supervisor.SupervisedProcess]:
+    # Keeps every process the supervisor starts, so a test can check its process group is gone afterwards
+    processes = []
+    start_process = supervisor.start_process
+
+    async def start_recorded_process(*args, **kwargs):
+        process = await start_process(*args, **kwargs)
+        processes.append(process)
+        return process
+
+    monkeypatch.setattr(supervisor, "start_process", start_recorded_process)
+    return processes
+
+
+def write_run_script(folder: Path, run_name: str) -> Path:
+    script_path = folder / f"{run_name}.txt"
+    script_path.write_text(f"i:Ts/Seed = {SEED_NUMBER}\n"
+                           "i:Ts/NumberOfThreads = 1\n"
+                           f"i:So/{PARTICLE_SOURCE_COMPONENT}/NumberOfHistoriesInRun = 10\n"
+                           f"s:Sc/Scorer/OutputFile = \"{folder / run_name}\"\n"
+                           "i:Sc/Scorer/ZBins = 5\n")
+    return script_path
+
+
+def create_settings(minimum_timeout_seconds: float=30, maximum_retries: int=0) -> Supervisor:
+    return Supervisor.model_validate({"timeout_seconds_per_history": 0.01,
+                                      "minimum_timeout_seconds": minimum_timeout_seconds,
+                                      "maximum_retries": maximum_retries,
+                                      "retry_backoff_seconds": 0})
+
+
+def is_process_group_alive(process_group_id: int) -> bool:
+    # Killed processes can take a moment to be reaped once their parent is gone
+    deadline = time.monotonic() + PROCESS_EXIT_SECONDS
+    while time.monotonic() < deadline:
+        try:
+            os.killpg(process_group_id, 0)
+        except ProcessLookupError:
+            return False
+        time.sleep(0.05)
+    return True
+
+
+def run_supervised(script_paths: List[Path], settings: Supervisor):
+    jobs = [SimulationJob(script_path, 1) for script_path in script_paths]
+    return list(iterate_supervised_simulations(jobs, settings, PARTICLE_SOURCE_COMPONENT, core_budget=2,
+                                               topas_executable=str(STUB_TOPAS_PATH)))
+
+
+def test_successful_run(tmp_path):
+    script_path = write_run_script(tmp_path, "run")
+    [result] = run_supervised([script_path], create_settings())
+    assert result.succeeded
+    assert result.attempts == 1
+    assert (tmp_path / "run.csv").exists()
+    # Reaped with wait4, so the run's resource usage is kept
+    assert result.cpu_time > 0
+    assert result.peak_rss > 0
+
+
+def test_hanging_run_is_killed_at_its_timeout(tmp_path, monkeypatch, started_processes):
+    monkeypatch.setenv("STUB_TOPAS_HANG_SECONDS", "60")
+    script_path = write_run_script(tmp_path, "run")
+    start_time = time.monotonic()
+    [result] = run_supervised([script_path], create_settings(minimum_timeout_seconds=1))
+    assert time.monotonic() - start_time < 1 + supervisor.TERMINATE_GRACE_SECONDS
+    assert result.timed_out
+    assert not result.succeeded
+    assert not is_process_group_alive(started_processes[0].pid)
+
+
+def test_failed_run_is_retried_with_a_new_seed(tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_TOPAS_EXIT_CODE", "3")
+    monkeypatch.setenv("STUB_TOPAS_FAULT_PATTERN", r"^run\.txt$")
+    script_path = write_run_script(tmp_path, "run")
+    [result] = run_supervised([script_path], create_settings(maximum_retries=1))
+    assert result.succeeded
+    assert result.attempts == 2
+    retry_seed = read_parameter_value(read_script_lines(tmp_path / "run_retry_1.txt"), "Ts/Seed")
+    assert int(retry_seed) != SEED_NUMBER
+
+
+def test_run_failing_every_attempt_reports_its_exit_code(tmp_path, monkeypatch):
+    monkeypatch.setenv("STUB_TOPAS_EXIT_CODE", "3")
+    script_path = write_run_script(tmp_path, "run")
+    [result] = run_supervised([script_path], create_settings(maximum_retries=1))
+    assert not result.succeeded
+    assert result.return_code == 3
+    assert result.attempts == 2
+
+
+def test_overlong_output_line_fails_the_attempt_and_not_the_sweep(tmp_path, monkeypatch, started_processes):
+    # Every line the stub prints names the script's full path, which is longer than the lowered limit
+    monkeypatch.setattr(supervisor, "STREAM_LINE_LIMIT", 16)
+    monkeypatch.setenv("STUB_TOPAS_HANG_SECONDS", "60")
+    script_paths = [write_run_script(tmp_path, "run_0"), write_run_script(tmp_path, "run_1")]
+    results = run_supervised(script_paths, create_settings(maximum_retries=1))
+    assert len(results) == 2
+    for result in results:
+        assert not result.succeeded
+        assert not result.timed_out
+        assert result.attempts == 2
+    for process in started_processes:
+        assert not is_process_group_alive(process.pid)
+
+
+def test_cancellation_kills_the_process_group(tmp_path, started_processes):
+    # The stub forks a child into its process group, which must go down with it
+    stub_path = tmp_path / "forking_topas"
+    stub_path.write_text("#!/bin/sh\nsleep 60 &\necho started\nwait\n")
+    stub_path.chmod(0o755)
+    script_path = write_run_script(tmp_path, "run")
+
+    async def cancel_running_job():
+        task = asyncio.create_task(supervise_job(SimulationJob(script_path, 1), create_settings(),
+                                                 str(stub_path), PARTICLE_SOURCE_COMPONENT))
+        while not started_processes:
+            await asyncio.sleep(0.05)
+        await asyncio.sleep(0.5)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(cancel_running_job())
+    assert started_processes[0].returncode is not None
+    assert not is_process_group_alive(started_processes[0].pid)
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,147 @@
+from itertools import islice
+from pathlib import Path
+import numpy as np
+import pytest
+from pydantic import ValidationError
+from topas_wrapper.get_data import ExperimentParameters, Sweep, SweepAxis
+from topas_wrapper.input_constants import SweepParameter
+from topas_wrapper.sweeps import (create_sobol_direction_numbers,
+                                  iterate_sobol_points,
+                                  generate_latin_hypercube,
+                                  count_grid_points,
+                                  iterate_grid_points,
+                                  iterate_sweep_points,
+                                  resolve_sweep_axes,
+                                  MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS,
+                                  SOBOL_BITS)
+
+EXPERIMENT_PARAMETERS_PATH = Path(__file__).resolve().parents[1] / "EXPERIMENT_PARAMETERS.toml"
+
+
+@pytest.fixture
+def experiment_parameters() -> ExperimentParameters:
+    return ExperimentParameters.from_toml(EXPERIMENT_PARAMETERS_PATH)
+
+
+def count_points_per_stratum(unit_values: np.ndarray, number_of_strata: int) -> np.ndarray:
+    return np.bincount((unit_values * number_of_strata).astype(int), minlength=number_of_strata)
+
+
+def test_sobol_direction_numbers_start_from_the_table():
+    direction_numbers = create_sobol_direction_numbers(3)
+    assert direction_numbers.shape == (SOBOL_BITS, 3)
+    # The first dimension is the van der Corput sequence, the others continue their initial m by the recurrence
+    assert [int(number) >> (SOBOL_BITS - bit - 1) for bit, number in enumerate(direction_numbers[:4, 0])] == [1, 1, 1, 1]
+    assert [int(number) >> (SOBOL_BITS - bit - 1) for bit, number in enumerate(direction_numbers[:4, 1])] == [1, 3, 5, 15]
+    assert [int(number) >> (SOBOL_BITS - bit - 1) for bit, number in enumerate(direction_numbers[:4, 2])] == [1, 3, 3, 9]
+
+
+def test_too_many_sobol_dimensions_are_rejected():
+    with pytest.raises(ValueError, match="at most"):
+        create_sobol_direction_numbers(MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS + 1)
+
+
+def test_unshifted_sobol_sequence_starts_at_the_known_points():
+    points = np.array(list(islice(iterate_sobol_points(2), 4)))
+    np.testing.assert_array_equal(points, [[0, 0], [0.5, 0.5], [0.75, 0.25], [0.25, 0.75]])
+
+
+@pytest.mark.parametrize("shifted", [False, True])
+@pytest.mark.parametrize("power", [1, 3, 6])
+def test_first_power_of_two_sobol_points_fill_every_stratum_once(shifted, power):
+    number_of_points = 2**power
+    rng = np.random.default_rng(3) if shifted else None
+    points = np.array(list(islice(iterate_sobol_points(MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS, rng), number_of_points)))
+    assert points.shape == (number_of_points, MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS)
+    assert np.all((points >= 0) & (points < 1))
+    for dimension in range(MAXIMUM_NUMBER_OF_SOBOL_DIMENSIONS):
+        assert np.all(count_points_per_stratum(points[:, dimension], number_of_points) == 1)
+    # The first two dimensions form a (0, m, 2)-net, so every box of area 1 / 2^m holds one point too
+    for x_power in range(power + 1):
+        boxes = (points[:, 0] * 2**x_power).astype(int) * 2**(power - x_power) + (points[:, 1] * 2**(power - x_power)).astype(int)
+        assert np.all(np.bincount(boxes, minlength=number_of_points) == 1)
+
+
+@pytest.mark.parametrize("number_of_samples, number_of_dimensions", [(1, 1), (7, 3), (50, 6)])
+def test_latin_hypercube_fills_every_stratum_once_per_dimension(number_of_samples, number_of_dimensions):
+    points = generate_latin_hypercube(number_of_samples, number_of_dimensions, np.random.default_rng(0))
+    assert points.shape == (number_of_samples, number_of_dimensions)
+    for dimension in range(number_of_dimensions):
+        assert np.all(count_points_per_stratum(points[:, dimension], number_of_samples) == 1)
+
+
+def test_grid_expands_every_combination(experiment_parameters):
+    sweep = Sweep.model_validate({"axes": [{"parameter": "beam_position_spread_x", "minimum": 0.1, "maximum": 0.5, "number_of_points": 3},
+                                           {"parameter": "physics_modules", "values": [["g4em-standard_opt4"], ["g4em-standard_opt3", "g4decay"]]}]})
+    experiment_parameters = experiment_parameters.model_copy(update={"sweep": sweep})
+    sweep_axes = resolve_sweep_axes(experiment_parameters)
+    # Beam energy and numbers of histories join as the first and last axes
+    assert [axis.parameter for axis in sweep_axes] == [SweepParameter.beam_energy,
+                                                       SweepParameter.beam_position_spread_x,
+                                                       SweepParameter.physics_modules,
+                                                       SweepParameter.number_of_histories]
+    number_of_points = len(experiment_parameters.particle_source.beam_energy) * 3 * 2 * len(experiment_parameters.numbers_of_histories)
+    assert count_grid_points(sweep_axes) == number_of_points
+    sweep_points = list(iterate_sweep_points(experiment_parameters))
+    assert len(sweep_points) == number_of_points
+    assert len({tuple(map(str, sweep_point.values())) for sweep_point in sweep_points}) == number_of_points
+    assert sorted({sweep_point[SweepParameter.beam_position_spread_x] for sweep_point in sweep_points}) == pytest.approx([0.1, 0.3, 0.5])
+
+
+def test_range_without_number_of_points_has_no_grid_count():
+    sweep_axes = [SweepAxis.model_validate({"parameter": "beam_energy", "values": [70, 100]}),
+                  SweepAxis.model_validate({"parameter": "beam_angular_spread_x", "minimum": 0, "maximum": 1})]
+    assert count_grid_points(sweep_axes) is None
+    assert count_grid_points(sweep_axes[:1]) == 2
+    assert list(iterate_grid_points(sweep_axes[:1])) == [{SweepParameter.beam_energy: 70}, {SweepParameter.beam_energy: 100}]
+
+
+@pytest.mark.parametrize("sampling", ["latin_hypercube", "sobol"])
+def test_sampled_sweep_takes_number_of_samples_points(experiment_parameters, sampling):
+    sweep = Sweep.model_validate({"sampling": sampling, "number_of_samples": 8,
+                                  "axes": [{"parameter": "beam_energy", "minimum": 70, "maximum": 230},
+                                           {"parameter": "beam_angular_spread_x", "minimum": 0, "maximum": 0.01}]})
+    sweep_points = list(iterate_sweep_points(experiment_parameters.model_copy(update={"sweep": sweep})))
+    assert len(sweep_points) == 8
+    assert all(70 <= sweep_point[SweepParameter.beam_energy] <= 230 for sweep_point in sweep_points)
+    assert all(0 <= sweep_point[SweepParameter.beam_angular_spread_x] <= 0.01 for sweep_point in sweep_points)
+
+
+@pytest.mark.parametrize("axis, expected_error", [
+    ({"parameter": "beam_energy"}, "needs either values or a minimum and maximum"),
+    ({"parameter": "beam_energy", "values": [70], "minimum": 0, "maximum": 1}, "needs either values or a minimum and maximum"),
+    ({"parameter": "physics_modules", "minimum": 0, "maximum": 1}, "can only be swept over listed values"),
+    ({"parameter": "beam_energy", "minimum": 2, "maximum": 1}, "no smaller than it"),
+    ({"parameter": "beam_energy", "minimum": 1}, "no smaller than it"),
+    ({"parameter": "beam_energy", "values": []}, "has no values"),
+    ({"parameter": "beam_energy", "values": [["g4decay"]]}, "must all be numbers"),
+    ({"parameter": "physics_modules", "values": [70]}, "must all be lists of modules"),
+    ({"parameter": "beam_energy", "values": [70, -1]}, "must be zero or greater"),
+    ({"parameter": "beam_energy", "minimum": 0, "maximum": 1, "number_of_points": 1}, "greater than or equal to 2"),
+])
+def test_invalid_sweep_axis_is_rejected(axis, expected_error):
+    with pytest.raises(ValidationError, match=expected_error):
+        SweepAxis.model_validate(axis)
+
+
+@pytest.mark.parametrize("sweep, expected_error", [
+    ({"axes": [{"parameter": "beam_energy", "values": [70]}, {"parameter": "beam_energy", "values": [100]}]}, "only have one sweep axis"),
+    ({"number_of_samples": 4, "axes": [{"parameter": "beam_energy", "values": [70]}]}, "a grid runs every point"),
+    ({"axes": [{"parameter": "beam_energy", "minimum": 70, "maximum": 100}]}, "needs number_of_points"),
+    ({"sampling": "sobol", "axes": [{"parameter": "beam_energy", "values": [70]}]}, "sobol sampling needs number_of_samples"),
+    ({"sampling": "latin_hypercube", "number_of_samples": 0, "axes": []}, "greater than 0"),
+])
+def test_invalid_sweep_is_rejected(sweep, expected_error):
+    with pytest.raises(ValidationError, match=expected_error):
+        Sweep.model_validate(sweep)
+
+
+def test_valid_sweeps_are_accepted():
+    Sweep.model_validate({"axes": [{"parameter": "beam_energy", "minimum": 70, "maximum": 100, "number_of_points": 4}]})
+    Sweep.model_validate({"sampling": "latin_hypercube", "number_of_samples": 10,
+                          "axes": [{"parameter": "beam_energy", "minimum": 70, "maximum": 100},
+                                   {"parameter": "physics_modules", "values": [["g4em-standard_opt4"]]}]})
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
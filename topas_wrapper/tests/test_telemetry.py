@@ -0,0 +1,194 @@
+import math
+from pathlib import Path
+from typing import List
+import numpy as np
+import pytest
+from topas_wrapper.adaptive_histories import run_adaptive_experiment
+from topas_wrapper.get_data import ExperimentParameters, AdaptiveHistories
+from topas_wrapper.input_constants import PhysicsList, SweepParameter
+from topas_wrapper.run_simulations import SimulationJob, SimulationResult, run_experiment, resume_experiment
+from topas_wrapper.script_generator import generate_sweep_point_script, join_script_lines
+from topas_wrapper.sweeps import apply_sweep_point
+from topas_wrapper.telemetry import (TelemetryLedger,
+                                     MINIMUM_NUMBER_OF_MATCHING_RUNS,
+                                     create_configuration_key,
+                                     fit_cost_model,
+                                     order_longest_first,
+                                     read_run_configuration)
+from topas_wrapper.work_queue import enqueue_experiment, run_worker
+
+EXPERIMENT_PARAMETERS_PATH = Path(__file__).resolve().parents[1] / "EXPERIMENT_PARAMETERS.toml"
+STUB_TOPAS_PATH = Path(__file__).resolve().parents[1] / "benchmarks" / "stub_topas.py"
+SWEPT_MODULES = [PhysicsList.g4em_standard_opt3, PhysicsList.g4decay]
+BEAM_ENERGIES = [70.0, 100.0, 130.0, 160.0]
+NUMBERS_OF_HISTORIES = [100, 1000]
+
+
+@pytest.fixture
+def experiment_parameters() -> ExperimentParameters:
+    return ExperimentParameters.from_toml(EXPERIMENT_PARAMETERS_PATH)
+
+
+@pytest.fixture
+def telemetry_ledger(tmp_path) -> TelemetryLedger:
+    telemetry_ledger = TelemetryLedger(tmp_path / "telemetry.sqlite")
+    yield telemetry_ledger
+    telemetry_ledger.close()
+
+
+@pytest.fixture
+def stub_experiment_parameters(tmp_path, experiment_parameters, monkeypatch) -> ExperimentParameters:
+    # An absolute experiment name puts the experiment in the test's folder instead of experiments/
+    monkeypatch.setenv("STUB_TOPAS_STARTUP_SECONDS", "0")
+    monkeypatch.setenv("STUB_TOPAS_SECONDS_PER_HISTORY", "0")
+    return experiment_parameters.model_copy(update={"experiment_name": str(tmp_path / "experiment"),
+                                                    "use_result_cache": False,
+                                                    "numbers_of_histories": [10]})
+
+
+def read_recorded_script_names(ledger_path: Path) -> List[str]:
+    telemetry_ledger = TelemetryLedger(ledger_path)
+    script_names = [script_name for script_name, in telemetry_ledger.connection.execute("SELECT script_name FROM runs ORDER BY id")]
+    telemetry_ledger.close()
+    return script_names
+
+
+def write_sweep_point_script(folder: Path, run_name: str, experiment_parameters: ExperimentParameters, beam_energy: float,
+                             number_of_histories: int, physics_modules: List[PhysicsList]=None) -> Path:
+    sweep_point = {SweepParameter.beam_energy: beam_energy, SweepParameter.number_of_histories: number_of_histories}
+    if physics_modules is not None:
+        sweep_point[SweepParameter.physics_modules] = physics_modules
+    script = generate_sweep_point_script(apply_sweep_point(experiment_parameters, sweep_point), [], folder / run_name)
+    script_path = folder / f"{run_name}.txt"
+    script_path.write_text(join_script_lines(script))
+    return script_path
+
+
+def create_result(script_path: Path, wall_time: float) -> SimulationResult:
+    return SimulationResult(SimulationJob(script_path, 1), 0, wall_time, None)
+
+
+def record_sweep(folder: Path, telemetry_ledger: TelemetryLedger, experiment_parameters: ExperimentParameters,
+                 physics_modules: List[PhysicsList], seconds_per_history: float):
+    for beam_energy in BEAM_ENERGIES:
+        for number_of_histories in NUMBERS_OF_HISTORIES:
+            run_name = f"run_{'default' if physics_modules is None else 'swept'}_{beam_energy:.0f}_{number_of_histories}"
+            script_path = write_sweep_point_script(folder, run_name, experiment_parameters, beam_energy, number_of_histories, physics_modules)
+            telemetry_ledger.record(create_result(script_path, seconds_per_history * number_of_histories * beam_energy / 100), experiment_parameters)
+
+
+def test_run_configuration_is_read_from_the_script(tmp_path, experiment_parameters):
+    script_path = write_sweep_point_script(tmp_path, "run", experiment_parameters, 100.0, 10, SWEPT_MODULES)
+    run_configuration = read_run_configuration(script_path)
+    assert run_configuration.physics_modules == [module.value for module in SWEPT_MODULES]
+    assert run_configuration.bins == (experiment_parameters.scorer.x_bins, experiment_parameters.scorer.y_bins, experiment_parameters.scorer.z_bins)
+
+
+def test_sweep_run_is_recorded_with_the_modules_it_ran_with(tmp_path, experiment_parameters, telemetry_ledger):
+    script_path = write_sweep_point_script(tmp_path, "sweep_point_000000", experiment_parameters, 100.0, 10, SWEPT_MODULES)
+    run_parameters = apply_sweep_point(experiment_parameters, {SweepParameter.beam_energy: 100.0,
+                                                               SweepParameter.number_of_histories: 10,
+                                                               SweepParameter.physics_modules: SWEPT_MODULES})
+    telemetry_ledger.record(create_result(script_path, 2.0), experiment_parameters)
+    configuration_key, physics_modules = telemetry_ledger.connection.execute("SELECT configuration_key, physics_modules FROM runs").fetchone()
+    assert physics_modules == "g4em-standard_opt3 g4decay"
+    assert configuration_key == create_configuration_key(run_parameters)
+    assert configuration_key != create_configuration_key(experiment_parameters)
+
+
+def test_each_script_is_predicted_with_the_cost_model_of_its_configuration(tmp_path, experiment_parameters, telemetry_ledger):
+    # The swept modules run ten times slower, which a single experiment-wide model would average away
+    record_sweep(tmp_path, telemetry_ledger, experiment_parameters, None, 1e-3)
+    record_sweep(tmp_path, telemetry_ledger, experiment_parameters, SWEPT_MODULES, 1e-2)
+    assert telemetry_ledger.has_cost_model()
+    script_paths = [write_sweep_point_script(tmp_path, "next_default", experiment_parameters, 100.0, 500),
+                    write_sweep_point_script(tmp_path, "next_swept", experiment_parameters, 100.0, 500, SWEPT_MODULES)]
+    default_cost_model, swept_cost_model = telemetry_ledger.fit_script_cost_models(script_paths)
+    assert default_cost_model.configuration_key == create_configuration_key(experiment_parameters)
+    assert swept_cost_model.configuration_key != default_cost_model.configuration_key
+    assert default_cost_model.predict(100.0, 500, 1) == pytest.approx(0.5, rel=1e-6)
+    assert swept_cost_model.predict(100.0, 500, 1) == pytest.approx(5.0, rel=1e-6)
+    ordered_script_paths, ordered_cost_models = order_longest_first(script_paths, [default_cost_model, swept_cost_model], experiment_parameters)
+    assert ordered_script_paths == script_paths[::-1]
+    assert ordered_cost_models == [swept_cost_model, default_cost_model]
+
+
+def test_failed_and_cached_runs_are_not_recorded(tmp_path, experiment_parameters, telemetry_ledger):
+    script_path = write_sweep_point_script(tmp_path, "run", experiment_parameters, 100.0, 10)
+    telemetry_ledger.record(SimulationResult(SimulationJob(script_path, 1), 3, 2.0, None), experiment_parameters)
+    telemetry_ledger.record(SimulationResult(SimulationJob(script_path, 1), 0, 0.0, None, cached=True), experiment_parameters)
+    telemetry_ledger.record(SimulationResult(SimulationJob(script_path, 1), 0, 2.0, None, cpu_time=1.5, peak_rss=2**20), experiment_parameters)
+    assert telemetry_ledger.connection.execute("SELECT wall_time, cpu_time, peak_rss, histories_per_second FROM runs").fetchall() == [(2.0, 1.5, 2**20, 5.0)]
+
+
+def test_cost_model_recovers_a_power_law():
+    # wall time = 0.002 * energy^0.5 * histories / cores^0.8
+    rng = np.random.default_rng(0)
+    beam_energies = rng.uniform(50, 250, 40)
+    numbers_of_histories = rng.integers(100, 100000, 40)
+    cores = rng.integers(1, 9, 40)
+    wall_times = 0.002 * beam_energies**0.5 * numbers_of_histories / cores**0.8
+    cost_model = fit_cost_model(np.column_stack([beam_energies, numbers_of_histories, cores, wall_times]), "key")
+    np.testing.assert_allclose(cost_model.coefficients, [math.log(0.002), 0.5, 1.0, -0.8], atol=1e-9)
+    assert cost_model.residual_factor == pytest.approx(1.0)
+    assert cost_model.number_of_runs == 40
+    assert cost_model.predict(100.0, 1000, 4) == pytest.approx(0.002 * 10 * 1000 / 4**0.8)
+
+
+def test_cost_model_falls_back_to_every_configuration(tmp_path, experiment_parameters, telemetry_ledger):
+    assert telemetry_ledger.fit_cost_model() is None
+    assert not telemetry_ledger.has_cost_model()
+    record_sweep(tmp_path, telemetry_ledger, experiment_parameters, None, 1e-3)
+    assert len(BEAM_ENERGIES) * len(NUMBERS_OF_HISTORIES) >= MINIMUM_NUMBER_OF_MATCHING_RUNS
+    cost_model = telemetry_ledger.fit_cost_model("a configuration no run has used")
+    assert cost_model.configuration_key is None
+    assert cost_model.number_of_runs == len(BEAM_ENERGIES) * len(NUMBERS_OF_HISTORIES)
+
+
+def test_run_experiment_records_every_run(tmp_path, stub_experiment_parameters):
+    results = run_experiment(stub_experiment_parameters, str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    assert all(result.succeeded for result in results)
+    assert sorted(read_recorded_script_names(tmp_path / "telemetry.sqlite")) == sorted(result.job.script_path.name for result in results)
+
+
+def test_sharded_run_experiment_records_every_shard(tmp_path, stub_experiment_parameters):
+    experiment_parameters = stub_experiment_parameters.model_copy(update={"number_of_shards": 2})
+    results = run_experiment(experiment_parameters, str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    assert len(results) == 2 * len(experiment_parameters.particle_source.beam_energy)
+    assert len(read_recorded_script_names(tmp_path / "telemetry.sqlite")) == len(results)
+
+
+def test_resume_experiment_records_the_runs_it_reruns(tmp_path, stub_experiment_parameters, monkeypatch):
+    monkeypatch.setenv("STUB_TOPAS_EXIT_CODE", "3")
+    monkeypatch.setenv("STUB_TOPAS_FAULT_PATTERN", r"^beam_energy_70p00")
+    run_experiment(stub_experiment_parameters, str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    assert len(read_recorded_script_names(tmp_path / "telemetry.sqlite")) == len(stub_experiment_parameters.particle_source.beam_energy) - 1
+    monkeypatch.delenv("STUB_TOPAS_EXIT_CODE")
+    [result] = resume_experiment(stub_experiment_parameters.experiment_name, str(STUB_TOPAS_PATH), TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    assert result.succeeded
+    assert read_recorded_script_names(tmp_path / "telemetry.sqlite")[-1] == result.job.script_path.name
+
+
+def test_run_worker_records_every_run(tmp_path, stub_experiment_parameters):
+    enqueue_experiment(stub_experiment_parameters)
+    results = run_worker(stub_experiment_parameters.experiment_name, topas_executable=str(STUB_TOPAS_PATH),
+                         telemetry_ledger=TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    assert len(results) == len(stub_experiment_parameters.particle_source.beam_energy)
+    assert sorted(read_recorded_script_names(tmp_path / "telemetry.sqlite")) == sorted(result.job.script_path.name for result in results)
+
+
+def test_run_adaptive_experiment_records_every_batch(tmp_path, stub_experiment_parameters):
+    adaptive_histories = AdaptiveHistories.model_validate({"target_metric": "integrated_deposit",
+                                                           "relative_tolerance": 1.0,
+                                                           "batch_number_of_histories": 10,
+                                                           "minimum_number_of_batches": 2,
+                                                           "maximum_number_of_histories": 20})
+    experiment_parameters = stub_experiment_parameters.model_copy(update={"adaptive_histories": adaptive_histories})
+    adaptive_runs = run_adaptive_experiment(experiment_parameters, str(STUB_TOPAS_PATH), telemetry_ledger=TelemetryLedger(tmp_path / "telemetry.sqlite"))
+    number_of_batches = sum(adaptive_run.number_of_batches for adaptive_run in adaptive_runs)
+    assert number_of_batches == 2 * len(experiment_parameters.particle_source.beam_energy)
+    assert len(read_recorded_script_names(tmp_path / "telemetry.sqlite")) == number_of_batches
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])
@@ -0,0 +1,165 @@
+import json
+import multiprocessing
+import os
+import time
+from pathlib import Path
+import pytest
+from topas_wrapper import work_queue as work_queue_module
+from topas_wrapper.work_queue import (WorkQueue,
+                                      PENDING_FOLDERNAME,
+                                      CLAIMED_FOLDERNAME,
+                                      DONE_FOLDERNAME,
+                                      FAILED_FOLDERNAME)
+from topas_wrapper.run_simulations import SimulationJob, SimulationResult
+
+LEASE_TIMEOUT_SECONDS = 60.0
+NUMBER_OF_JOBS = 40
+NUMBER_OF_WORKERS = 4
+
+
+def create_queue(experiment_folder: Path, number_of_jobs: int, maximum_attempts: int=3) -> WorkQueue:
+    scripts_folder = experiment_folder / "scripts"
+    scripts_folder.mkdir(parents=True)
+    work_queue = WorkQueue(experiment_folder, LEASE_TIMEOUT_SECONDS, maximum_attempts)
+    work_queue.create()
+    for index in range(number_of_jobs):
+        script_path = scripts_folder / f"run_{index:03d}.txt"
+        script_path.write_text("i:Ts/NumberOfThreads = 1\n")
+        work_queue.enqueue(script_path, 1)
+    return work_queue
+
+
+def age_file(filepath: Path, seconds: float):
+    old_time = time.time() - seconds
+    os.utime(filepath, (old_time, old_time))
+
+
+def create_result(lease, return_code: int) -> SimulationResult:
+    return SimulationResult(SimulationJob(lease.script_path, lease.number_of_threads), return_code, 0.1, None)
+
+
+def claim_until_drained(experiment_folder: Path, worker_id: str, claimed_job_names):
+    work_queue = WorkQueue(experiment_folder, LEASE_TIMEOUT_SECONDS)
+    while True:
+        lease = work_queue.claim(worker_id)
+        if lease is None:
+            return
+        claimed_job_names.append(lease.job_name)
+
+
+def test_concurrent_workers_claim_each_job_once(tmp_path):
+    work_queue = create_queue(tmp_path, NUMBER_OF_JOBS)
+    with multiprocessing.Manager() as manager:
+        claimed_job_names = manager.list()
+        workers = [multiprocessing.Process(target=claim_until_drained, args=(tmp_path, f"worker{index}", claimed_job_names))
+                   for index in range(NUMBER_OF_WORKERS)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        claimed_job_names = list(claimed_job_names)
+    assert len(claimed_job_names) == NUMBER_OF_JOBS
+    assert len(set(claimed_job_names)) == NUMBER_OF_JOBS
+    assert work_queue.count_jobs() == {PENDING_FOLDERNAME: 0, CLAIMED_FOLDERNAME: NUMBER_OF_JOBS, DONE_FOLDERNAME: 0, FAILED_FOLDERNAME: 0}
+
+
+def test_stale_lease_of_dead_worker_is_expired_and_reclaimed(tmp_path):
+    work_queue = create_queue(tmp_path, 1)
+    dead_lease = work_queue.claim("dead")
+    assert work_queue.expire_stale_leases("alive") == 0
+    age_file(dead_lease.lease_path, 2 * LEASE_TIMEOUT_SECONDS)
+    assert work_queue.expire_stale_leases("alive") == 1
+    lease = work_queue.claim("alive")
+    assert lease.job_name == dead_lease.job_name
+    assert lease.attempts == 2
+    assert work_queue.count_jobs()[CLAIMED_FOLDERNAME] == 1
+
+
+def test_job_queued_longer_than_lease_timeout_is_not_expired_while_claimed(tmp_path, monkeypatch):
+    # Another worker expires leases between the rename into claimed and the rewrite of the lease
+    work_queue = create_queue(tmp_path, 1)
+    age_file(work_queue.list_job_files(PENDING_FOLDERNAME)[0], 60 * LEASE_TIMEOUT_SECONDS)
+    other_work_queue = WorkQueue(tmp_path, LEASE_TIMEOUT_SECONDS)
+    rewrite_lease = work_queue_module.rewrite_lease
+
+    def rewrite_lease_after_expiry(job, lease_path):
+        other_work_queue.expire_stale_leases("other")
+        rewrite_lease(job, lease_path)
+
+    monkeypatch.setattr(work_queue_module, "rewrite_lease", rewrite_lease_after_expiry)
+    lease = work_queue.claim("claimer")
+    assert lease is not None
+    assert other_work_queue.claim("other") is None
+    assert work_queue.count_jobs()[PENDING_FOLDERNAME] == 0
+    assert work_queue.count_jobs()[CLAIMED_FOLDERNAME] == 1
+    assert lease.attempts == 1
+
+
+def test_claim_does_not_recreate_a_lease_expired_before_its_rewrite(tmp_path, monkeypatch):
+    work_queue = create_queue(tmp_path, 1)
+    rewrite_lease = work_queue_module.rewrite_lease
+
+    def rewrite_lease_after_move(job, lease_path):
+        os.rename(lease_path, work_queue.folder(PENDING_FOLDERNAME) / lease_path.name.partition("@")[0])
+        rewrite_lease(job, lease_path)
+
+    monkeypatch.setattr(work_queue_module, "rewrite_lease", rewrite_lease_after_move)
+    assert work_queue.claim("claimer") is None
+    assert work_queue.count_jobs()[PENDING_FOLDERNAME] == 1
+    assert work_queue.count_jobs()[CLAIMED_FOLDERNAME] == 0
+
+
+def test_failed_job_is_requeued(tmp_path):
+    work_queue = create_queue(tmp_path, 1)
+    lease = work_queue.claim("worker")
+    work_queue.complete(lease, create_result(lease, 1), "worker")
+    pending_job_files = work_queue.list_job_files(PENDING_FOLDERNAME)
+    assert len(pending_job_files) == 1
+    job = json.loads(pending_job_files[0].read_text())
+    assert job["attempts"] == 1
+    assert job["return_code"] == 1
+    assert work_queue.claim("worker").attempts == 2
+
+
+def test_succeeded_job_is_done(tmp_path):
+    work_queue = create_queue(tmp_path, 1)
+    lease = work_queue.claim("worker")
+    work_queue.complete(lease, create_result(lease, 0), "worker")
+    assert work_queue.count_jobs()[DONE_FOLDERNAME] == 1
+    assert work_queue.is_drained()
+
+
+def test_job_fails_once_maximum_attempts_are_used(tmp_path):
+    work_queue = create_queue(tmp_path, 1, maximum_attempts=2)
+    for _ in range(2):
+        lease = work_queue.claim("worker")
+        work_queue.complete(lease, create_result(lease, 1), "worker")
+    assert work_queue.count_jobs()[FAILED_FOLDERNAME] == 1
+    assert work_queue.claim("worker") is None
+
+
+def test_job_fails_once_maximum_attempts_are_expired(tmp_path):
+    work_queue = create_queue(tmp_path, 1, maximum_attempts=2)
+    for _ in range(2):
+        lease = work_queue.claim("dead")
+        age_file(lease.lease_path, 2 * LEASE_TIMEOUT_SECONDS)
+        work_queue.expire_stale_leases("alive")
+    assert work_queue.claim("alive") is None
+    failed_job_files = work_queue.list_job_files(FAILED_FOLDERNAME)
+    assert len(failed_job_files) == 1
+    assert "Gave up after 2 attempts" in json.loads(failed_job_files[0].read_text())["error"]
+
+
+def test_lost_lease_is_not_recreated_on_completion(tmp_path):
+    work_queue = create_queue(tmp_path, 1)
+    lease = work_queue.claim("slow")
+    age_file(lease.lease_path, 2 * LEASE_TIMEOUT_SECONDS)
+    work_queue.expire_stale_leases("other")
+    other_lease = work_queue.claim("other")
+    os.remove(other_lease.lease_path)
+    work_queue.complete(lease, create_result(lease, 0), "slow")
+    assert work_queue.count_jobs() == {PENDING_FOLDERNAME: 0, CLAIMED_FOLDERNAME: 0, DONE_FOLDERNAME: 0, FAILED_FOLDERNAME: 0}
+
+
+if __name__ == "__main__":
+    pytest.main([__file__])